@@ -47,16 +47,19 @@ from litedram.phy import s7ddrphy
 from litepcie.phy.s7pciephy import S7PCIEPHY
 from litepcie.software import generate_litepcie_software
 
-import subprocess as sp
 import pathlib
 
 from adder import CustomAdder
 from bsREPL import bsREPL
+import buildcache
 
-def git_ident():
-    git_log_cmd = ["git", "--no-pager", "log", "--abbrev-commit", "--max-count", "1", "--pretty=reference"]
-    git_status = sp.run(git_log_cmd, check=True, text=True).stdout
-    return git_status
+# bsc's Verilog library; the build takes what the user module instantiates
+BSC_VERILOG = os.environ.get("BSC_VERILOG", "/home/tparks/upstream/bsc/src/Verilog")
+
+# options the gateware doesn't depend on: actions, and where outputs go
+NOT_DESIGN = {"build", "load", "flash", "driver", "no_cache", "output_dir", "gateware_dir", "software_dir",
+              "include_dir", "generated_dir", "csr_csv", "csr_json", "csr_svd", "memory_x", "doc",
+              "no_compile", "no_compile_software", "no_compile_gateware"}
 
 # BaseSoC -----------------------------------------------------------------------------------------
 class CRG(Module):
@@ -84,12 +87,12 @@ class CRG(Module):
 # BaseSoC = acorn_cle_215_target.BaseSoC
 
 class BaseSoC(SoCCore):
-    def __init__(self, sys_clk_freq=int(100e6), with_pcie=False, with_sata=False, **kwargs):
+    def __init__(self, sys_clk_freq=int(100e6), with_pcie=False, with_sata=False, bsrepl_lanes=1, bsrepl_queue_depth=0, bsrepl_perf=False, bsrepl_stream=False, bsrepl_pop=False, bsrepl_job=False, bsrepl_module="mkCollatzServer", design=None, **kwargs):
         platform = acorn_cle_215_platform.Platform()
 
         # # SoCCore ----------------------------------------------------------------------------------
         SoCCore.__init__(self, platform, sys_clk_freq,
-            ident          = f"LiteX SoC on Acorn CLE 215+ - git log {git_ident()}",
+            ident          = "LiteX SoC on Acorn CLE 215+" + (f" - design {design}" if design else ""),
             ident_version  = True,
             cpu_type       = None,
             **kwargs)
@@ -171,8 +174,32 @@ class BaseSoC(SoCCore):
         # self.submodules.cadd = CustomAdder()
         # self.add_csr("cadd")
 
-        self.submodules.bsREPL = bsREPL()
+        # with bsrepl_stream the first method pair can also be fed from pcie_dma0
+        assert with_pcie or not bsrepl_stream, "streaming needs PCIe"
+        # with bsrepl_job it also runs batch jobs into the DDR3, through a
+        # write and a read port of its own on the controller's crossbar
+        job_ports = None
+        if bsrepl_job:
+            assert not self.integrated_main_ram_size, "batch jobs need the DDR3"
+            job_ports = (self.sdram.crossbar.get_port(mode="write"), self.sdram.crossbar.get_port(mode="read"))
+        self.submodules.bsREPL = bsREPL(module=bsrepl_module, lanes=bsrepl_lanes, queue_depth=bsrepl_queue_depth, perf=bsrepl_perf,
+                                        stream=bsrepl_stream, pop=bsrepl_pop, job_ports=job_ports,
+                                        stream_width=self.pcie_phy.data_width if with_pcie else 128)
         self.add_csr("bsREPL")
+        self.add_constant("BSREPL_LANES", bsrepl_lanes)
+        self.add_constant("BSREPL_QUEUE_DEPTH", bsrepl_queue_depth)
+        if with_pcie:
+            # route the bsREPL events to the next free MSI vector
+            irq = len(self.msis)
+            self.msis["BSREPL"] = self.bsREPL.irq
+            self.comb += self.pcie_msi.irqs[irq].eq(self.bsREPL.irq)
+            self.add_constant("BSREPL_INTERRUPT", irq)
+        if bsrepl_stream:
+            # host -> card through the DMA reader, results back through the writer
+            self.comb += self.pcie_dma0.source.connect(self.bsREPL.sink)
+        if with_pcie and (bsrepl_stream or bsrepl_job):
+            # a job's results can be read back through the writer too
+            self.comb += self.bsREPL.source.connect(self.pcie_dma0.sink)
 
 # Build --------------------------------------------------------------------------------------------
 
@@ -186,47 +213,82 @@ def main():
     parser.add_argument("--driver",          action="store_true", help="Generate PCIe driver")
     parser.add_argument("--with-spi-sdcard", action="store_true", help="Enable SPI-mode SDCard support (requires SDCard adapter on P2)")
     parser.add_argument("--with-sata",       action="store_true", help="Enable SATA support (over PCIe2SATA)")
+    parser.add_argument("--bsrepl-lanes",    default=1, type=int, help="Parallel copies of the bsREPL user module (default: 1)")
+    parser.add_argument("--bsrepl-queue-depth", default=0, type=int, help="Depth of the bsREPL method queues, 0 for the handshake adapter (default: 0)")
+    parser.add_argument("--bsrepl-perf",     action="store_true", help="Add bsREPL performance counters")
+    parser.add_argument("--bsrepl-stream",   action="store_true", help="Feed the first bsREPL method pair from PCIe DMA too")
+    parser.add_argument("--bsrepl-job",      action="store_true", help="Add bsREPL batch jobs with results in the DDR3")
+    parser.add_argument("--bsrepl-module",   default="mkCollatzServer", help="bsc-generated module bsREPL wraps, build/<module>.v (default: mkCollatzServer)")
+    parser.add_argument("--bsrepl-pop",      nargs="?", type=int, const=True, default=False, help="Add read-to-pop result registers, of N payload bits if given")
+    parser.add_argument("--no-cache",        action="store_true", help="Elaborate (and build) even if the outputs are cached")
     builder_args(parser)
     soc_sdram_args(parser)
     args = parser.parse_args()
 
     assert not (args.with_pcie and args.with_sata)
-    soc = BaseSoC(
-        sys_clk_freq = int(float(args.sys_clk_freq)),
-        with_pcie    = args.with_pcie,
-        with_sata    = args.with_sata,
-        **soc_sdram_argdict(args)
-    )
-    basepath = pathlib.Path(__file__).parent.absolute()
-    soc.platform.verilog_include_paths += [f"/home/tparks/upstream/bsc/src/Verilog"]
-    # filename, language, library in
-    soc.platform.sources.append( (f"{basepath}/build/mkCollatzServer.v", "verilog", None) )
-    directory = '/home/tparks/upstream/bsc/src/Verilog'
-    for entry in os.scandir(directory):
-        if entry.path.endswith(".v") and entry.is_file():
-            soc.platform.sources.append( (entry.path, "verilog", None) )
-
-    # print(soc.platform.verilog_include_paths)
-    # sys.exit()
-    # import code; from pprint import pprint as p; code.InteractiveConsole(locals=dict(globals(), **locals())).interact()
-    if args.with_spi_sdcard:
-        soc.add_spi_sdcard()
-
-    builder  = Builder(soc, **builder_argdict(args))
-    builder.build(run=args.build)
-
-
 
+    # the user module bsc generated, and the library modules it instantiates
+    basepath = pathlib.Path(__file__).parent.absolute()
+    verilog = buildcache.verilog_closure([f"{basepath}/build/{args.bsrepl_module}.v"], [f"{basepath}/build", BSC_VERILOG])
+
+    # the design: those, the python that elaborates the SoC and the options.
+    # Its hash names the outputs in the cache, and the SoC in its ident.
+    params = {name: value for name, value in vars(args).items() if name not in NOT_DESIGN}
+    design = buildcache.digest(buildcache.module_files() + verilog, params)[:16]
+
+    platform = acorn_cle_215_platform.Platform()
+    output_dir = args.output_dir or os.path.join("build", platform.name)
+    gateware_dir = args.gateware_dir or os.path.join(output_dir, "gateware")
+    outputs = {"gateware.v": os.path.join(gateware_dir, f"{platform.name}.v")}
+    if args.csr_csv:
+        outputs["csr.csv"] = args.csr_csv
+    if args.build:
+        outputs["gateware.bit"] = os.path.join(gateware_dir, f"{platform.name}.bit")
+        outputs["gateware.bin"] = os.path.join(gateware_dir, f"{platform.name}.bin")
     if args.driver:
-        generate_litepcie_software(soc, os.path.join(builder.output_dir, "driver"))
+        outputs["driver"] = os.path.join(output_dir, "driver")
+
+    cache = buildcache.BuildCache()
+    if not args.no_cache and cache.restore(design, outputs):
+        print(f"design {design}: {', '.join(outputs)} from the cache")
+    else:
+        soc = BaseSoC(
+            sys_clk_freq = int(float(args.sys_clk_freq)),
+            with_pcie    = args.with_pcie,
+            with_sata    = args.with_sata,
+            bsrepl_lanes = args.bsrepl_lanes,
+            bsrepl_queue_depth = args.bsrepl_queue_depth,
+            bsrepl_perf  = args.bsrepl_perf,
+            bsrepl_stream = args.bsrepl_stream,
+            bsrepl_pop   = args.bsrepl_pop,
+            bsrepl_job   = args.bsrepl_job,
+            bsrepl_module = args.bsrepl_module,
+            design       = design,
+            **soc_sdram_argdict(args)
+        )
+        soc.platform.verilog_include_paths += [BSC_VERILOG]
+        # filename, language, library in
+        for path in verilog:
+            soc.platform.sources.append( (path, "verilog", None) )
+
+        # import code; from pprint import pprint as p; code.InteractiveConsole(locals=dict(globals(), **locals())).interact()
+        if args.with_spi_sdcard:
+            soc.add_spi_sdcard()
+
+        builder  = Builder(soc, **builder_argdict(args))
+        builder.build(run=args.build)
+
+        if args.driver:
+            generate_litepcie_software(soc, os.path.join(builder.output_dir, "driver"))
+        cache.store(design, outputs)
 
     if args.load:
-        prog = soc.platform.create_programmer()
-        prog.load_bitstream(os.path.join(builder.gateware_dir, soc.build_name + ".bit"))
+        prog = platform.create_programmer()
+        prog.load_bitstream(os.path.join(gateware_dir, platform.name + ".bit"))
 
     if args.flash:
-        prog = soc.platform.create_programmer()
-        prog.load_bitstream(os.path.join(builder.gateware_dir, soc.build_name + ".bin"))
+        prog = platform.create_programmer()
+        prog.load_bitstream(os.path.join(gateware_dir, platform.name + ".bin"))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess as sp
+
+# Benchmarks for the host <-> card path. Every benchmark reports a
+# distribution (p50/p99/min/max/mean in microseconds) or a throughput, and
+# the run is written as JSON tagged with the bitstream's identifier_mem
+# string, so runs across bitstreams and host-library changes can be diffed.
+#
+#   python bench.py --comm pcie -o results.json
+#   python bench.py --comm sim -n 200
+#   python bench.py --comm file          (CSR access cost only, no card)
+
+def summarize(samples_ns):
+    s = sorted(samples_ns)
+    n = len(s)
+    pick = lambda q: s[min(n - 1, int(q*n))]/1e3
+    return {"n": n,
+            "p50": pick(0.50),
+            "p99": pick(0.99),
+            "min": s[0]/1e3,
+            "max": s[-1]/1e3,
+            "mean": sum(s)/n/1e3,
+            "unit": "us"}
+
+def timed(fn, n):
+    clock = time.perf_counter_ns
+    samples = []
+    for i in range(n):
+        t = clock()
+        fn(i)
+        samples.append(clock() - t)
+    return summarize(samples)
+
+def _pick(regs, names):
+    for name in names:
+        if hasattr(regs, name):
+            return getattr(regs, name)
+    return None
+
+def bench_csr(comm, n):
+    results = {}
+    regs = comm.regs
+    # a scratch register is safe to write with anything
+    scratch = _pick(regs, ["ctrl_scratch", "cadd_a"])
+    if scratch is not None:
+        results["csr_read"] = timed(lambda i: scratch.read(), n)
+        results["csr_write"] = timed(lambda i: scratch.write(i), n)
+    # 64 bit, split over two words; only written while the trigger is low,
+    # so the adapter never acts on it. A queued adapter would take every
+    # write as a call, so it is skipped there.
+    wide = _pick(regs, ["bsREPL_collatz_submit_n_value_csr", "bsREPL_lane0_collatz_submit_n_value_csr"])
+    queued = _pick(regs, ["bsREPL_collatz_submit_credits_csr", "bsREPL_lane0_collatz_submit_credits_csr"])
+    if wide is not None and queued is None:
+        results["csr64_read"] = timed(lambda i: wide.read(), n)
+        results["csr64_write"] = timed(lambda i: wide.write(i << 32 | i), n)
+    return results
+
+def bench_repl(comm, n, batch):
+    from bsREPL import bsREPL
+    results = {}
+    repl = bsREPL(comm)
+    comm.regs.bsREPL_reset.write(1)
+
+    def roundtrip(i):
+        repl.collatz_submit(n=5 + i)
+        repl.collatz_get()
+    results["roundtrip"] = timed(roundtrip, n)
+
+    def throughput(fn):
+        t = time.perf_counter()
+        calls = fn()
+        t = time.perf_counter() - t
+        return {"calls": calls, "seconds": t, "calls_per_s": calls/t}
+
+    def batched():
+        for start in range(5, 5 + n, batch):
+            values = range(start, min(start + batch, 5 + n))
+            repl.collatz_submit_many(values)
+            repl.collatz_get_many(len(values))
+        return n
+    # a batch bigger than the queues would block in submit_many
+    batch = min(batch, repl.pipeline_depth)
+    results["batch"] = throughput(batched)
+    results["batch"]["batch"] = batch
+
+    def pipelined():
+        return len(repl.map("collatz_submit", "collatz_get", range(5, 5 + n)))
+    results["pipelined"] = throughput(pipelined)
+    results["pipelined"]["lanes"] = repl.lanes
+    results["pipelined"]["queue_depth"] = repl.queue_depth
+    return results
+
+def bench_dma(util="build/driver/user/litepcie_util"):
+    # loopback bandwidth through dma.py when the driver's device is there
+    import dma
+    if os.path.exists(dma.DEVICE):
+        with dma.DMA() as d:
+            return {"dma_loopback": d.loopback_test()}
+    # otherwise as reported by litepcie_util's dma_test; the raw table is
+    # kept since its columns differ between litepcie versions
+    if not os.path.exists(util):
+        return {}
+    try:
+        out = sp.run(["sudo", util, "dma_test"], capture_output=True, text=True, timeout=15).stdout
+    except sp.TimeoutExpired as e:
+        out = e.stdout.decode() if isinstance(e.stdout, bytes) else (e.stdout or "")
+    speeds = []
+    for line in out.splitlines():
+        fields = line.split()
+        try:
+            speeds.append(float(fields[0]))
+        except (ValueError, IndexError):
+            pass
+    result = {"raw": out}
+    if speeds:
+        result["gbps"] = {"n": len(speeds), "max": max(speeds), "mean": sum(speeds)/len(speeds)}
+    return {"dma_loopback": result}
+
+def open_backend(kind):
+    if kind == "file":
+        # an anonymous mapping standing in for BAR0: measures the host side
+        # of a CSR access only
+        from comm_mmap import CommMMAP
+        comm = CommMMAP(None, csr_csv="csr.csv", size=0x20000)
+        comm.open()
+        return comm
+    from device import open_comm
+    return open_comm(kind)
+
+def main():
+    parser = argparse.ArgumentParser(description="CSR / bsREPL / DMA benchmarks")
+    parser.add_argument("--comm", default=os.environ.get("BSREPL_COMM", "pcie"),
+                        choices=["pcie", "mmap", "sim", "file"], help="comm backend")
+    parser.add_argument("-n", type=int, default=10000, help="samples per benchmark")
+    parser.add_argument("--batch", type=int, default=64, help="batch size for the batch benchmark")
+    parser.add_argument("--no-dma", action="store_true", help="skip the DMA loopback benchmark")
+    parser.add_argument("-o", "--output", default=None, help="write results as JSON here")
+    args = parser.parse_args()
+
+    comm = open_backend(args.comm)
+
+    from device import read_ident
+    ident = read_ident(comm) if hasattr(comm.bases, "identifier_mem") and args.comm != "file" else args.comm
+
+    results = bench_csr(comm, args.n)
+    if args.comm != "file":
+        results.update(bench_repl(comm, args.n, args.batch))
+    if args.comm in ["pcie", "mmap"] and not args.no_dma:
+        results.update(bench_dma())
+
+    run = {"ident": ident,
+           "comm": args.comm,
+           "host": platform.node(),
+           "python": sys.version.split()[0],
+           "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "results": results}
+
+    print(ident)
+    for name, r in results.items():
+        if "p50" in r:
+            print(f"{name:12} p50 {r['p50']:9.2f}us  p99 {r['p99']:9.2f}us  max {r['max']:9.2f}us")
+        elif "calls_per_s" in r:
+            print(f"{name:12} {r['calls_per_s']:12.0f} calls/s")
+        elif "gbps" in r and isinstance(r["gbps"], dict):
+            print(f"{name:12} {r['gbps']['max']:12.2f} Gbps max")
+        elif "gbps" in r:
+            print(f"{name:12} {r['gbps']:12.2f} Gbps, {r['errors']} bad buffers")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import os
+import stat
+import time
+import queue
+import argparse
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+# One process owns the card, everyone else talks to it.
+#
+# The bsREPL handshake CSRs are shared state, so two processes calling
+# methods at once corrupt each other's calls. The broker holds the only
+# comm and repl; clients connect over a Unix socket and send whole batches
+# (submit, get, values). Whatever has queued up from all the clients while
+# the previous batch ran is merged into one repl.map call per method pair,
+# so more clients mean bigger pipelined batches rather than interleaved
+# handshakes, and each client gets back its own slice of the results.
+#
+#   python broker.py serve                      (BSREPL_COMM picks the comm)
+#   python broker.py bench -c 4
+#
+#   client = BrokerClient()
+#   steps = client.map("collatz_submit", "collatz_get", range(5, 1000))
+#
+# Connections carry pickles, so only the owner of the broker may talk to
+# it: the socket sits in a directory only they can enter, and clients
+# have to prove they know the authkey kept next to it (created by the
+# first broker, readable only by them).
+
+RUNTIME_DIR = os.environ.get("XDG_RUNTIME_DIR") or f"/tmp/bsrepl-{os.getuid()}"
+ADDRESS = os.environ.get("BSREPL_BROKER", os.path.join(RUNTIME_DIR, "bsrepl", "broker.sock"))
+
+def _private_dir(path):
+    # the socket's directory, and any missing above it, made 0700: those
+    # have to be ours and closed to everyone else. The directories above
+    # must be ours or root's, and not open for others to swap ours out
+    # (world-writable only with the sticky bit, like /tmp).
+    path = os.path.abspath(path)
+    made = []
+    head = path
+    while not os.path.exists(head):
+        made.append(head)
+        head = os.path.dirname(head)
+    for directory in reversed(made):
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass # someone else just made it: checked below like ours
+    uid = os.getuid()
+    directory = path
+    while True:
+        st = os.stat(directory)
+        if directory == path or directory in made:
+            if st.st_uid != uid or st.st_mode & 0o077:
+                raise PermissionError(f"{directory} has to be owned by you and closed to others (chmod 700)")
+        elif st.st_uid not in (0, uid) or (st.st_mode & stat.S_IWOTH and not st.st_mode & stat.S_ISVTX):
+            raise PermissionError(f"{directory} could be replaced by another user")
+        if directory == os.path.dirname(directory):
+            return path
+        directory = os.path.dirname(directory)
+
+def authkey(address=ADDRESS, create=False):
+    # the key in the socket's directory; the broker creates it
+    path = os.path.join(_private_dir(os.path.dirname(os.path.abspath(address))), "authkey")
+    if create and not os.path.exists(path):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(os.urandom(32))
+        except FileExistsError:
+            pass # another broker got there first
+    with open(path, "rb") as f:
+        return f.read()
+
+class Broker():
+
+    def __init__(self, repl, address=ADDRESS, max_batch=1 << 16):
+        self.repl = repl
+        self.address = address
+        self.authkey = authkey(address, create=True)
+        # calls merged into one map, at most
+        self.max_batch = max_batch
+        self.batches = 0
+        self.calls = 0
+        self._requests = queue.Queue()
+        self._listener = None
+        self._dispatcher = None
+
+    def start(self):
+        if os.path.exists(self.address):
+            # a socket nobody answers on is left over from a broker that
+            # died; one that answers belongs to a live broker, keep off it
+            try:
+                Client(self.address, family="AF_UNIX", authkey=self.authkey).close()
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.address)
+            except AuthenticationError:
+                raise RuntimeError(f"another broker (with another key) is serving {self.address}")
+            else:
+                raise RuntimeError(f"another broker is serving {self.address}")
+        self._listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        threading.Thread(target=self._accept, daemon=True).start()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def serve_forever(self):
+        self.start()
+        self._dispatcher.join()
+
+    def close(self):
+        self._requests.put(None)
+        self._dispatcher.join()
+        self._listener.close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except AuthenticationError:
+                continue # a client without the key
+            except OSError:
+                return
+            threading.Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn):
+        # one thread per client, only ever receiving; replies are sent by
+        # the dispatcher
+        while True:
+            try:
+                tag, submit, get, values = conn.recv()
+            except (EOFError, OSError):
+                return
+            except Exception:
+                conn.close() # not a request
+                return
+            self._requests.put((conn, tag, submit, get, values))
+
+    def _take(self):
+        # block for one request, then take whatever else is already queued
+        first = self._requests.get()
+        if first is None:
+            return None
+        pending = [first]
+        n = len(first[4])
+        while n < self.max_batch:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None) # finish this batch first
+                break
+            pending.append(request)
+            n += len(request[4])
+        return pending
+
+    def _dispatch(self):
+        while True:
+            pending = self._take()
+            if pending is None:
+                return
+            groups = {}
+            for request in pending:
+                groups.setdefault(request[2:4], []).append(request)
+            for (submit, get), requests in groups.items():
+                values = [v for request in requests for v in request[4]]
+                try:
+                    results, error = self.repl.map(submit, get, values), None
+                except Exception as e:
+                    results, error = None, repr(e)
+                self.batches += 1
+                self.calls += len(values)
+                start = 0
+                for conn, tag, _, _, request_values in requests:
+                    end = start + len(request_values)
+                    reply = (tag, None, error) if error else (tag, results[start:end], None)
+                    start = end
+                    try:
+                        conn.send(reply)
+                    except OSError:
+                        pass # client went away
+
+class BrokerClient():
+    # one per thread: requests on a connection are answered in order
+
+    def __init__(self, address=ADDRESS):
+        self._conn = Client(address, family="AF_UNIX", authkey=authkey(address))
+        self._tag = 0
+
+    def map(self, submit, get, values):
+        self._tag += 1
+        self._conn.send((self._tag, submit, get, list(values)))
+        tag, results, error = self._conn.recv()
+        assert tag == self._tag
+        if error is not None:
+            raise RuntimeError(f"broker: {error}")
+        return results
+
+    def call(self, submit, get, value):
+        return self.map(submit, get, [value])[0]
+
+    def close(self):
+        self._conn.close()
+
+
+import unittest
+
+class TestBroker(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from bsREPL import bsREPL, _sim
+        self.comm = _sim()
+        self.repl = bsREPL(self.comm)
+        self.dir = tempfile.TemporaryDirectory()
+        self.broker = Broker(self.repl, address=os.path.join(self.dir.name, "bsrepl.sock"))
+        self.broker.start()
+
+    def tearDown(self):
+        self.broker.close()
+        self.comm.close()
+        self.dir.cleanup()
+
+    def test_clients(self):
+        from bsREPL import _collatz
+        results = {}
+        def client(i):
+            c = BrokerClient(self.broker.address)
+            values = range(5 + 10*i, 15 + 10*i)
+            results[i] = (values, c.map("collatz_submit", "collatz_get", values))
+            c.close()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for values, got in results.values():
+            self.assertEqual(got, [_collatz(n) for n in values])
+        self.assertEqual(self.broker.calls, 30)
+
+    def test_access(self):
+        import socket
+        address = self.broker.address
+        self.assertEqual(os.stat(os.path.join(self.dir.name, "authkey")).st_mode & 0o777, 0o600)
+        with self.assertRaises(AuthenticationError):
+            Client(address, family="AF_UNIX", authkey=b"guess").close()
+        # a live broker keeps its address, a dead one's socket is taken over
+        with self.assertRaises(RuntimeError):
+            Broker(self.repl, address=address).start()
+        stale = os.path.join(self.dir.name, "stale.sock")
+        dead = socket.socket(socket.AF_UNIX)
+        dead.bind(stale)
+        dead.close()
+        other = Broker(self.repl, address=stale)
+        other.start()
+        c = BrokerClient(stale)
+        self.assertEqual(c.call("collatz_submit", "collatz_get", 5), 5)
+        c.close()
+        other.close()
+        # the socket's directory has to be private
+        open_dir = os.path.join(self.dir.name, "open")
+        os.mkdir(open_dir, 0o755)
+        os.chmod(open_dir, 0o755)
+        with self.assertRaises(PermissionError):
+            Broker(self.repl, address=os.path.join(open_dir, "broker.sock"))
+        # and so do the ones made for it, while those above can't be open
+        # to others without the sticky bit
+        Broker(self.repl, address=os.path.join(self.dir.name, "a", "b", "broker.sock"))
+        for path in ["a", "a/b"]:
+            self.assertEqual(os.stat(os.path.join(self.dir.name, path)).st_mode & 0o777, 0o700)
+        os.chmod(open_dir, 0o777)
+        with self.assertRaises(PermissionError):
+            Broker(self.repl, address=os.path.join(open_dir, "c", "broker.sock"))
+        os.chmod(open_dir, 0o777 | stat.S_ISVTX)
+        Broker(self.repl, address=os.path.join(open_dir, "c", "broker.sock"))
+
+    def test_error(self):
+        c = BrokerClient(self.broker.address)
+        with self.assertRaises(RuntimeError):
+            c.map("no_such_method", "collatz_get", [5])
+        self.assertEqual(c.call("collatz_submit", "collatz_get", 27), 111)
+        c.close()
+
+
+def _bench_client(address, n, chunk, out):
+    c = BrokerClient(address)
+    for start in range(5, 5 + n, chunk):
+        c.map("collatz_submit", "collatz_get", range(start, min(start + chunk, 5 + n)))
+    c.close()
+    out.put(n)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bsREPL device broker")
+    parser.add_argument("command", choices=["serve", "bench"])
+    parser.add_argument("--address", default=ADDRESS, help="Unix socket path")
+    parser.add_argument("-c", "--clients", type=int, default=4, help="bench: client processes")
+    parser.add_argument("-n", type=int, default=10000, help="bench: calls per client")
+    parser.add_argument("--chunk", type=int, default=16, help="bench: values per request")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        from device import comm
+        from bsREPL import bsREPL
+        repl = bsREPL(comm)
+        comm.regs.bsREPL_reset.write(1)
+        print(f"serving {args.address}")
+        Broker(repl, address=args.address).serve_forever()
+    else:
+        import multiprocessing
+        out = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=_bench_client, args=(args.address, args.n, args.chunk, out))
+                   for _ in range(args.clients)]
+        t = time.perf_counter()
+        for p in clients:
+            p.start()
+        calls = sum(out.get() for _ in clients)
+        t = time.perf_counter() - t
+        for p in clients:
+            p.join()
+        print(f"{args.clients} clients: {calls/t:.0f} calls/s")
@@ -1,23 +1,141 @@
 from migen import *
 from litex.soc.interconnect.csr import *
+from litex.soc.interconnect.csr_eventmanager import EventManager, EventSourcePulse
+from litex.soc.interconnect import stream
 from migen.fhdl import *
+from migen.genlib.fifo import SyncFIFO
 from bsv_parser import BSVInterface
-from functools import partial
+from waiters import SpinWaiter, CallTimeout, Deadline
+import profiler
+import stubgen
+import memo
+import atexit
+import weakref
+import os
+import subprocess
+from functools import partial, reduce
+from operator import or_
+from collections import deque
+import numpy as np
+
+# sentinel for the end of a batch of values
+_END = object()
+
+# repls with a memo_path, saved together at exit. Weak, so the exit
+# handler doesn't keep every repl (and its comm) alive.
+_memo_repls = weakref.WeakSet()
+
+def _save_memos():
+    # one write per file: repls sharing a memo_path would otherwise
+    # overwrite each other's caches in turn
+    paths = {}
+    for repl in list(_memo_repls):
+        paths.setdefault(repl.memo_path, []).append(repl)
+    for path, repls in paths.items():
+        caches = {}
+        for repl in repls:
+            ident, memos = repl._memo_snapshot()
+            for name, cache in memos.items():
+                if name in caches:
+                    cache = memo.Memo(max(cache.maxsize, caches[name].maxsize), caches[name].items() + cache.items())
+                caches[name] = cache
+        memo.save(path, ident, caches)
+
+atexit.register(_save_memos)
+
+# the user module bsREPL wraps unless told otherwise
+COLLATZ_INTERFACE = """
+interface Ifc_type;
+  method Action collatz_submit(Int#(64) n);
+  method ActionValue#(Int#(64)) collatz_get();
+endinterface: Ifc_type
+"""
+
+def stream_slot(width):
+    # bits an argument or result takes in the DMA stream: a whole NumPy
+    # integer, so the host side is a plain array
+    return max(8, 1 << (width - 1).bit_length())
+
+def stream_dtype(type, width):
+    return np.dtype(f"<{'i' if type == 'Int' else 'u'}{stream_slot(width)//8}")
 
 class bsREPL(Module):
 
-    def __init__(self, comm=None):
+    # how many calls the batch API keeps in flight. mkCollatzServer has 2-deep
+    # mkFIFO request and response queues, plus the working registers of the
+    # server itself and the adapter's input and output holding registers.
+    pipeline_depth = 2 + 2 + 1 + 1 + 1
+
+    def __init__(self, comm=None, waiter=None, model=None, lanes=None, queue_depth=None, perf=False,
+                 interface=COLLATZ_INTERFACE, module="mkCollatzServer", modname="bsREPL",
+                 stream=False, stream_width=128, dma=None, pop=False,
+                 pure=None, memo_size=1 << 20, memo_path=None, timeout=None, recover=True, job_ports=None):
         self._comm = comm
-        INTERFACE = """
-        interface Ifc_type;
-          method Action collatz_submit(Int#(64) n);
-          method ActionValue#(Int#(64)) collatz_get();
-        endinterface: Ifc_type
-        """
+        # the verilog module to instantiate, and the name of its CSR bank
+        self.module = module
+        self.modname = modname
+        # a migen stand-in for the verilog user module, for simulation; see
+        # models.py. With several lanes, a list of one model per lane.
+        self._model = model
+        # parallel copies of the user module. The host finds out from the
+        # registers when it isn't given.
+        self.lanes = lanes
+        # 0 for the single-value handshake adapter, otherwise the depth of
+        # the FIFOs in front of and behind every method. Also found out from
+        # the registers on the host.
+        self.queue_depth = queue_depth
+        # performance counters per method, see _add_perf
+        self.perf_counters = perf
+        # read-to-pop registers for the actionvalue methods, True or the
+        # payload bits of a narrow one; see _add_pop
+        self.pop = pop
+        # how the host waits on handshakes; see waiters.py. Without one the
+        # methods are generated stubs that spin inline, see stubgen.py.
+        self._stubs = waiter is None
+        self._waiter = SpinWaiter() if waiter is None else waiter
+        # seconds a call may wait on the card without progress before it
+        # raises CallTimeout; with recover the adapter is brought back
+        # first, see recover(). None waits forever, with no clock reads.
+        self.timeout = timeout
+        if timeout is not None:
+            self._waiter.timeout = timeout
+        # True resets the adapter, "hot_reset" also lets a recovery hot
+        # reset the card when that isn't enough, False leaves it as it is
+        assert recover in (True, False, "hot_reset"), f"recover={recover!r}"
+        self.auto_recover = recover
+        # called with the CallTimeout (None for a plain recover()) whenever
+        # the adapter is reset, to drop host-side state about calls in it
+        self.on_recover = []
+
+        # the user module's interface: a BSVInterface, or its source, e.g.
+        # BSVInterface.from_package("CollatzServer.bsv")["Ifc_type"]
+        self.interface = BSVInterface(interface) if isinstance(interface, str) else interface
 
-        self.interface = BSVInterface(INTERFACE)
+        # DMA streaming of an action / actionvalue method pair, see
+        # _add_stream: True for the first of each, or (submit, get). On the
+        # host the adapter's registers tell whether it was built with it.
+        self.stream_dma = bool(stream)
+        # on-card batch jobs over that pair, see _add_job: the (write, read)
+        # SDRAM ports the results go through, e.g. two crossbar ports, or
+        # models.DRAMModel's in simulation
+        self.job_ports = job_ports
+        if stream is True or (stream is False and (comm is not None or job_ports is not None)):
+            stream = (self.interface.actionmethods[0][3], self.interface.actionvaluemethods[0][2])
+        self.stream_methods = stream or None
+        # data width of the pcie_dma0 streams
+        self.stream_width = stream_width
+        # a dma.DMA for stream() on the host
+        self.dma = dma
+        # method pairs that are pure functions of their argument, True for
+        # the first pair: map, stream and call go through a result cache of
+        # memo_size entries, kept in memo_path between sessions. See memo.py.
+        self._pure = pure
+        self.memo_size = memo_size
+        self.memo_path = memo_path
 
         if comm is None:
+            self.lanes = 1 if lanes is None else lanes
+            self.queue_depth = 0 if queue_depth is None else queue_depth
             self._init_HDL()
         else:
             self._init_REPL()
@@ -48,44 +166,115 @@ class bsREPL(Module):
             If(reset_count > 0, reset_count.eq(reset_count-1)), # countdown
             ]
 
-        self.signals = connections = []
+        # one event per method and lane, in interface order: fires when a
+        # submission is accepted or a result becomes valid. The SoC routes irq
+        # to an MSI vector.
+        self.submodules.ev = ev = EventManager()
+
+        if self.perf_counters:
+            # one control for all the counters, so a snapshot is consistent
+            # across methods and lanes
+            self.perf_control = control = CSRStorage(2,
+                                                     description="perf counters: write 1 to snapshot, 2 to clear, 3 for both",
+                                                     name="perf_control_csr")
+            csrs["perf_control_csr"] = control
+            self.perf_snapshot = Signal()
+            self.perf_clear = Signal()
+            self.comb += [self.perf_snapshot.eq(control.re & control.storage[0]),
+                          self.perf_clear.eq(control.re & control.storage[1])]
+            self._add_perf("perf", cycles=1)
+
+        # a user module per lane. Lanes share the reset but have their own
+        # CSRs and events, prefixed lane<i>_ when there is more than one.
+        if isinstance(self._model, (list, tuple)):
+            models = list(self._model)
+        else:
+            assert self._model is None or self.lanes == 1, "need a model per lane"
+            models = [self._model]*self.lanes
+        assert len(models) == self.lanes, "need a model per lane"
+        if self.stream_methods:
+            self._add_stream()
+        for lane in range(self.lanes):
+            self._add_lane(lane, rst_n, models[lane])
+        if self.job_ports:
+            # after the methods', so their event bits stay put
+            ev.job = EventSourcePulse(name="job", description="batch job finished")
+            self.comb += ev.job.trigger.eq(self.job_finished)
+
+        ev.finalize()
+        self.irq = ev.irq
+        for csr in ev.get_csrs():
+            csr.name = f"ev_{csr.name}"
+            csrs[csr.name] = csr
+
+        for name, csr in csrs.items():
+            print(name, csr)
+            self.__setattr__(name, csr)
+
+    def _lane_prefix(self, lane):
+        return "" if self.lanes == 1 else f"lane{lane}_"
+
+    def _add_lane(self, lane, rst_n, model):
+        csrs, signals, ev = self.csrs, self.signals, self.ev
+        prefix = self._lane_prefix(lane)
+        connections = []
+        # calls inside the user module, for the actionvalue perf counters
+        outstanding = Signal(32)
 
         for type, width, arg_name, method_name, in self.interface.actionmethods:
+            name = f"{prefix}{method_name}"
+            if self.queue_depth:
+                connections += self._add_queued_action(name, width, arg_name, method_name, rst_n)
+                continue
             # generate CSRs to interface. inputs call action methods.
             # ready, enable, ack. When calling a method, we wait for ready
             # set value, and pulse enable before returning.
             value = CSRStorage(width,
-                               description=f"input {method_name} {arg_name} value CSR",
-                               name=f"{method_name}_{arg_name}_value_csr",
+                               description=f"input {name} {arg_name} value CSR",
+                               name=f"{name}_{arg_name}_value_csr",
                                write_from_dev=True)
-            csrs[f"{method_name}_{arg_name}_value_csr"] = value
+            csrs[f"{name}_{arg_name}_value_csr"] = value
 
             # set to 0 by dev: waiting,
             # set to 1 by host: attempt write,
             # set to 0 by dev: write commited
-            trigger = CSRStorage(1, description=f"input {method_name} trigger CSR",
-                                 name=f"{method_name}_trigger_csr",
+            trigger = CSRStorage(1, description=f"input {name} trigger CSR",
+                                 name=f"{name}_trigger_csr",
                                  write_from_dev=True)
-            csrs[f"{method_name}_trigger_csr"] = trigger
+            csrs[f"{name}_trigger_csr"] = trigger
+
+            status = CSRStatus(5, description=f"input {name} internal status CSR",
+                                 name=f"{name}_status_csr")
+            csrs[f"{name}_status_csr"] = status
 
-            status = CSRStatus(4, description=f"input {method_name} internal status CSR",
-                                 name=f"{method_name}_status_csr")
-            csrs[f"{method_name}_status_csr"] = status
+            # the status bits are combinational, so a status read right after
+            # a trigger or ack write already sees it (bsREPL_async polls them)
 
             # we need to pulse enable when we have new data, but we can't do
             # single-cycle pulse from Python - use a simple edge detector here.
             enable_edge = Signal(1, reset=0)
-            signals[f"{method_name}_enable_edge"] = enable_edge
-            self.sync += [status.status[0].eq(enable_edge)]
+            signals[f"{name}_enable_edge"] = enable_edge
+            self.comb += [status.status[0].eq(enable_edge)]
             ready_to_write = Signal(1)
-            signals[f"{method_name}_ready_to_write"] = ready_to_write
-            self.sync += [status.status[1].eq(ready_to_write)]
+            signals[f"{name}_ready_to_write"] = ready_to_write
+            self.comb += [status.status[1].eq(ready_to_write)]
             value_sig = Signal(width, reset=0)
-            signals[f"{method_name}_value_sig"] = value_sig
-            self.sync += [status.status[2].eq(value_sig)]
+            signals[f"{name}_value_sig"] = value_sig
+            self.comb += [status.status[2].eq(value_sig)]
+
+            # rst_n stays in bit 3
+            self.comb += [status.status[3].eq(rst_n)]
+            # submission pending, the inverse of "trigger has dropped back to 0"
+            self.comb += [status.status[4].eq(trigger.storage)]
 
-            # keep in top bit
-            self.sync += [status.status[3].eq(rst_n)]
+            self._add_perf(name,
+                           calls=enable_edge,
+                           stall=trigger.storage & ~ready_to_write,
+                           hostwait=~trigger.storage & ready_to_write,
+                           busy=trigger.storage)
+
+            event = EventSourcePulse(name=name, description=f"{name} submission accepted")
+            setattr(ev, name, event)
 
             action_fsm = FSM(reset_state="RESET")
             self.submodules += action_fsm
@@ -103,6 +292,7 @@ class bsREPL(Module):
                              NextState("SEND")),
                           )
             action_fsm.act("SEND",
+                           event.trigger.eq(1),
                            NextValue(enable_edge, 1),
                            NextValue(value_sig, value.storage),
                            NextState("RESET")
@@ -119,75 +309,689 @@ class bsREPL(Module):
             # To call the method, send EN high for 1 cycle. Next cycle,
             # value will hold the data. This needs to be copied to the
             # CSR from verilog.
+            name = f"{prefix}{method_name}"
+            if self.queue_depth:
+                connections += self._add_queued_actionvalue(name, width, method_name, rst_n, outstanding)
+                continue
             value = CSRStatus(width,
-                              description=f"output {method_name} value CSR",
-                              name=f"{method_name}_value_csr")
-            csrs[f"{method_name}_value_csr"] = value
+                              description=f"output {name} value CSR",
+                              name=f"{name}_value_csr")
+            csrs[f"{name}_value_csr"] = value
             ack = CSRStorage(1,
-                             description=f"output {method_name} ack read csr",
-                             name=f"{method_name}_ack_csr",
+                             description=f"output {name} ack read csr",
+                             name=f"{name}_ack_csr",
                              reset=1, # when we start there was no prior value, so we say it's been ack'ed
                              write_from_dev=True)
-            csrs[f"{method_name}_ack_csr"] = ack
+            csrs[f"{name}_ack_csr"] = ack
 
-            status = CSRStatus(4,
-                              description=f"output {method_name} status CSR",
-                              name=f"{method_name}_status_csr")
-            csrs[f"{method_name}_status_csr"] = status
+            status = CSRStatus(5,
+                              description=f"output {name} status CSR",
+                              name=f"{name}_status_csr")
+            csrs[f"{name}_status_csr"] = status
 
 
             value_sig = Signal(width)
             ready_sig = Signal(1)
             enable_sig = Signal(1)
-            signals[f"{method_name}_value_sig"] = value_sig
-            signals[f"{method_name}_enable_edge"] = enable_sig
-            signals[f"{method_name}_ready_to_read"] = ready_sig
-            self.sync += [status.status[0].eq(ready_sig),
+            signals[f"{name}_value_sig"] = value_sig
+            signals[f"{name}_enable_edge"] = enable_sig
+            signals[f"{name}_ready_to_read"] = ready_sig
+            self.comb += [status.status[0].eq(ready_sig),
                           status.status[1].eq(enable_sig),
-                          status.status[3].eq(rst_n)]
+                          status.status[3].eq(rst_n),
+                          status.status[4].eq(~ack.storage)] # result waiting for the host
+
+            if self.pop:
+                # reading the value out through the pop register acks it
+                self.sync += If(self._add_pop(name, width, ~ack.storage, value.status), ack.storage.eq(1))
+
+            self._add_perf(name,
+                           calls=enable_sig,
+                           stall=(outstanding != 0) & ack.storage & ~ready_sig,
+                           hostwait=~ack.storage,
+                           busy=(outstanding != 0) & ~ready_sig)
+
+            event = EventSourcePulse(name=name, description=f"{name} result valid")
+            setattr(ev, name, event)
 
             # when enable_toggle goes high, we need to pulse enable,
-            # then copy value_sig into value.status.
+            # and copy value_sig into value.status while it's still the head.
             readout_fsm = FSM(reset_state="RESET")
             self.submodules += readout_fsm
             readout_fsm.act("RESET",
-                            NextValue(value.status, 0),
                             NextValue(enable_sig, 0),
                             NextState("WAIT")
                            )
 
             readout_fsm.act("WAIT",
-                            If(ack.storage == 1 and ready_sig == 1, # value to read and the prior value has been ack'ed
+                            If((ack.storage == 1) & (ready_sig == 1), # value to read and the prior value has been ack'ed
+                               event.trigger.eq(1),
+                               NextValue(value.status, value_sig),
                                NextValue(enable_sig, 1),
                                NextValue(ack.storage, 0),
                                NextState("RESET"),
                              )
                            )
 
-            self.sync += [value.status.eq(value_sig)]
-
             connections += [Instance.Output(f"{method_name}", value_sig),
                             Instance.Input(f"EN_{method_name}", enable_sig),
                             Instance.Output(f"RDY_{method_name}", ready_sig)]
 
+        if self.stream_methods:
+            connections = self._stream_ports(lane, connections, rst_n)
+
+        if self.perf_counters:
+            # submissions the module took less results it gave, through
+            # whichever path drives its EN ports; one result per submission
+            enables = {port.name: port.expr for port in connections if port.name.startswith("EN_")}
+            taken = [enables[f"EN_{m[3]}"] for m in self.interface.actionmethods]
+            given = [enables[f"EN_{m[2]}"] for m in self.interface.actionvaluemethods]
+            self.sync += If(~rst_n,
+                            outstanding.eq(0)
+                         ).Else(
+                            outstanding.eq(outstanding + sum(taken) - sum(given)))
+
         # Add the user module
-        self.specials += Instance("mkCollatzServer",
-                                  Instance.Input("CLK", ClockSignal()),
-                                  Instance.Input("RST_N", rst_n),
-                                  *connections)
+        if model is None:
+            self.specials += Instance(self.module,
+                                      Instance.Input("CLK", ClockSignal()),
+                                      Instance.Input("RST_N", rst_n),
+                                      *connections)
+        else:
+            setattr(self.submodules, f"{prefix}user", model)
+            self.comb += model.RST_N.eq(rst_n)
+            self.comb += [getattr(model, port.name).eq(port.expr) if isinstance(port, Instance.Input)
+                          else port.expr.eq(getattr(model, port.name))
+                          for port in connections]
 
-        for name, csr in csrs.items():
-            print(name, csr)
-            self.__setattr__(name, csr)
+    # DMA streaming: while stream_enable_csr is set, the stream method pair
+    # of every lane takes its arguments from `sink` (the pcie_dma0 reader)
+    # and hands its results to `source` (the writer) instead of its CSR
+    # adapter, one per cycle when the module is ready. Values are packed in
+    # stream_slot(width) bit slots, first value in the low bits - a
+    # little-endian array on the host - and dealt to the lanes round robin;
+    # results are collected in the same order, so they come out in order.
+    # With the bit clear the CSR adapters work as before, for single calls.
+    # A batch job (_add_job) drives the lanes the same way.
+
+    def _add_stream(self):
+        submit, get = self.stream_methods
+        arg_width, = [m[1] for m in self.interface.actionmethods if m[3] == submit]
+        result_width, = [m[1] for m in self.interface.actionvaluemethods if m[2] == get]
+        arg_slot, result_slot = stream_slot(arg_width), stream_slot(result_width)
+
+        # what feeds the lanes and takes their results: (active, arguments, results)
+        front_ends = []
+        if self.stream_dma:
+            self.stream_enable = CSRStorage(1, description=f"drive {submit}/{get} from the DMA streams",
+                                            name="stream_enable_csr")
+            self.csrs["stream_enable_csr"] = self.stream_enable
+
+            self.sink = stream.Endpoint([("data", self.stream_width)])
+            # width adaptation; the converters and the lane counters restart on reset
+            args = ResetInserter()(stream.Converter(self.stream_width, arg_slot))
+            results = ResetInserter()(stream.Converter(result_slot, self.stream_width))
+            self.submodules.stream_args = args
+            self.submodules.stream_results = results
+            self.comb += [self.sink.connect(args.sink),
+                          args.reset.eq(self.reset.storage),
+                          results.reset.eq(self.reset.storage)]
+            front_ends.append((self.stream_enable.storage, args.source, results.sink))
+        if self.job_ports:
+            job = self._add_job(arg_width, arg_slot, result_slot)
+            front_ends.append(job)
+
+        # the pcie_dma0 writer gets the streamed results, or a job's readback
+        if self.stream_dma or self.job_ports:
+            self.source = stream.Endpoint([("data", self.stream_width)])
+        if self.stream_dma and self.job_ports:
+            self.comb += If(self.job_readback_dma,
+                            self.job_readback.connect(self.source)
+                         ).Else(
+                            results.source.connect(self.source))
+        elif self.stream_dma:
+            self.comb += results.source.connect(self.source)
+        elif self.job_ports:
+            self.comb += self.job_readback.connect(self.source)
+
+        deal = stream.Endpoint([("data", arg_slot)])
+        collect = stream.Endpoint([("data", result_slot)])
+        self.stream_on = Signal()
+        self.comb += self.stream_on.eq(reduce(or_, [active for active, _, _ in front_ends]))
+        for active, arguments, results in front_ends:
+            self.comb += If(active, arguments.connect(deal), collect.connect(results))
+
+        self.stream_lanes = lanes = [(stream.Endpoint([("data", arg_slot)]), stream.Endpoint([("data", result_slot)]))
+                                     for _ in range(self.lanes)]
+        arg_lane = Signal(max=max(self.lanes, 2))
+        result_lane = Signal(max=max(self.lanes, 2))
+        for lane, (arg, result) in enumerate(lanes):
+            self.comb += [arg.valid.eq(deal.valid & (arg_lane == lane)),
+                          arg.data.eq(deal.data),
+                          result.ready.eq(collect.ready & (result_lane == lane))]
+        self.comb += [deal.ready.eq(Array(arg.ready for arg, _ in lanes)[arg_lane]),
+                      collect.valid.eq(Array(result.valid for _, result in lanes)[result_lane]),
+                      collect.data.eq(Array(result.data for _, result in lanes)[result_lane])]
+
+        def next_lane(lane, endpoint):
+            return If(self.reset.storage,
+                      lane.eq(0)
+                   ).Elif(endpoint.valid & endpoint.ready,
+                      If(lane == self.lanes - 1, lane.eq(0)).Else(lane.eq(lane + 1)))
+        self.sync += [next_lane(arg_lane, deal), next_lane(result_lane, collect)]
+
+    def _stream_ports(self, lane, connections, rst_n):
+        # put a lane's stream endpoints in front of its stream methods,
+        # muxed with the CSR adapter's ports on stream_enable
+        submit, get = self.stream_methods
+        arg_name, = [m[2] for m in self.interface.actionmethods if m[3] == submit]
+        arg, result = self.stream_lanes[lane]
+        on = self.stream_on
+        ports = {port.name: port for port in connections}
+
+        value, en, rdy = ports[f"{submit}_{arg_name}"], ports[f"EN_{submit}"], ports[f"RDY_{submit}"]
+        value_sig, en_sig, rdy_sig = Signal(len(value.expr)), Signal(), Signal()
+        self.comb += If(on,
+                        value_sig.eq(arg.data),
+                        en_sig.eq(arg.valid & rdy_sig & rst_n),
+                        arg.ready.eq(rdy_sig & rst_n)
+                     ).Else(
+                        value_sig.eq(value.expr),
+                        en_sig.eq(en.expr),
+                        rdy.expr.eq(rdy_sig))
+        replaced = {value.name: Instance.Input(value.name, value_sig),
+                    en.name: Instance.Input(en.name, en_sig),
+                    rdy.name: Instance.Output(rdy.name, rdy_sig)}
+
+        out, en, rdy = ports[get], ports[f"EN_{get}"], ports[f"RDY_{get}"]
+        en_sig, rdy_sig = Signal(), Signal()
+        self.comb += [result.data.eq(out.expr),
+                      If(on,
+                         result.valid.eq(rdy_sig & rst_n),
+                         en_sig.eq(result.ready & rdy_sig & rst_n)
+                      ).Else(
+                         en_sig.eq(en.expr),
+                         rdy.expr.eq(rdy_sig))]
+        replaced.update({en.name: Instance.Input(en.name, en_sig),
+                         rdy.name: Instance.Output(rdy.name, rdy_sig)})
+        return [replaced.get(port.name, port) for port in connections]
+
+    # batch jobs: the card runs the stream pair itself over start, start +
+    # stride, ... (count values) and writes the results to SDRAM from byte
+    # address base, packed as in the DMA stream but in port-width words, the
+    # last one padded with zeros. The host sets the job_* CSRs, writes 1 to
+    # job_control_csr, and waits for the done bit or the job event; then it
+    # reads job_readback_count_csr words back from job_readback_base_csr,
+    # one at a time through job_readback_data_csr (control 2, reading the
+    # lsw pops a word) or into the pcie_dma0 writer (control 4). The DMA
+    # stream has to stay disabled meanwhile. Writing reset aborts both.
+    # Returns the job's (active, arguments, results) for _add_stream.
+
+    def _add_job(self, arg_width, arg_slot, result_slot):
+        csrs = self.csrs
+        write, read = self.job_ports
+        dw = write.data_width
+        ratio = dw//result_slot
+        shift = log2_int(dw//8)
+
+        def csr(name, csr_type, width, description):
+            csrs[f"{name}_csr"] = c = csr_type(width, description=description, name=f"{name}_csr")
+            return c
+        start = csr("job_start", CSRStorage, arg_width, "job: first argument")
+        stride = csr("job_stride", CSRStorage, arg_width, "job: added to the argument for the next one")
+        count = csr("job_count", CSRStorage, 32, "job: arguments")
+        base = csr("job_base", CSRStorage, 32, f"job: SDRAM byte address of the results, {dw//8} byte aligned")
+        readback_base = csr("job_readback_base", CSRStorage, 32, "readback: SDRAM byte address")
+        readback_count = csr("job_readback_count", CSRStorage, 32, f"readback: {dw} bit words")
+        control = csr("job_control", CSRStorage, 3,
+                      "write 1 to start the job, 2 to read back through job_readback_data_csr, 4 into the DMA writer")
+        status = csr("job_status", CSRStatus, 4, "job busy (0), done (1), readback busy (2), readback word waiting (3)")
+        progress = csr("job_progress", CSRStatus, 32, "job: results collected")
+        readback_data = csr("job_readback_data", CSRStatus, dw, "readback: next word, pops when the lsw is read")
+
+        busy, done = Signal(), Signal()
+        launch = Signal()
+        self.comb += launch.eq(control.re & control.storage[0] & ~busy)
+
+        # the arguments
+        args = stream.Endpoint([("data", arg_slot)])
+        value = Signal(arg_width)
+        issued = Signal(32)
+        self.comb += [args.valid.eq(busy & (issued < count.storage)),
+                      args.data.eq(value)]
+        self.sync += If(args.valid & args.ready,
+                        value.eq(value + stride.storage),
+                        issued.eq(issued + 1))
+
+        # the results, and the padding of the last word
+        results = stream.Endpoint([("data", result_slot)])
+        words = Signal(32)
+        packed = Signal(32)
+        collected = Signal(32)
+        packer = ResetInserter()(stream.Converter(result_slot, dw))
+        self.submodules.job_packer = packer
+        self.comb += [words.eq((count.storage + ratio - 1) >> log2_int(ratio)),
+                      packer.reset.eq(self.reset.storage | launch),
+                      If(collected < count.storage,
+                         results.connect(packer.sink)
+                      ).Else(
+                         packer.sink.valid.eq(busy & (packed < (words << log2_int(ratio)))),
+                         packer.sink.data.eq(0)),
+                      progress.status.eq(collected)]
+        self.sync += [If(results.valid & results.ready, collected.eq(collected + 1)),
+                      If(packer.sink.valid & packer.sink.ready, packed.eq(packed + 1))]
+
+        # to SDRAM, a command then its data per word
+        address = Signal(write.address_width)
+        commanded = Signal()
+        written = Signal(32)
+        self.comb += [write.cmd.valid.eq(packer.source.valid & ~commanded),
+                      write.cmd.we.eq(1),
+                      write.cmd.addr.eq(address),
+                      write.wdata.valid.eq(packer.source.valid & commanded),
+                      write.wdata.data.eq(packer.source.data),
+                      write.wdata.we.eq(2**(dw//8) - 1),
+                      packer.source.ready.eq(write.wdata.ready & commanded)]
+        self.sync += [If(write.cmd.valid & write.cmd.ready, commanded.eq(1)),
+                      If(write.wdata.valid & write.wdata.ready,
+                         commanded.eq(0),
+                         address.eq(address + 1),
+                         written.eq(written + 1))]
+
+        self.job_finished = Signal()
+        self.comb += self.job_finished.eq(busy & (written == words))
+        self.sync += If(self.reset.storage,
+                        busy.eq(0),
+                        done.eq(0)
+                     ).Elif(launch,
+                        busy.eq(1),
+                        done.eq(0),
+                        value.eq(start.storage),
+                        issued.eq(0),
+                        packed.eq(0),
+                        collected.eq(0),
+                        address.eq(base.storage >> shift),
+                        commanded.eq(0),
+                        written.eq(0)
+                     ).Elif(self.job_finished,
+                        busy.eq(0),
+                        done.eq(1))
+
+        # readback: read commands go out as long as the FIFO has room for
+        # their data
+        depth = 8
+        fifo = ResetInserter()(SyncFIFO(dw, depth))
+        self.submodules.job_readback_fifo = fifo
+        unpack = ResetInserter()(stream.Converter(dw, self.stream_width))
+        self.submodules.job_readback_unpack = unpack
+        self.job_readback = unpack.source
+        reading, to_dma = Signal(), Signal()
+        requested = Signal(32)
+        in_flight = Signal(max=depth + 1)
+        read_address = Signal(read.address_width)
+        read_launch = Signal()
+        self.comb += [read_launch.eq(control.re & (control.storage[1] | control.storage[2]) & ~reading),
+                      fifo.reset.eq(self.reset.storage | read_launch),
+                      unpack.reset.eq(self.reset.storage | read_launch),
+                      read.cmd.valid.eq(reading & (requested < readback_count.storage) &
+                                        (fifo.level + in_flight < depth)),
+                      read.cmd.we.eq(0),
+                      read.cmd.addr.eq(read_address),
+                      read.rdata.ready.eq(1),
+                      fifo.we.eq(read.rdata.valid),
+                      fifo.din.eq(read.rdata.data),
+                      readback_data.status.eq(fifo.dout),
+                      unpack.sink.valid.eq(fifo.readable & to_dma),
+                      unpack.sink.data.eq(fifo.dout),
+                      If(to_dma, fifo.re.eq(unpack.sink.ready)).Else(fifo.re.eq(readback_data.we))]
+        self.sync += [If(read.cmd.valid & read.cmd.ready,
+                         requested.eq(requested + 1),
+                         read_address.eq(read_address + 1)),
+                      in_flight.eq(in_flight + (read.cmd.valid & read.cmd.ready) - (read.rdata.valid & read.rdata.ready))]
+        self.sync += If(self.reset.storage,
+                        reading.eq(0)
+                     ).Elif(read_launch,
+                        reading.eq(1),
+                        to_dma.eq(control.storage[2]),
+                        requested.eq(0),
+                        in_flight.eq(0),
+                        read_address.eq(readback_base.storage >> shift)
+                     ).Elif(reading & (requested == readback_count.storage) & (in_flight == 0) & ~fifo.readable,
+                        reading.eq(0))
+        # the DMA writer takes the readback only while there is one
+        self.job_readback_dma = Signal()
+        self.comb += [self.job_readback_dma.eq(reading & to_dma),
+                      status.status.eq(Cat(busy, done, reading, fifo.readable & ~to_dma))]
+
+        return busy, args, results
+
+    # read-to-pop register of an actionvalue method: the valid bit in the
+    # msb, the value in the low bits, and reading the last word (the lsw,
+    # litex puts the msw first) while valid takes the value, as writing ack
+    # would. A poll that finds nothing is a single read of the first word,
+    # and a value under 32 bits comes out, valid bit and all, in one read.
+    #
+    # With pop=<bits> (at most 30) the register is one word whatever the
+    # method's width: the low bits of the value, and bit 30 set if it
+    # doesn't fit in them. Such a value is not taken by the read; the host
+    # gets it through value and ack instead. Worth it when results are
+    # usually small, like collatz step counts.
+    # Returns the take strobe.
+
+    def _add_pop(self, name, width, valid, value):
+        bits = width if self.pop is True else min(self.pop, width)
+        taken = Signal()
+        if bits < width:
+            assert bits <= 30, "narrow pop registers hold at most 30 bits"
+            pop = CSRStatus(32, description=f"output {name} valid (31), too wide (30) and low {bits} bits, pops on read",
+                            name=f"{name}_pop_csr")
+            wide = Signal()
+            self.comb += [wide.eq(value[bits:] != 0),
+                          pop.status[:bits].eq(value[:bits]),
+                          pop.status[30].eq(wide),
+                          pop.status[31].eq(valid),
+                          taken.eq(pop.we & valid & ~wide)]
+        else:
+            words = (width + 1 + 31)//32
+            pop = CSRStatus(32*words, description=f"output {name} valid (msb) and value, pops on read",
+                            name=f"{name}_pop_csr")
+            self.comb += [pop.status[:width].eq(value),
+                          pop.status[-1].eq(valid),
+                          taken.eq(pop.we & valid)]
+        self.csrs[f"{name}_pop_csr"] = pop
+        return taken
+
+    # performance counters, when enabled. Each method counts, in cycles:
+    #   calls     EN, i.e. values handed to or results taken from the module
+    #   stall     the adapter could call the method but RDY is low; for an
+    #             actionvalue method only while a call is in the module
+    #   hostwait  waiting on the host: RDY high and nothing submitted, or a
+    #             result not yet ack'ed
+    #   busy      action: a submission is held in the adapter. actionvalue:
+    #             a call is in the module and its result isn't RDY yet
+    # Calls in the module are the lane's submissions taken less its results
+    # taken, i.e. one result per submission as map() assumes too.
+    # and perf_cycles counts every cycle. The counters run freely; the CSRs
+    # show them as of the last snapshot.
+
+    def _add_perf(self, name, **conditions):
+        if not self.perf_counters:
+            return
+        for counter, condition in conditions.items():
+            live = Signal(64)
+            csr = CSRStatus(64, description=f"{name} {counter} cycles at the last snapshot",
+                            name=f"{name}_{counter}_csr")
+            self.csrs[f"{name}_{counter}_csr"] = csr
+            self.sync += [If(self.perf_clear, live.eq(0)).Elif(condition, live.eq(live + 1)),
+                          If(self.perf_snapshot, csr.status.eq(live))]
+
+    # queued adapter: instead of one held value per method there is a
+    # queue_depth FIFO in front of each action method and behind each
+    # actionvalue method. The host pushes by writing the value CSR and pops
+    # by writing the ack CSR, going by the credits/level CSRs instead of a
+    # handshake per value, and the user module is called whenever its FIFO
+    # allows, one value per cycle. The FIFOs are flushed when the host
+    # writes reset.
+
+    def _add_queued_action(self, name, width, arg_name, method_name, rst_n):
+        csrs, signals, ev = self.csrs, self.signals, self.ev
+        depth = self.queue_depth
+
+        # pushed when the last word is written
+        value = CSRStorage(width,
+                           description=f"input {name} {arg_name} value CSR, queued on write",
+                           name=f"{name}_{arg_name}_value_csr")
+        csrs[f"{name}_{arg_name}_value_csr"] = value
+        credits = CSRStatus(bits_for(depth),
+                            description=f"input {name} free queue entries",
+                            name=f"{name}_credits_csr")
+        csrs[f"{name}_credits_csr"] = credits
+        status = CSRStatus(5, description=f"input {name} internal status CSR",
+                           name=f"{name}_status_csr")
+        csrs[f"{name}_status_csr"] = status
+
+        queue = ResetInserter()(SyncFIFO(width, depth))
+        setattr(self.submodules, f"{name}_queue", queue)
+
+        enable_sig = Signal(1)
+        ready_to_write = Signal(1)
+        signals[f"{name}_enable_edge"] = enable_sig
+        signals[f"{name}_ready_to_write"] = ready_to_write
+        signals[f"{name}_value_sig"] = queue.dout
+
+        event = EventSourcePulse(name=name, description=f"{name} submission accepted")
+        setattr(ev, name, event)
+
+        self.comb += [queue.reset.eq(self.reset.storage),
+                      queue.din.eq(value.storage),
+                      queue.we.eq(value.re),
+                      credits.status.eq(depth - queue.level),
+                      # call the method straight from the head of the queue
+                      enable_sig.eq(queue.readable & ready_to_write & rst_n),
+                      queue.re.eq(enable_sig),
+                      event.trigger.eq(enable_sig),
+
+                      status.status[0].eq(enable_sig),
+                      status.status[1].eq(ready_to_write),
+                      status.status[2].eq(queue.dout),
+                      status.status[3].eq(rst_n),
+                      status.status[4].eq(queue.readable)] # submissions pending
+
+        self._add_perf(name,
+                       calls=enable_sig,
+                       stall=queue.readable & ~ready_to_write,
+                       hostwait=~queue.readable & ready_to_write,
+                       busy=queue.readable)
+
+        return [Instance.Input(f"{method_name}_{arg_name}", queue.dout),
+                Instance.Input(f"EN_{method_name}", enable_sig),
+                Instance.Output(f"RDY_{method_name}", ready_to_write)]
+
+    def _add_queued_actionvalue(self, name, width, method_name, rst_n, outstanding):
+        csrs, signals, ev = self.csrs, self.signals, self.ev
+        depth = self.queue_depth
+
+        # head of the queue
+        value = CSRStatus(width,
+                          description=f"output {name} value CSR",
+                          name=f"{name}_value_csr")
+        csrs[f"{name}_value_csr"] = value
+        ack = CSRStorage(1,
+                         description=f"output {name} ack CSR, pops the queue on write",
+                         name=f"{name}_ack_csr")
+        csrs[f"{name}_ack_csr"] = ack
+        level = CSRStatus(bits_for(depth),
+                          description=f"output {name} queued results",
+                          name=f"{name}_level_csr")
+        csrs[f"{name}_level_csr"] = level
+        status = CSRStatus(5,
+                           description=f"output {name} status CSR",
+                           name=f"{name}_status_csr")
+        csrs[f"{name}_status_csr"] = status
+
+        queue = ResetInserter()(SyncFIFO(width, depth))
+        setattr(self.submodules, f"{name}_queue", queue)
+        popped = self._add_pop(name, width, queue.readable, queue.dout) if self.pop else 0
+
+        value_sig = Signal(width)
+        ready_sig = Signal(1)
+        enable_sig = Signal(1)
+        signals[f"{name}_value_sig"] = value_sig
+        signals[f"{name}_enable_edge"] = enable_sig
+        signals[f"{name}_ready_to_read"] = ready_sig
+
+        event = EventSourcePulse(name=name, description=f"{name} result valid")
+        setattr(ev, name, event)
+
+        self.comb += [queue.reset.eq(self.reset.storage),
+                      # take a result whenever there is room for it
+                      enable_sig.eq(ready_sig & queue.writable & rst_n),
+                      queue.din.eq(value_sig),
+                      queue.we.eq(enable_sig),
+                      event.trigger.eq(enable_sig),
+                      value.status.eq(queue.dout),
+                      queue.re.eq(ack.re | popped),
+                      level.status.eq(queue.level),
+
+                      status.status[0].eq(ready_sig),
+                      status.status[1].eq(enable_sig),
+                      status.status[3].eq(rst_n),
+                      status.status[4].eq(queue.readable)] # result waiting for the host
+
+        self._add_perf(name,
+                       calls=enable_sig,
+                       stall=(outstanding != 0) & queue.writable & ~ready_sig,
+                       hostwait=queue.readable,
+                       busy=(outstanding != 0) & ~ready_sig)
+
+        return [Instance.Output(f"{method_name}", value_sig),
+                Instance.Input(f"EN_{method_name}", enable_sig),
+                Instance.Output(f"RDY_{method_name}", ready_sig)]
 
     def _init_REPL(self):
-        for type, width, arg_name, method_name, in self.interface.actionmethods:
-            fn = partial(self._action_call, modname="bsREPL", methodname=method_name)
-            self.__setattr__(method_name, fn)
+        regs = self._comm.regs
+        type, width, arg_name, first = self.interface.actionmethods[0]
+        if self.lanes is None:
+            # lane<i>_ prefixed registers mean a multi-lane adapter
+            lanes = 0
+            while hasattr(regs, f"{self.modname}_lane{lanes}_{first}_{arg_name}_value_csr"):
+                lanes += 1
+            self.lanes = max(lanes, 1)
+        if self.queue_depth is None:
+            # credits registers mean a queued adapter. Without the SoC
+            # constant, the credits of an idle adapter are the depth.
+            credits = getattr(regs, f"{self.modname}_{self._lane_prefix(0)}{first}_credits_csr", None)
+            if credits is None:
+                self.queue_depth = 0
+            else:
+                self.queue_depth = getattr(self._comm.constants, "bsrepl_queue_depth", None) or credits.read()
+        self.perf_counters = hasattr(regs, f"{self.modname}_perf_control_csr")
+        # read-to-pop registers on the actionvalue methods, see _pop_reader
+        get = self.interface.actionvaluemethods[0][2]
+        self.pop = hasattr(regs, f"{self.modname}_{self._lane_prefix(0)}{get}_pop_csr")
+        # built with DMA streaming of stream_methods, see stream()
+        self.streaming = hasattr(regs, f"{self.modname}_stream_enable_csr")
+        # built with batch jobs over them, see job.py
+        self.jobs = hasattr(regs, f"{self.modname}_job_control_csr")
+        if self.queue_depth:
+            # the queues replace the adapter's holding registers
+            self.pipeline_depth = 2 + 2 + 1 + 2*self.queue_depth
+            call, call_many = self._queued_call, self._queued_call_many
+            value_return, value_return_many = self._queued_value_return, self._queued_value_return_many
+        else:
+            call, call_many = self._action_call, self._action_call_many
+            value_return, value_return_many = self._action_value_return, self._action_value_return_many
+        if self.pop:
+            value_return, value_return_many = self._pop_value_return, self._pop_value_return_many
 
-        for type, width, method_name in self.interface.actionvaluemethods:
-            fn = partial(self._action_value_return, modname="bsREPL", methodname=method_name)
-            self.__setattr__(method_name, fn)
+        self._arg_names = {}
+        self._pops = {}
+        # event bit of each method, same order as _init_HDL creates them
+        self._events = {}
+        for lane in range(self.lanes):
+            prefix = self._lane_prefix(lane)
+            for type, width, arg_name, method_name, in self.interface.actionmethods:
+                name = f"{prefix}{method_name}"
+                self._arg_names[name] = arg_name
+                self._events[name] = len(self._events)
+                fn = partial(call, modname=self.modname, methodname=name)
+                self.__setattr__(name, fn)
+                fn = partial(call_many, modname=self.modname, methodname=name)
+                self.__setattr__(f"{name}_many", fn)
+
+            for type, width, method_name in self.interface.actionvaluemethods:
+                name = f"{prefix}{method_name}"
+                self._events[name] = len(self._events)
+                if self.pop:
+                    self._pops[name] = self._pop_reader(self.modname, name, width)
+                fn = partial(value_return, modname=self.modname, methodname=name)
+                self.__setattr__(name, fn)
+                fn = partial(value_return_many, modname=self.modname, methodname=name)
+                self.__setattr__(f"{name}_many", fn)
+
+        # the job event comes after all of the methods'
+        self._job_event = len(self._events) if self.jobs else None
+
+        if self.lanes > 1:
+            # the plain method names call lane 0
+            for method_name in self._method_names():
+                self.__setattr__(method_name, getattr(self, f"lane0_{method_name}"))
+                self.__setattr__(f"{method_name}_many", getattr(self, f"lane0_{method_name}_many"))
+
+        if self._stubs:
+            # the single calls as straight-line register accesses
+            stubs = stubgen.bind(self._comm, self.interface, self.modname, self.lanes, self.queue_depth,
+                                 self.timeout, self._expired)
+            for name in self._events:
+                self.__setattr__(name, getattr(stubs, name))
+            if self.lanes > 1:
+                for method_name in self._method_names():
+                    self.__setattr__(method_name, getattr(stubs, method_name))
+
+        self._memos = {}
+        if self._pure:
+            self._init_memo()
+
+        prof = profiler.from_env()
+        if prof is not None:
+            prof.instrument_repl(self)
+
+    def _ident(self):
+        from device import read_ident
+        return read_ident(self._comm) if hasattr(self._comm.bases, "identifier_mem") else ""
+
+    def _init_memo(self):
+        pairs = self._pure
+        if pairs is True:
+            pairs = [(self.interface.actionmethods[0][3], self.interface.actionvaluemethods[0][2])]
+        # a saved cache only counts for the bitstream it was filled from
+        self._memo_ident = self._ident()
+        saved = memo.load(self.memo_path, self._memo_ident) if self.memo_path else {}
+        for submit, get in pairs:
+            self._memos[(submit, get)] = memo.Memo(self.memo_size, saved.get(f"{submit}/{get}", ()))
+        if self.memo_path:
+            _memo_repls.add(self)
+        # a hot reset may come back with another bitstream
+        self.on_recover.append(lambda error: self._check_memo_ident())
+
+    def _check_memo_ident(self):
+        # a reprogrammed card makes the cached results suspect: drop them
+        ident = self._ident()
+        if ident != self._memo_ident:
+            for cache in self._memos.values():
+                cache.clear()
+            self._memo_ident = ident
+        return ident
+
+    def _memo_snapshot(self):
+        ident = self._check_memo_ident()
+        return ident, {f"{submit}/{get}": cache for (submit, get), cache in self._memos.items()}
+
+    def save_memo(self):
+        memo.save(self.memo_path, *self._memo_snapshot())
+
+    def memo_stats(self):
+        return {f"{submit}/{get}": cache.stats() for (submit, get), cache in self._memos.items()}
+
+    def call(self, submit, get, value):
+        # one submit/get round trip, answered from the cache for a pure pair
+        cache = self._memos.get((submit, get))
+        if cache is not None:
+            result = cache.lookup(value, memo._MISS)
+            if result is not memo._MISS:
+                return result
+        # the plain names of a multi-lane adapter are lane 0's
+        arg_name = self._arg_names.get(submit) or self._arg_names[f"{self._lane_prefix(0)}{submit}"]
+        getattr(self, submit)(**{arg_name: value})
+        result = getattr(self, get)()
+        if cache is not None:
+            cache.store(value, result)
+            cache.computed += 1
+        return result
+
+    def _method_names(self):
+        return ([m[3] for m in self.interface.actionmethods] +
+                [m[2] for m in self.interface.actionvaluemethods])
 
     def _action_call(self, modname, methodname, **kwargs):
         module = self._comm.regs
@@ -197,28 +1001,522 @@ class bsREPL(Module):
         value_regs = {k : getattr(module, f"{modname}_{methodname}_{k}_value_csr")
                       for k in kwargs.keys()}
 
-        while trigger.read() != 0:
-            # make sure any prior submission is accepted
-            pass
+        accepted = lambda: trigger.read() == 0
+
+        # make sure any prior submission is accepted
+        self._wait(accepted, methodname)
 
         for k, v in kwargs.items():
             value_regs[k].write(v)
         trigger.write(1)
 
-        while trigger.read() == 1:
-            # wait for ack
-            pass
+        # wait for ack
+        self._wait(accepted, methodname)
 
     def _action_value_return(self, modname, methodname):
         module = self._comm.regs
         ack = getattr(module, f"{modname}_{methodname}_ack_csr")
         value = getattr(module, f"{modname}_{methodname}_value_csr")
-        while ack.read() == 1: # wait for a valid, new value
-            pass
+        # wait for a valid, new value
+        self._wait(lambda: ack.read() == 0, methodname)
         v = value.read()
         ack.write(1) # advance the FIFO
         return v
 
+    def _action_call_many(self, values, modname, methodname):
+        # submit a value per call without waiting for each one to be accepted;
+        # we only wait for the prior submission before overwriting the value CSR.
+        # the user module has to be drained with _many/map once its queues are full.
+        module = self._comm.regs
+        trigger = getattr(module, f"{modname}_{methodname}_trigger_csr")
+        arg_name = self._arg_names[methodname]
+        value = getattr(module, f"{modname}_{methodname}_{arg_name}_value_csr")
+        deadline = Deadline(self.timeout)
+        for v in values:
+            while trigger.read() != 0:
+                if deadline.expired():
+                    self._expired(methodname)
+            value.write(v)
+            trigger.write(1)
+            deadline.restart()
+
+    def _action_value_return_many(self, n, modname, methodname):
+        module = self._comm.regs
+        ack = getattr(module, f"{modname}_{methodname}_ack_csr")
+        value = getattr(module, f"{modname}_{methodname}_value_csr")
+        results = []
+        deadline = Deadline(self.timeout)
+        for _ in range(n):
+            while ack.read() == 1:
+                if deadline.expired():
+                    self._expired(methodname)
+            results.append(value.read())
+            ack.write(1)
+            deadline.restart()
+        return results
+
+    def _queued_call(self, modname, methodname, **kwargs):
+        # returns once the value is queued, not when the method takes it
+        module = self._comm.regs
+        credits = getattr(module, f"{modname}_{methodname}_credits_csr")
+        self._wait(lambda: credits.read() > 0, methodname)
+        for k, v in kwargs.items():
+            getattr(module, f"{modname}_{methodname}_{k}_value_csr").write(v)
+
+    def _queued_value_return(self, modname, methodname):
+        module = self._comm.regs
+        level = getattr(module, f"{modname}_{methodname}_level_csr")
+        value = getattr(module, f"{modname}_{methodname}_value_csr")
+        ack = getattr(module, f"{modname}_{methodname}_ack_csr")
+        self._wait(lambda: level.read() > 0, methodname)
+        v = value.read()
+        ack.write(1) # pop
+        return v
+
+    def _queued_call_many(self, values, modname, methodname):
+        # one credits read per burst of posted value writes
+        module = self._comm.regs
+        credits = getattr(module, f"{modname}_{methodname}_credits_csr")
+        arg_name = self._arg_names[methodname]
+        value = getattr(module, f"{modname}_{methodname}_{arg_name}_value_csr")
+        values = iter(values)
+        v = next(values, _END)
+        deadline = Deadline(self.timeout)
+        while v is not _END:
+            n = credits.read()
+            if n:
+                deadline.restart()
+            elif deadline.expired():
+                self._expired(methodname)
+            while n and v is not _END:
+                value.write(v)
+                n -= 1
+                v = next(values, _END)
+
+    def _queued_value_return_many(self, n, modname, methodname):
+        # one level read per burst of results
+        module = self._comm.regs
+        level = getattr(module, f"{modname}_{methodname}_level_csr")
+        value = getattr(module, f"{modname}_{methodname}_value_csr")
+        ack = getattr(module, f"{modname}_{methodname}_ack_csr")
+        results = []
+        deadline = Deadline(self.timeout)
+        while len(results) < n:
+            ready = min(level.read(), n - len(results))
+            if ready:
+                deadline.restart()
+            elif deadline.expired():
+                self._expired(methodname)
+            for _ in range(ready):
+                results.append(value.read())
+                ack.write(1)
+        return results
+
+    def _pop_reader(self, modname, methodname, width):
+        # a function polling methodname's pop register once: the value,
+        # taken, or None. The first word holds the valid bit; the rest are
+        # only read when it's set, the last of them taking the value.
+        module = self._comm.regs
+        reg = getattr(module, f"{modname}_{methodname}_pop_csr")
+        addr, length, read = reg.addr, reg.length, self._comm.read
+        valid, mask = 1 << 31, 2**width - 1
+        if width + 1 > 32*length:
+            # narrow: a value too wide for it is left for value/ack
+            wide = 1 << 30
+            value, ack = (getattr(module, f"{modname}_{methodname}_{csr}_csr") for csr in ["value", "ack"])
+            def pop():
+                v = read(addr)
+                if not v & valid:
+                    return None
+                if v & wide:
+                    v = value.read()
+                    ack.write(1)
+                    return v
+                return v & (wide - 1)
+        elif length == 1:
+            def pop():
+                v = read(addr)
+                return v & mask if v & valid else None
+        else:
+            def pop():
+                v = read(addr)
+                if not v & valid:
+                    return None
+                for word in read(addr + 4, length - 1):
+                    v = (v << 32) | word
+                return v & mask
+        return pop
+
+    def _pop_value_return(self, modname, methodname):
+        pop = self._pops[methodname]
+        value = []
+        def ready():
+            v = pop()
+            if v is not None:
+                value.append(v)
+            return v is not None
+        self._wait(ready, methodname)
+        return value[0]
+
+    def _pop_value_return_many(self, n, modname, methodname):
+        pop = self._pops[methodname]
+        results = []
+        deadline = Deadline(self.timeout)
+        while len(results) < n:
+            v = pop()
+            if v is not None:
+                results.append(v)
+                deadline.restart()
+            elif deadline.expired():
+                self._expired(methodname)
+        return results
+
+    def map(self, submit, get, values, depth=None, modname=None):
+        # call submit for every value and collect get's results, in order.
+        # up to depth calls per lane are kept in flight: instead of spinning
+        # on a single handshake we submit whenever a lane can take a value,
+        # and read out whenever a result is waiting, so the PCIe round trips
+        # overlap with each other and with the computation.
+        #
+        # each value goes to the lane with the fewest calls in flight. A
+        # lane returns its results in submission order, so a queue of result
+        # slots per lane is enough to put them back in input order.
+        depth = self.pipeline_depth if depth is None else depth
+        modname = self.modname if modname is None else modname
+        cache = self._memos.get((submit, get))
+        if cache is not None:
+            # only the distinct values not cached go to the card
+            values = values.tolist() if isinstance(values, np.ndarray) else values
+            return cache.map(values, lambda misses: self._map(submit, get, misses, depth, modname))
+        return self._map(submit, get, values, depth, modname)
+
+    def _map(self, submit, get, values, depth, modname):
+        if self.queue_depth:
+            return self._map_queued(submit, get, values, depth, modname)
+        module = self._comm.regs
+        lanes = []
+        for lane in range(self.lanes):
+            prefix = self._lane_prefix(lane)
+            arg_name = self._arg_names[f"{prefix}{submit}"]
+            lanes.append((getattr(module, f"{modname}_{prefix}{submit}_trigger_csr"),
+                          getattr(module, f"{modname}_{prefix}{submit}_{arg_name}_value_csr"),
+                          getattr(module, f"{modname}_{prefix}{get}_ack_csr"),
+                          getattr(module, f"{modname}_{prefix}{get}_value_csr")))
+
+        pops = [self._pops[f"{self._lane_prefix(lane)}{get}"] for lane in range(self.lanes)] if self.pop else None
+        results = []
+        slots = [deque() for _ in lanes]  # result slots of the calls in flight, per lane
+        armed = [False for _ in lanes]    # trigger written and not yet seen back at 0
+        values = iter(values)
+        pending = next(values, _END)
+        in_flight = 0
+        deadline = Deadline(self.timeout) # restarted on every submission and result
+        while pending is not _END or in_flight:
+            if pending is not _END:
+                lane = min(range(len(lanes)), key=lambda l: len(slots[l]))
+                trigger, value_in, _, _ = lanes[lane]
+                if len(slots[lane]) < depth and (not armed[lane] or trigger.read() == 0):
+                    value_in.write(pending)
+                    trigger.write(1)
+                    armed[lane] = True
+                    slots[lane].append(len(results))
+                    results.append(None)
+                    in_flight += 1
+                    pending = next(values, _END)
+                    deadline.restart()
+                    continue
+            done = in_flight
+            for lane, (_, _, ack, value_out) in enumerate(lanes):
+                if not slots[lane]:
+                    continue
+                if pops:
+                    # one read polls and takes the result
+                    v = pops[lane]()
+                    if v is not None:
+                        results[slots[lane].popleft()] = v
+                        in_flight -= 1
+                elif ack.read() == 0:
+                    results[slots[lane].popleft()] = value_out.read()
+                    ack.write(1)
+                    in_flight -= 1
+            if in_flight != done:
+                deadline.restart()
+            elif deadline.expired():
+                self._expired(*self._pair_names(submit, get))
+        return results
+
+    def _map_queued(self, submit, get, values, depth, modname):
+        # map for the queued adapter: the same lane choice and result slots,
+        # but the credits and level CSRs are only read once the counts from
+        # the last read are used up, so most values and results cost a
+        # single posted write or a read and a write.
+        module = self._comm.regs
+        lanes = []
+        for lane in range(self.lanes):
+            prefix = self._lane_prefix(lane)
+            arg_name = self._arg_names[f"{prefix}{submit}"]
+            lanes.append((getattr(module, f"{modname}_{prefix}{submit}_credits_csr"),
+                          getattr(module, f"{modname}_{prefix}{submit}_{arg_name}_value_csr"),
+                          getattr(module, f"{modname}_{prefix}{get}_level_csr"),
+                          getattr(module, f"{modname}_{prefix}{get}_ack_csr"),
+                          getattr(module, f"{modname}_{prefix}{get}_value_csr")))
+
+        pops = [self._pops[f"{self._lane_prefix(lane)}{get}"] for lane in range(self.lanes)] if self.pop else None
+        results = []
+        slots = [deque() for _ in lanes]
+        credits = [0 for _ in lanes] # free input entries, as of the last read
+        levels = [0 for _ in lanes]  # queued results, as of the last read
+        values = iter(values)
+        pending = next(values, _END)
+        in_flight = 0
+        deadline = Deadline(self.timeout)
+        while pending is not _END or in_flight:
+            if pending is not _END:
+                lane = min(range(len(lanes)), key=lambda l: len(slots[l]))
+                credits_csr, value_in, _, _, _ = lanes[lane]
+                if len(slots[lane]) < depth and not credits[lane]:
+                    credits[lane] = credits_csr.read()
+                if len(slots[lane]) < depth and credits[lane]:
+                    value_in.write(pending)
+                    credits[lane] -= 1
+                    slots[lane].append(len(results))
+                    results.append(None)
+                    in_flight += 1
+                    pending = next(values, _END)
+                    deadline.restart()
+                    continue
+            done = in_flight
+            for lane, (_, _, level, ack, value_out) in enumerate(lanes):
+                if slots[lane] and not levels[lane]:
+                    levels[lane] = level.read()
+                while slots[lane] and levels[lane]:
+                    if pops:
+                        results[slots[lane].popleft()] = pops[lane]()
+                    else:
+                        results[slots[lane].popleft()] = value_out.read()
+                        ack.write(1)
+                    levels[lane] -= 1
+                    in_flight -= 1
+            if in_flight != done:
+                deadline.restart()
+            elif deadline.expired():
+                self._expired(*self._pair_names(submit, get))
+        return results
+
+    def stream(self, values, submit=None, get=None):
+        # call submit for every value of an array and return get's results
+        # as an array, moving both over DMA instead of CSRs. The adapter
+        # has to be built with stream (for this method pair) and the repl
+        # given a dma.DMA.
+        #
+        # The DMA moves whole buffers, so the values are padded to whole
+        # buffers each way with copies of the last one, a value submit is
+        # known to take. The reader runs on past the end into stale buffers
+        # and the user module with it, so the adapter is reset afterwards:
+        # anything in flight in it is dropped.
+        submit, get = self.stream_methods if submit is None else (submit, get)
+        assert self.streaming and (submit, get) == self.stream_methods, f"adapter doesn't stream {submit}/{get}"
+        assert self.dma is not None, "stream needs a dma.DMA"
+        (type, width), = [m[:2] for m in self.interface.actionmethods if m[3] == submit]
+        arg_dtype = stream_dtype(type, width)
+        (type, width), = [m[:2] for m in self.interface.actionvaluemethods if m[2] == get]
+        result_dtype = stream_dtype(type, width)
+        values = np.asarray(values, dtype=arg_dtype).reshape(-1)
+
+        cache = self._memos.get((submit, get))
+        if cache is not None:
+            # cached the way map returns them, unsigned
+            raw = np.dtype(result_dtype.str.replace("i", "u"))
+            results = cache.map(values.tolist(),
+                                lambda misses: self._stream(np.array(misses, dtype=arg_dtype), result_dtype).view(raw).tolist())
+            return np.array(results, dtype=raw).view(result_dtype)
+        return self._stream(values, result_dtype)
+
+    def _stream(self, values, result_dtype):
+        arg_dtype = values.dtype
+        n = values.size
+        if not n:
+            return np.empty(0, dtype=result_dtype)
+        dma = self.dma
+        step = np.lcm(dma.buffer_size//arg_dtype.itemsize, dma.buffer_size//result_dtype.itemsize)
+        total = -(-n//step)*step
+        args = np.empty(total, dtype=arg_dtype)
+        args[:n] = values
+        args[n:] = args[n - 1]
+        results = np.empty(total, dtype=result_dtype)
+
+        module = self._comm.regs
+        enable = getattr(module, f"{self.modname}_stream_enable_csr")
+        underflows = dma.underflows
+        dma.loopback(False)
+        enable.write(1)
+        try:
+            dma.start()
+            dma.exchange(args, results)
+        finally:
+            dma.stop()
+            enable.write(0)
+            getattr(module, f"{self.modname}_reset").write(1)
+        if dma.underflows != underflows:
+            raise RuntimeError("DMA reader ran ahead of the host, results are out of order")
+        return results[:n]
+
+    # deadlines and recovery. With a timeout, a call that sees no progress
+    # on the card for that long diagnoses the methods involved from their
+    # status registers, recovers the adapter (unless recover=False) and
+    # raises CallTimeout with both. The checks are a clock read per poll of
+    # a not-yet-ready register, none on a call that doesn't have to wait.
+
+    def _wait(self, ready, methodname):
+        try:
+            self._waiter.wait(ready, self._events[methodname])
+        except CallTimeout as e:
+            if e.method is not None:
+                raise
+            self._expired(methodname)
+
+    def _pair_names(self, submit, get):
+        return [f"{self._lane_prefix(lane)}{name}" for lane in range(self.lanes) for name in (submit, get)]
+
+    def _expired(self, *names):
+        diagnosis = self.diagnose(*names)
+        error = CallTimeout(f"{'/'.join(names)}: no progress in {self.timeout}s", method=names[0], diagnosis=diagnosis)
+        if self.auto_recover:
+            error.recovery = self.recover(error)
+        details = "; ".join(f"{name}: {text}" for name, text in diagnosis.items()) or "all methods look idle"
+        outcome = "" if not self.auto_recover else f", recovered by {error.recovery}" if error.recovery else ", recovery failed"
+        error.args = (f"{error.args[0]} ({details}){outcome}",)
+        raise error
+
+    def diagnose(self, *names):
+        # what the *_status_csr bits say about the named methods (default
+        # all of them): {name: problem} for the ones that aren't idle.
+        #   action       bit 1 RDY, bit 3 rst_n, bit 4 submission pending
+        #   actionvalue  bit 0 RDY, bit 3 rst_n, bit 4 result waiting
+        regs = self._comm.regs
+        report = {}
+        for name in names or self._events:
+            status = getattr(regs, f"{self.modname}_{name}_status_csr").read()
+            problems = []
+            if not status & 1 << 3:
+                problems.append("held in reset (rst_n low)")
+            if name in self._arg_names:
+                if status & 1 << 4 and not status & 1 << 1:
+                    problems.append("submission pending with RDY low: the module is wedged or its results aren't drained")
+                elif status & 1 << 4:
+                    problems.append("submission pending")
+            elif status & 1 << 4:
+                problems.append("result waiting for the host")
+            elif not status & 1:
+                problems.append("no result (RDY low)")
+            if problems:
+                report[name] = ", ".join(problems)
+        return report
+
+    def _idle(self, polls=64):
+        # out of reset, every action method ready and nothing pending or
+        # waiting anywhere. rst_n takes 16 cycles to come back, so the
+        # first status is polled for it a little.
+        regs = self._comm.regs
+        statuses = [getattr(regs, f"{self.modname}_{name}_status_csr") for name in self._events]
+        for _ in range(polls):
+            if statuses[0].read() & 1 << 3:
+                break
+        for name, status in zip(self._events, statuses):
+            s = status.read()
+            if not s & 1 << 3 or s & 1 << 4:
+                return False
+            if name in self._arg_names and not s & 1 << 1:
+                return False
+        return True
+
+    def _reset_adapter(self):
+        # the 16 cycle reset pulse flushes the user module, and the queues
+        # of a queued adapter. The handshake adapter's registers survive
+        # it, so a submission not taken yet is withdrawn first and a held
+        # result dropped after.
+        regs = self._comm.regs
+        if self.streaming:
+            getattr(regs, f"{self.modname}_stream_enable_csr").write(0)
+        if not self.queue_depth:
+            for name in self._arg_names:
+                getattr(regs, f"{self.modname}_{name}_trigger_csr").write(0)
+        getattr(regs, f"{self.modname}_reset").write(1)
+        if not self.queue_depth:
+            for name in self._events:
+                if name not in self._arg_names:
+                    getattr(regs, f"{self.modname}_{name}_ack_csr").write(1)
+
+    def _resync(self, error):
+        # whatever the host kept about calls in the adapter is gone with them
+        for callback in self.on_recover:
+            callback(error)
+
+    def _hot_reset(self):
+        # hot_reset.sh on the card's PCIe port, then map BAR0 again. The
+        # card drops off the bus meanwhile, for every user of it.
+        bar = getattr(self._comm, "bar", None) or ""
+        if not bar.startswith("/sys/bus/pci/devices/"):
+            return False
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hot_reset.sh")
+        if subprocess.run(["sudo", script, os.path.basename(os.path.dirname(bar))]).returncode:
+            return False
+        comm = self._comm
+        try:
+            comm.close()
+        except AttributeError:
+            # litex's CommPCIe closes its fd as if it were a file
+            os.close(comm.file)
+            comm.mmap.close()
+            del comm.file
+        comm.enable()
+        comm.open()
+        return True
+
+    def recover(self, error=None, hot_reset=None):
+        # bring the adapter back, cheapest step first, and return the one
+        # that worked: "reset" (the reset pulse plus a resync of host-side
+        # state, microseconds) or "hot_reset" (a PCIe hot reset of the card,
+        # about a second). None if it's still stuck. The hot reset takes
+        # the card off the bus for every process using it, so it is only
+        # tried with hot_reset, by default when built with recover="hot_reset".
+        hot_reset = self.auto_recover == "hot_reset" if hot_reset is None else hot_reset
+        self._reset_adapter()
+        self._resync(error)
+        if self._idle():
+            return "reset"
+        if hot_reset and self._hot_reset():
+            self._reset_adapter()
+            self._resync(error)
+            if self._idle():
+                return "hot_reset"
+        return None
+
+    def perf(self, clear=False, modname=None):
+        # snapshot the counters (and restart them with clear) and turn them
+        # into utilization and per-call time, using the card's clock from
+        # config_clock_frequency. latency is how long a call's submission
+        # or result sits in the adapter on average.
+        assert self.perf_counters, "adapter built without perf counters"
+        modname = self.modname if modname is None else modname
+        module = self._comm.regs
+        getattr(module, f"{modname}_perf_control_csr").write(3 if clear else 1)
+        freq = self._comm.constants.config_clock_frequency
+        cycles = getattr(module, f"{modname}_perf_cycles_csr").read()
+        seconds = cycles/freq
+        report = {"cycles": cycles, "seconds": seconds}
+        for name in self._events:
+            counts = {counter: getattr(module, f"{modname}_{name}_{counter}_csr").read()
+                      for counter in ["calls", "stall", "hostwait", "busy"]}
+            calls = counts["calls"]
+            report[name] = dict(counts,
+                                calls_per_s=calls/seconds if cycles else 0,
+                                utilization=counts["busy"]/cycles if cycles else 0,
+                                stalled=counts["stall"]/cycles if cycles else 0,
+                                waiting_on_host=counts["hostwait"]/cycles if cycles else 0,
+                                latency=counts["busy"]/calls/freq if calls else None)
+        return report
+
     def status(self):
         dev = self._dev
         print(f"""
@@ -233,6 +1531,237 @@ class bsREPL(Module):
         return list(self.csrs.values())
 
 
+import unittest
+
+def _collatz(n):
+    steps = 0
+    while n != 1:
+        n = n//2 if n % 2 == 0 else 3*n + 1
+        steps += 1
+    return steps
+
+def _sim(**kwargs):
+    from comm_sim import CommSim
+    comm = CommSim(**kwargs)
+    comm.open()
+    comm.regs.bsREPL_reset.write(1)
+    return comm
+
+class TestPerf(unittest.TestCase):
+
+    def test_counters(self):
+        for queue_depth in [0, 2]:
+            with self.subTest(queue_depth=queue_depth):
+                self.check_counters(queue_depth)
+
+    def check_counters(self, queue_depth):
+        comm = _sim(perf=True, queue_depth=queue_depth)
+        repl = bsREPL(comm)
+        repl.perf(clear=True)
+        self.assertEqual(repl.call("collatz_submit", "collatz_get", 27), 111)
+        report = repl.perf(clear=True)
+        submit, get = report["collatz_submit"], report["collatz_get"]
+        self.assertEqual((submit["calls"], get["calls"]), (1, 1))
+        # the module steps 111 times before the result is RDY
+        self.assertGreaterEqual(get["busy"], 111)
+        self.assertLess(get["busy"], report["cycles"])
+        self.assertLessEqual(get["stall"], get["busy"])
+        # nothing submitted: the module isn't busy and nothing stalls
+        for _ in range(20):
+            comm.regs.bsREPL_collatz_get_status_csr.read()
+        idle = repl.perf()["collatz_get"]
+        self.assertEqual((idle["calls"], idle["busy"], idle["stall"]), (0, 0, 0))
+        comm.close()
+
+
+class TestMemo(unittest.TestCase):
+
+    def test_save_and_recover(self):
+        import gc, json, tempfile
+        comm = _sim()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "memo.json")
+            # two repls on one file: both caches end up in it
+            a = bsREPL(comm, pure=True, memo_path=path)
+            b = bsREPL(comm, pure=True, memo_path=path)
+            self.assertEqual(a.call("collatz_submit", "collatz_get", 27), 111)
+            self.assertEqual(b.call("collatz_submit", "collatz_get", 5), 5)
+            _save_memos()
+            with open(path) as f:
+                saved = json.load(f)["memos"]["collatz_submit/collatz_get"]
+            self.assertEqual(sorted(map(tuple, saved)), [(5, 5), (27, 111)])
+            # a recovery that comes back to another bitstream drops the cache
+            a._ident = lambda: "another design"
+            self.assertEqual(a.recover(), "reset")
+            self.assertEqual(a.memo_stats()["collatz_submit/collatz_get"]["size"], 0)
+            self.assertEqual(b.memo_stats()["collatz_submit/collatz_get"]["size"], 1)
+            del a, b
+            gc.collect()
+            self.assertEqual(len(_memo_repls), 0)
+        comm.close()
+
+
+class TestRecover(unittest.TestCase):
+
+    def test_timeout(self):
+        comm = _sim()
+        repl = bsREPL(comm, timeout=0.5)
+        hot_resets = []
+        repl._hot_reset = lambda: hot_resets.append(1) or False
+        # submissions nobody collects fill the module until one isn't taken
+        with self.assertRaises(CallTimeout) as cm:
+            for n in range(5, 5 + 4*repl.pipeline_depth):
+                repl.collatz_submit(n)
+        error = cm.exception
+        self.assertEqual(error.method, "collatz_submit")
+        self.assertIn("wedged", error.diagnosis["collatz_submit"])
+        self.assertEqual(error.recovery, "reset")
+        self.assertEqual(repl.diagnose("collatz_submit"), {})
+        self.assertEqual(repl.call("collatz_submit", "collatz_get", 27), 111)
+        # a reset that doesn't help only goes on to a hot reset when asked to
+        idle = repl._idle
+        repl._idle = lambda: False
+        self.assertIsNone(repl.recover())
+        self.assertEqual(hot_resets, [])
+        self.assertIsNone(repl.recover(hot_reset=True))
+        self.assertEqual(hot_resets, [1])
+        repl._idle = idle
+        self.assertEqual(repl.recover(), "reset")
+        comm.close()
+
+
+class TestLanes(unittest.TestCase):
+
+    def test_lanes(self):
+        for queue_depth in [0, 2]:
+            with self.subTest(queue_depth=queue_depth):
+                self.check_lanes(queue_depth)
+
+    def check_lanes(self, queue_depth):
+        comm = _sim(lanes=2, queue_depth=queue_depth, perf=True)
+        repl = bsREPL(comm)
+        self.assertEqual((repl.lanes, repl.queue_depth), (2, queue_depth))
+        # the lanes are independent, and the plain names are lane 0
+        repl.lane1_collatz_submit(n=27)
+        repl.collatz_submit(n=5)
+        self.assertEqual(repl.collatz_get(), 5)
+        self.assertEqual(repl.lane1_collatz_get(), 111)
+        # a map is spread over both and comes back in order
+        repl.perf(clear=True)
+        ns = [27, 5, 6, 9, 7, 3]
+        self.assertEqual(repl.map("collatz_submit", "collatz_get", ns), [_collatz(n) for n in ns])
+        report = repl.perf()
+        calls = [report[f"lane{lane}_collatz_get"]["calls"] for lane in range(2)]
+        self.assertEqual(sum(calls), len(ns))
+        self.assertNotIn(0, calls)
+        # call() goes through lane 0, and so does the cache in front of it
+        self.assertEqual(repl.call("collatz_submit", "collatz_get", 27), 111)
+        pure = bsREPL(comm, pure=True)
+        for _ in range(2):
+            self.assertEqual(pure.call("collatz_submit", "collatz_get", 9), _collatz(9))
+        self.assertEqual(pure.memo_stats()["collatz_submit/collatz_get"]["computed"], 1)
+        comm.close()
+
+
+class TestQueued(unittest.TestCase):
+
+    def test_credits_and_level(self):
+        from waiters import SpinWaiter
+        comm = _sim(queue_depth=2)
+        credits, level = comm.regs.bsREPL_collatz_submit_credits_csr, comm.regs.bsREPL_collatz_get_level_csr
+        self.assertEqual((credits.read(), level.read()), (2, 0))
+        for repl in [bsREPL(comm), bsREPL(comm, waiter=SpinWaiter())]:
+            # submissions queue up past what the module holds, results
+            # wait in the output queue, never more than its depth of them
+            ns = [5, 6, 7, 9, 3, 10]
+            for n in ns:
+                repl.collatz_submit(n=n)
+            for _ in range(20):
+                self.assertLessEqual(level.read(), 2)
+            self.assertEqual([repl.collatz_get() for n in ns], [_collatz(n) for n in ns])
+            self.assertEqual((credits.read(), level.read()), (2, 0))
+        # the bursts of the _many calls
+        ns = [27, 5, 6, 9, 7]
+        repl.collatz_submit_many(ns)
+        self.assertEqual(repl.collatz_get_many(len(ns)), [_collatz(n) for n in ns])
+        self.assertEqual(repl.map("collatz_submit", "collatz_get", ns), [_collatz(n) for n in ns])
+        self.assertEqual((credits.read(), level.read()), (2, 0))
+        comm.close()
+
+
+class TestPop(unittest.TestCase):
+
+    def test_pop(self):
+        for pop, queue_depth in [(True, 0), (True, 2), (6, 0)]:
+            with self.subTest(pop=pop, queue_depth=queue_depth):
+                self.check_pop(pop, queue_depth)
+
+    def check_pop(self, pop, queue_depth):
+        comm = _sim(pop=pop, queue_depth=queue_depth)
+        repl = bsREPL(comm)
+        reg = comm.regs.bsREPL_collatz_get_pop_csr
+        first = lambda: comm.read(reg.addr) # the word with the valid bit
+        self.assertEqual(reg.length, 3 if pop is True else 1)
+        self.assertFalse(first() & 1 << 31)
+
+        # a value the register holds: valid, not wide, popped by the read
+        repl.collatz_submit(n=5)
+        for _ in range(50):
+            v = first()
+            if v & 1 << 31:
+                break
+        self.assertTrue(v & 1 << 31)
+        if pop is True:
+            # the rest of it, read after the valid word, takes the value
+            self.assertEqual(comm.read(reg.addr + 4, 2), [0, 5])
+        else:
+            self.assertEqual(v & ~(1 << 31), 5)
+        self.assertFalse(first() & 1 << 31)
+
+        if pop is not True:
+            # too wide for 6 bits: flagged, and left for value/ack
+            repl.collatz_submit(n=27)
+            for _ in range(200):
+                v = first()
+                if v & 1 << 31:
+                    break
+            self.assertTrue(v & 1 << 30)
+            self.assertTrue(first() & 1 << 31) # not popped
+            self.assertEqual(comm.regs.bsREPL_collatz_get_value_csr.read(), 111)
+            comm.regs.bsREPL_collatz_get_ack_csr.write(1)
+            self.assertFalse(first() & 1 << 31)
+
+        ns = [27, 5, 6, 9]
+        self.assertEqual([repl.call("collatz_submit", "collatz_get", n) for n in ns], [_collatz(n) for n in ns])
+        self.assertEqual(repl.map("collatz_submit", "collatz_get", ns), [_collatz(n) for n in ns])
+        comm.close()
+
+
+class TestStream(unittest.TestCase):
+
+    def test_stream(self):
+        for lanes in [1, 2]:
+            with self.subTest(lanes=lanes):
+                self.check_stream(lanes)
+
+    def check_stream(self, lanes):
+        from comm_sim import SimDMA
+        comm = _sim(stream=True, lanes=lanes)
+        # 4 values a buffer, 2 a stream word: 7 values fill two buffers,
+        # the last word with one value and a copy of it
+        repl = bsREPL(comm, dma=SimDMA(comm, buffer_size=32))
+        self.assertTrue(repl.streaming)
+        ns = np.arange(5, 12)
+        results = repl.stream(ns)
+        self.assertEqual(results.dtype, np.int64)
+        self.assertEqual(results.tolist(), [_collatz(int(n)) for n in ns])
+        self.assertEqual(repl.stream(np.array([27])).tolist(), [111])
+        # and the CSR adapter takes single calls again afterwards
+        repl.collatz_submit(n=27)
+        self.assertEqual(repl.collatz_get(), 111)
+        comm.close()
+
+
 if __name__ == "__main__":
     from device import dev, comm
     collatz_repl = bsREPL(comm)
@@ -245,7 +1774,7 @@ if __name__ == "__main__":
         cnt = 0
         while n != 1:
             if n % 2 == 0:
-                n = n/2
+                n = n//2
             else:
                 n = 3*n + 1
             cnt += 1
@@ -259,6 +1788,48 @@ if __name__ == "__main__":
                 print(n)
                 status()
 
+    def test_map(dev):
+        import time
+        dev.bsREPL_reset = 1
+        ns = range(5, 10000)
+        t = time.perf_counter()
+        results = collatz_repl.map("collatz_submit", "collatz_get", ns)
+        t = time.perf_counter() - t
+        for n, r in zip(ns, results):
+            if r != collatz(n):
+                print(n)
+        print(f"{len(ns)/t:.0f} calls/s")
+
+    def test_perf(dev):
+        if not collatz_repl.perf_counters:
+            return
+        dev.bsREPL_reset = 1
+        collatz_repl.perf(clear=True)
+        collatz_repl.map("collatz_submit", "collatz_get", range(5, 10000))
+        from pprint import pprint
+        pprint(collatz_repl.perf())
+
+    def test_waiters(dev):
+        # tail latency and cpu cost of each wait mode, over the same calls
+        import os
+        from waiters import SpinWaiter, AdaptiveWaiter, IRQWaiter, BsREPLIRQ
+        modes = {"spin": SpinWaiter(record=True),
+                 "adaptive": AdaptiveWaiter(record=True)}
+        if "BSREPL_IRQ" in os.environ:
+            irq = BsREPLIRQ(comm, os.environ["BSREPL_IRQ"])
+            modes["irq"] = IRQWaiter(irq, record=True)
+            modes["adaptive+irq"] = AdaptiveWaiter(irq=irq, record=True)
+        for name, waiter in modes.items():
+            dev.bsREPL_reset = 1
+            repl = bsREPL(comm, waiter=waiter)
+            for n in range(5, 2000):
+                repl.collatz_submit(n=n)
+                repl.collatz_get()
+            print(name, waiter.stats())
+
     print(dev)
     test_1(dev)
+    test_map(dev)
+    test_perf(dev)
+    test_waiters(dev)
     print("passed")
@@ -0,0 +1,281 @@
+import asyncio
+from collections import deque
+from functools import partial
+from waiters import CallTimeout, Deadline
+
+# asyncio front end for a bsREPL in REPL mode. Every method becomes a
+# coroutine; they don't touch the hardware themselves but queue up, and a
+# single poller task services all of them. Each poll cycle reads the
+# *_status_csr of every method with work pending, then advances whatever
+# is ready:
+#
+#   action methods       bit 4 low means the previous submission was
+#                        accepted: its caller resumes, and the next queued
+#                        submission is written.
+#   actionvalue methods  bit 4 high means a result is latched: it is read,
+#                        ack'ed, and handed to the oldest waiting caller.
+#
+# On a queued adapter the poll reads the credits and level CSRs instead, and
+# writes or reads as many values as they allow.
+#
+# With a timeout on the repl, a poller that sees no progress for that long
+# has the repl diagnose and recover the adapter; every call outstanding
+# then raises the CallTimeout. Calls are also failed whenever the repl is
+# recovered by someone else, as the reset drops them in the hardware.
+#
+#   arepl = AsyncREPL(bsREPL(comm))
+#   await arepl.collatz_submit(n=27)
+#   steps = await arepl.collatz_get()
+
+STATUS_PENDING = 1 << 4 # action: submission not yet accepted
+STATUS_VALID = 1 << 4   # actionvalue: result waiting for the host
+
+def _fail(futures, error):
+    for future in futures:
+        if not future.done():
+            future.set_exception(error)
+
+class _Action():
+    def __init__(self, regs, modname, method_name, arg_name):
+        self.status = getattr(regs, f"{modname}_{method_name}_status_csr")
+        self.trigger = getattr(regs, f"{modname}_{method_name}_trigger_csr")
+        self.values = {arg_name: getattr(regs, f"{modname}_{method_name}_{arg_name}_value_csr")}
+        self.queue = deque()    # (kwargs, future) not written yet
+        self.in_flight = None   # future of the written, unaccepted submission
+
+    def busy(self):
+        return self.queue or self.in_flight is not None
+
+    def outstanding(self):
+        return len(self.queue) + (self.in_flight is not None)
+
+    def fail(self, error):
+        _fail([future for kwargs, future in self.queue], error)
+        if self.in_flight is not None:
+            _fail([self.in_flight], error)
+        self.queue.clear()
+        self.in_flight = None
+
+    def service(self, status):
+        if status & STATUS_PENDING:
+            return
+        if self.in_flight is not None:
+            if not self.in_flight.done():
+                self.in_flight.set_result(None)
+            self.in_flight = None
+        if self.queue:
+            kwargs, future = self.queue.popleft()
+            for k, v in kwargs.items():
+                self.values[k].write(v)
+            self.trigger.write(1)
+            self.in_flight = future
+
+class _ActionValue():
+    def __init__(self, regs, modname, method_name):
+        self.status = getattr(regs, f"{modname}_{method_name}_status_csr")
+        self.ack = getattr(regs, f"{modname}_{method_name}_ack_csr")
+        self.value = getattr(regs, f"{modname}_{method_name}_value_csr")
+        self.queue = deque()    # futures waiting for a result, oldest first
+
+    def busy(self):
+        return bool(self.queue)
+
+    def outstanding(self):
+        return len(self.queue)
+
+    def fail(self, error):
+        _fail(self.queue, error)
+        self.queue.clear()
+
+    def service(self, status):
+        if status & STATUS_VALID:
+            v = self.value.read()
+            self.ack.write(1)
+            future = self.queue.popleft()
+            if not future.done():
+                future.set_result(v)
+
+class _QueuedAction():
+    def __init__(self, regs, modname, method_name, arg_name):
+        self.status = getattr(regs, f"{modname}_{method_name}_credits_csr")
+        self.values = {arg_name: getattr(regs, f"{modname}_{method_name}_{arg_name}_value_csr")}
+        self.queue = deque()
+
+    def busy(self):
+        return bool(self.queue)
+
+    def outstanding(self):
+        return len(self.queue)
+
+    def fail(self, error):
+        _fail([future for kwargs, future in self.queue], error)
+        self.queue.clear()
+
+    def service(self, credits):
+        # queued is as far as a submission goes
+        for _ in range(min(credits, len(self.queue))):
+            kwargs, future = self.queue.popleft()
+            for k, v in kwargs.items():
+                self.values[k].write(v)
+            if not future.done():
+                future.set_result(None)
+
+class _QueuedActionValue():
+    def __init__(self, regs, modname, method_name):
+        self.status = getattr(regs, f"{modname}_{method_name}_level_csr")
+        self.ack = getattr(regs, f"{modname}_{method_name}_ack_csr")
+        self.value = getattr(regs, f"{modname}_{method_name}_value_csr")
+        self.queue = deque()
+
+    def busy(self):
+        return bool(self.queue)
+
+    def outstanding(self):
+        return len(self.queue)
+
+    def fail(self, error):
+        _fail(self.queue, error)
+        self.queue.clear()
+
+    def service(self, level):
+        for _ in range(min(level, len(self.queue))):
+            v = self.value.read()
+            self.ack.write(1)
+            future = self.queue.popleft()
+            if not future.done():
+                future.set_result(v)
+
+class AsyncREPL():
+
+    def __init__(self, repl, interval=0, modname=None):
+        self.repl = repl
+        modname = repl.modname if modname is None else modname
+        # seconds between poll cycles; 0 just yields to the other coroutines
+        self.interval = interval
+        self._methods = methods = {}
+        self._poller = None
+
+        # as on the repl, lane<i>_<method> per lane, and the plain names
+        # for lane 0
+        regs = repl._comm.regs
+        action, actionvalue = (_QueuedAction, _QueuedActionValue) if repl.queue_depth else (_Action, _ActionValue)
+        self._prefixes = [repl._lane_prefix(lane) for lane in range(repl.lanes)]
+        for prefix in self._prefixes:
+            for type, width, arg_name, method_name, in repl.interface.actionmethods:
+                name = f"{prefix}{method_name}"
+                methods[name] = action(regs, modname, name, arg_name)
+                setattr(self, name, partial(self._action_call, name))
+
+            for type, width, method_name in repl.interface.actionvaluemethods:
+                name = f"{prefix}{method_name}"
+                methods[name] = actionvalue(regs, modname, name)
+                setattr(self, name, partial(self._action_value_return, name))
+
+        if repl.lanes > 1:
+            for method_name in repl._method_names():
+                setattr(self, method_name, getattr(self, f"lane0_{method_name}"))
+
+        repl.on_recover.append(self._fail)
+
+    def _fail(self, error):
+        error = ConnectionResetError("bsREPL adapter was reset") if error is None else error
+        for m in self._methods.values():
+            m.fail(error)
+
+    def _future(self):
+        loop = asyncio.get_running_loop()
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll())
+        return loop.create_future()
+
+    async def _action_call(self, method_name, **kwargs):
+        future = self._future()
+        self._methods[method_name].queue.append((kwargs, future))
+        await future
+
+    async def _action_value_return(self, method_name):
+        future = self._future()
+        self._methods[method_name].queue.append(future)
+        return await future
+
+    async def call(self, submit, get, **kwargs):
+        # submit and claim the matching result in one step, so concurrent
+        # callers can't get their results crossed. The call goes to the lane
+        # with the fewest results outstanding.
+        prefix = min(self._prefixes, key=lambda p: len(self._methods[f"{p}{get}"].queue))
+        submitted, result = self._future(), self._future()
+        self._methods[f"{prefix}{submit}"].queue.append((kwargs, submitted))
+        self._methods[f"{prefix}{get}"].queue.append(result)
+        await submitted
+        return await result
+
+    async def _poll(self):
+        methods = self._methods
+        deadline = Deadline(self.repl.timeout) # restarted whenever a call moves on
+        while True:
+            pending = [m for m in methods.values() if m.busy()]
+            if not pending:
+                return
+            # read all the status registers first, then act on them
+            statuses = [m.status.read() for m in pending]
+            outstanding = sum(m.outstanding() for m in pending)
+            for m, status in zip(pending, statuses):
+                m.service(status)
+            if sum(m.outstanding() for m in pending) != outstanding:
+                deadline.restart()
+            elif deadline.expired():
+                try:
+                    self.repl._expired(*(name for name, m in methods.items() if m.busy()))
+                except CallTimeout as e:
+                    # recovery, if any, already failed the calls
+                    self._fail(e)
+                return
+            await asyncio.sleep(self.interval)
+
+
+import unittest
+
+class TestAsyncREPL(unittest.TestCase):
+
+    def test_order(self):
+        for queue_depth in [0, 2]:
+            with self.subTest(queue_depth=queue_depth):
+                self.check_order(queue_depth)
+
+    def check_order(self, queue_depth):
+        from bsREPL import bsREPL, _collatz, _sim
+        comm = _sim(queue_depth=queue_depth)
+        arepl = AsyncREPL(bsREPL(comm))
+        ns = [27, 5, 6, 9, 7]
+
+        async def main():
+            # concurrent calls each get their own result
+            calls = await asyncio.gather(*(arepl.call("collatz_submit", "collatz_get", n=n) for n in ns))
+            # and separate submits come back in submission order
+            await asyncio.gather(*(arepl.collatz_submit(n=n) for n in ns))
+            gets = await asyncio.gather(*(arepl.collatz_get() for n in ns))
+            return calls, gets
+
+        calls, gets = asyncio.run(main())
+        self.assertEqual(calls, [_collatz(n) for n in ns])
+        self.assertEqual(gets, [_collatz(n) for n in ns])
+        comm.close()
+
+
+if __name__ == "__main__":
+    import time
+    from device import dev, comm
+    from bsREPL import bsREPL
+
+    arepl = AsyncREPL(bsREPL(comm))
+
+    async def main():
+        dev.bsREPL_reset = 1
+        ns = range(5, 10000)
+        t = time.perf_counter()
+        results = await asyncio.gather(*(arepl.call("collatz_submit", "collatz_get", n=n) for n in ns))
+        t = time.perf_counter() - t
+        print(f"{len(ns)/t:.0f} calls/s")
+        return results
+
+    asyncio.run(main())
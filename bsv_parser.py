@@ -1,19 +1,53 @@
 from tatsu.model import ModelBuilderSemantics
 import pprint
 import json
-from tatsu import parse, compile, to_python_model
+import os
+import re
+import hashlib
+import importlib.util
+from functools import lru_cache
+from tatsu import parse, compile, to_python_model, to_python_sourcecode
 from tatsu.util import asjson
 
+# parsed interfaces, generated parsers and package indexes are cached here,
+# keyed by a content hash; `make clean` drops them with the rest of build/.
+CACHE_DIR = os.environ.get("BSV_PARSER_CACHE",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "build", "bsv_cache"))
+
+def _digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _cache_load(key):
+    try:
+        with open(os.path.join(CACHE_DIR, f"{key}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _cache_store(key, data):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, f"{key}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass # a read-only checkout still works, just uncached
+
 class BSVInterface():
 
-    GRAMMAR = '''
+    GRAMMAR = r'''
     @@grammar::BSVInterface
     @@parseinfo :: True
 
     start = interfaceDecl $ ;
 
     interfaceDecl::IFACE
-        = 'interface' typeDefType ';'
+        = 'interface' name:typeDefType ';'
             methods:{ methodProto }
         'endinterface:' typeDefType ;
 
@@ -31,9 +65,20 @@ class BSVInterface():
     string = /[a-zA-Z0-9\_]+/ ;
     '''
 
-    def __init__(self, interface_str):
-        self.parser = compile(self.GRAMMAR, name="BSVInterface", semantics=ModelBuilderSemantics())
-        self.interface = interface = self.parser.parse(interface_str)
+    def __init__(self, interface_str, cache=True):
+        key = _digest(self.GRAMMAR, interface_str)
+        cached = _cache_load(key) if cache else None
+
+        if cached is not None:
+            # the AST isn't kept on disk, only what we extract from it
+            self.interface = None
+            self.name = cached["name"]
+            self.actionmethods = [tuple(m) for m in cached["actionmethods"]]
+            self.actionvaluemethods = [tuple(m) for m in cached["actionvaluemethods"]]
+            return
+
+        self.interface = interface = get_parser().parse(interface_str, semantics=ModelBuilderSemantics())
+        self.name = interface.name
 
         self.actionmethods = actionmethods = []
         self.actionvaluemethods = actionvaluemethods = []
@@ -55,3 +100,91 @@ class BSVInterface():
                 actionvaluemethods.append( (type, width, method_name) )
             else:
                 print("method type", method.type.name, "of method", method.name, "not supported!")
+
+        if cache:
+            _cache_store(key, {"name": self.name,
+                               "actionmethods": actionmethods,
+                               "actionvaluemethods": actionvaluemethods})
+
+    @classmethod
+    def from_package(cls, path, cache=True):
+        # index every interface ... endinterface block of a .bsv package in
+        # one pass over the file: {interface name: BSVInterface}.
+        with open(path) as f:
+            text = f.read()
+
+        blocks = _interface_blocks(text)
+        if not cache:
+            return {name: cls(block, cache=False) for name, block in blocks}
+
+        key = _digest(cls.GRAMMAR, "package", text)
+        cached = _cache_load(key)
+        if cached is not None:
+            return {name: cls(block) for name, block in cached}
+        index = {name: cls(block) for name, block in blocks}
+        _cache_store(key, blocks)
+        return index
+
+_COMMENT = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+_INTERFACE = re.compile(r"\binterface\s+(\w+)\s*;(.*?)\bendinterface\b(?:\s*:\s*\w+)?", re.DOTALL)
+
+def _interface_blocks(text):
+    # [(name, normalized block)], in file order; commented-out blocks skipped
+    text = _COMMENT.sub("", text)
+    return [(m.group(1), f"interface {m.group(1)};{m.group(2)}endinterface: {m.group(1)}")
+            for m in _INTERFACE.finditer(text)]
+
+@lru_cache(maxsize=None)
+def get_parser(generated=True):
+    # compiling the grammar is the slow part of startup, so do it once per
+    # process. With generated=True the compiled parser is also written out
+    # as a python module in CACHE_DIR and imported on later runs.
+    grammar = BSVInterface.GRAMMAR
+    if not generated:
+        return compile(grammar, name="BSVInterface")
+
+    path = os.path.join(CACHE_DIR, f"parser_{_digest(grammar)[:16]}.py")
+    if not os.path.exists(path):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                f.write(to_python_sourcecode(grammar, name="BSVInterface"))
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            return compile(grammar, name="BSVInterface")
+
+    spec = importlib.util.spec_from_file_location("bsv_interface_parser", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.BSVInterfaceParser()
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    path = sys.argv[1] if len(sys.argv) > 1 else "CollatzServer.bsv"
+
+    # cold: what every BSVInterface used to pay, a grammar compile plus a parse
+    t = time.perf_counter()
+    parser = get_parser(generated=False)
+    with open(path) as f:
+        for name, block in _interface_blocks(f.read()):
+            parser.parse(block, semantics=ModelBuilderSemantics())
+    cold = time.perf_counter() - t
+
+    BSVInterface.from_package(path) # populate the disk caches
+    get_parser.cache_clear()
+
+    t = time.perf_counter()
+    get_parser()
+    generated = time.perf_counter() - t
+
+    t = time.perf_counter()
+    index = BSVInterface.from_package(path)
+    warm = time.perf_counter() - t
+
+    for name, interface in index.items():
+        print(name, interface.actionmethods, interface.actionvaluemethods)
+    print(f"cold {cold*1e3:.1f}ms (grammar compile + parse)")
+    print(f"generated parser import {generated*1e3:.1f}ms")
+    print(f"warm {warm*1e3:.1f}ms (disk cache)")
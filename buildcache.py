@@ -0,0 +1,241 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import subprocess
+
+# Content-addressed build cache, and pruning of the bsc Verilog library.
+#
+# Build outputs (bsc's Verilog, the elaborated SoC, the bitstream, csr.csv,
+# the driver) are stored under a hash of what they were made from: the
+# contents of the input files, the python modules the SoC was elaborated
+# with, and the options. An unchanged design gets them back by copy instead
+# of elaboration and synthesis. The hash also names the design in the SoC's
+# ident, so identifier_mem tells the host which design a card runs.
+#
+# verilog_closure() follows module instantiations from the user modules
+# bsc generated into its library, so the build gets only the library
+# modules actually used instead of every file in it.
+#
+#   python buildcache.py run -i CollatzServer.bsv -o build/mkCollatzServer.v -- bsc ...
+#   python buildcache.py closure build/mkCollatzServer.v --search build $BSC_VERILOG
+#
+# BSREPL_BUILD_CACHE puts the cache elsewhere, e.g. somewhere `make clean`
+# doesn't wipe.
+
+CACHE_DIR = os.environ.get("BSREPL_BUILD_CACHE",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "build", "cache"))
+
+# packages whose code elaborates the SoC; their modules count as inputs
+PACKAGES = ("migen", "litex", "litex_boards", "litedram", "litepcie", "litesata")
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def digest(files=(), params=None):
+    # a hash over the files' contents, in the given order, and params
+    # (anything JSON can take)
+    h = hashlib.sha256()
+    for path in files:
+        h.update(os.path.basename(path).encode())
+        h.update(b"\0")
+        h.update(_file_digest(path).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def module_files(root=None, packages=PACKAGES):
+    # source files of the modules imported so far from this directory
+    # (root) and from packages, sorted
+    root = os.path.dirname(os.path.abspath(__file__)) if root is None else root
+    files = set()
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if not path or not path.endswith(".py"):
+            continue
+        path = os.path.abspath(path)
+        if path.startswith(root + os.sep) or name.split(".")[0] in packages:
+            files.add(path)
+    return sorted(files)
+
+_COMMENT = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+_MODULE = re.compile(r"\bmodule\s+(\w+)")
+# a module name, optional parameters, then an instance name and its ports
+_INSTANCE = re.compile(r"\b([A-Za-z_]\w*)\s*(?:#\s*\(|[A-Za-z_]\w*\s*(?:\[[^\]]*\]\s*)?\()")
+
+def instantiated(text):
+    # names of the modules a Verilog source instantiates, less those it
+    # defines itself. Both sides of an `ifdef count.
+    text = _COMMENT.sub("", text)
+    return set(_INSTANCE.findall(text)) - set(_MODULE.findall(text))
+
+def verilog_closure(tops, search):
+    # tops and every <module>.v in the search directories they instantiate,
+    # directly or not. Anything not found there (Xilinx primitives,
+    # modules of the SoC) is left to the tools.
+    files = [os.path.abspath(path) for path in tops]
+    queue = list(files)
+    seen = set()
+    while queue:
+        with open(queue.pop()) as f:
+            names = instantiated(f.read())
+        for name in sorted(names - seen):
+            seen.add(name)
+            for directory in search:
+                path = os.path.abspath(os.path.join(directory, f"{name}.v"))
+                if os.path.isfile(path):
+                    if path not in files:
+                        files.append(path)
+                        queue.append(path)
+                    break
+    return files
+
+class BuildCache():
+    # cache entries are directories named by key, holding the outputs under
+    # names of their own (a file or a directory each)
+
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def has(self, key, names):
+        entry = self._entry(key)
+        return all(os.path.exists(os.path.join(entry, name)) for name in names)
+
+    def restore(self, key, outputs):
+        # outputs: {name: destination}. True if all of them were cached and
+        # are back in place.
+        if not self.has(key, outputs):
+            return False
+        entry = self._entry(key)
+        for name, dest in outputs.items():
+            src = os.path.join(entry, name)
+            if os.path.dirname(dest):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.isdir(src):
+                shutil.rmtree(dest, ignore_errors=True)
+                shutil.copytree(src, dest)
+            else:
+                shutil.copy2(src, dest)
+        return True
+
+    def store(self, key, outputs):
+        # outputs: {name: source}; ones that don't exist are skipped. Each
+        # lands under a temporary name first, so a half-copied output is
+        # never taken for a cached one.
+        entry = self._entry(key)
+        try:
+            os.makedirs(entry, exist_ok=True)
+            for name, src in outputs.items():
+                if not os.path.exists(src):
+                    continue
+                dest = os.path.join(entry, name)
+                tmp = f"{dest}.tmp"
+                shutil.rmtree(tmp, ignore_errors=True)
+                if os.path.isdir(src):
+                    shutil.copytree(src, tmp)
+                    shutil.rmtree(dest, ignore_errors=True)
+                else:
+                    shutil.copy2(src, tmp)
+                os.replace(tmp, dest)
+        except OSError:
+            pass # a read-only cache still works, just doesn't fill
+
+def _tool(command):
+    # the command's executable is an input too: a new bsc makes new Verilog
+    path = shutil.which(command[0])
+    return [path] if path else []
+
+def run(command, inputs, outputs, cache=None):
+    # command, unless its outputs for these inputs are cached; 0 or its
+    # exit status
+    cache = BuildCache() if cache is None else cache
+    key = digest(list(inputs) + _tool(command), {"command": command, "outputs": outputs})
+    named = {f"{i}_{os.path.basename(path)}": path for i, path in enumerate(outputs)}
+    if cache.restore(key, named):
+        print(f"{', '.join(outputs)}: cached ({key[:12]})")
+        return 0
+    status = subprocess.run(command).returncode
+    if status == 0:
+        cache.store(key, named)
+    return status
+
+
+import unittest
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_closure(self):
+        top = self.write("build/mkTop.v", """
+module mkTop(CLK, RST_N);
+  // FIFO1 #(.width(1)) unused(.CLK(CLK));
+  FIFO2 #(.width(32'd64), .guarded(1'd1)) f_in(.RST(RST_N), .CLK(CLK));
+  mkSub sub(.CLK(CLK));
+  always @(posedge CLK) $display("SizedFIFO (x)");
+endmodule
+""")
+        self.write("build/mkSub.v", "module mkSub(CLK);\n  RegN #(.width(8)) r(.CLK(CLK));\nendmodule\n")
+        lib = [self.write(f"lib/{name}.v", f"module {name}(CLK);\nendmodule\n")
+               for name in ["FIFO1", "FIFO2", "RegN", "SizedFIFO"]]
+        self.write("lib/RegN.v", "module RegN(CLK);\n  FIFO1 f(.CLK(CLK));\nendmodule\n")
+        files = verilog_closure([top], [os.path.join(self.dir, "build"), os.path.join(self.dir, "lib")])
+        self.assertEqual([os.path.relpath(path, self.dir) for path in files],
+                         ["build/mkTop.v", "lib/FIFO2.v", "build/mkSub.v", "lib/RegN.v", "lib/FIFO1.v"])
+        self.assertNotIn(lib[3], files)
+
+    def test_cache(self):
+        cache = BuildCache(os.path.join(self.dir, "cache"))
+        src = self.write("in.bsv", "a")
+        out = self.write("out/x.v", "x")
+        key = digest([src], {"flag": 1})
+        self.assertNotEqual(key, digest([src], {"flag": 2}))
+        self.assertFalse(cache.restore(key, {"x.v": out}))
+        cache.store(key, {"x.v": out, "missing": os.path.join(self.dir, "missing")})
+        os.remove(out)
+        self.assertTrue(cache.restore(key, {"x.v": out}))
+        self.assertEqual(open(out).read(), "x")
+        self.assertFalse(cache.restore(key, {"x.v": out, "missing": out}))
+        self.write("in.bsv", "b")
+        self.assertNotEqual(digest([src], {"flag": 1}), key)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="content-addressed build steps")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("run", help="run a command unless its outputs are cached")
+    p.add_argument("-i", "--inputs", nargs="*", default=[], help="files the outputs are made from")
+    p.add_argument("-o", "--outputs", nargs="+", required=True, help="files the command makes")
+    p.add_argument("cmd", nargs=argparse.REMAINDER, help="-- the command")
+    p = sub.add_parser("closure", help="list the Verilog files a module needs")
+    p.add_argument("tops", nargs="+")
+    p.add_argument("--search", nargs="+", required=True, help="directories of <module>.v files")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+        sys.exit(run(cmd, args.inputs, args.outputs))
+    else:
+        print("\n".join(verilog_closure(args.tops, args.search)))
@@ -0,0 +1,172 @@
+import os
+import mmap
+from types import SimpleNamespace
+
+from csr_table import CSRTable, Register
+
+# A CommPCIe replacement that maps BAR0 once and compiles every register in
+# csr.csv into a pair of closures over a 32-bit word view of the mapping.
+# dev.<reg> / regs.<reg>.read() then costs a closure call and one or two
+# indexed loads, instead of CSRBuilder object lookups and a bytes slice and
+# int.from_bytes per word.
+#
+# bar is either a PCI address like "03:00.0", a path to a resource0-like
+# file (a regular file works as a stand-in for tests), or None for an
+# anonymous mapping of `size` bytes.
+
+BUSWORD = 32
+MASK = 2**BUSWORD - 1
+
+def _compile(words, reg):
+    # words are big-endian ordered in litex: the msw lives at the lowest
+    # address, and writing the lsw last commits the register.
+    i = reg.addr // 4
+    if reg.length == 1:
+        def read():
+            return words[i]
+        def write(value):
+            words[i] = value & MASK
+    elif reg.length == 2:
+        j = i + 1
+        def read():
+            return (words[i] << BUSWORD) | words[j]
+        def write(value):
+            words[i] = (value >> BUSWORD) & MASK
+            words[j] = value & MASK
+    else:
+        idx = range(i, i + reg.length)
+        shifts = [BUSWORD*(reg.length - 1 - n) for n in range(reg.length)]
+        def read():
+            value = 0
+            for k in idx:
+                value = (value << BUSWORD) | words[k]
+            return value
+        def write(value):
+            for k, s in zip(idx, shifts):
+                words[k] = (value >> s) & MASK
+
+    if reg.mode not in ["rw", "wo"]:
+        def write(value, name=reg.name):
+            raise KeyError(name + " register not writable")
+    return read, write
+
+class CommMMAP():
+
+    def __init__(self, bar, csr_csv="csr.csv", size=None, debug=False):
+        if bar is not None and not os.path.exists(bar):
+            bar = f"/sys/bus/pci/devices/0000:{bar}/resource0"
+        self.bar = bar
+        self.size = size
+        self.debug = debug
+
+        self.table = table = CSRTable(csr_csv)
+        self.bases = SimpleNamespace(**table.bases)
+        self.constants = SimpleNamespace(**table.constants)
+        self.mems = SimpleNamespace(**table.mems)
+        self.regs = SimpleNamespace()
+
+    def enable(self):
+        # same as CommPCIe: turn the PCIe function on if it isn't yet.
+        if self.bar is None or not self.bar.startswith("/sys/bus/pci/devices"):
+            return
+        enable = open(self.bar.replace("resource0", "enable"), "r+")
+        if enable.read(1) == "0":
+            enable.seek(0)
+            enable.write("1")
+        enable.close()
+
+    def open(self):
+        if hasattr(self, "mmap"):
+            return
+        if self.bar is None:
+            self.mmap = mmap.mmap(-1, self.size)
+        else:
+            self.file = os.open(self.bar, os.O_RDWR | os.O_SYNC)
+            self.size = os.fstat(self.file).st_size if self.size is None else self.size
+            self.mmap = mmap.mmap(self.file, self.size, flags=mmap.MAP_SHARED,
+                                  prot=mmap.PROT_READ | mmap.PROT_WRITE)
+        self.words = words = memoryview(self.mmap).cast("I")
+
+        for name, reg in self.table.regs.items():
+            setattr(self.regs, name, Register(reg, *_compile(words, reg)))
+
+    def close(self):
+        if not hasattr(self, "mmap"):
+            return
+        self.regs = SimpleNamespace()
+        self.words.release()
+        self.mmap.close()
+        del self.words, self.mmap
+        if hasattr(self, "file"):
+            os.close(self.file)
+            del self.file
+
+    def accessors(self, name):
+        # (read, write) for one register, for callers that want to hoist the
+        # lookup out of a polling loop entirely.
+        reg = getattr(self.regs, name)
+        return reg.read, reg.write
+
+    # same address-based interface as CommPCIe
+    def read(self, addr, length=None, burst="incr"):
+        i = addr // 4
+        if length is None:
+            value = self.words[i]
+            if self.debug:
+                print("read 0x{:08x} @ 0x{:08x}".format(value, addr))
+            return value
+        data = self.words[i:i + length].tolist()
+        if self.debug:
+            for n, value in enumerate(data):
+                print("read 0x{:08x} @ 0x{:08x}".format(value, addr + 4*n))
+        return data
+
+    def write(self, addr, data):
+        data = data if isinstance(data, list) else [data]
+        i = addr // 4
+        for n, value in enumerate(data):
+            self.words[i + n] = value & MASK
+            if self.debug:
+                print("write 0x{:08x} @ 0x{:08x}".format(value, addr + 4*n))
+
+
+import unittest
+
+class TestCommMMAP(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.truncate(0x20000)
+        self.comm = CommMMAP(self.file.name, csr_csv="csr.csv")
+        self.comm.open()
+
+    def tearDown(self):
+        self.comm.close()
+        self.file.close()
+
+    def test_split_csr(self):
+        reg = self.comm.regs.bsREPL_collatz_submit_n_value_csr
+        reg.write(0x0123456789abcdef)
+        self.assertEqual(reg.read(), 0x0123456789abcdef)
+        # msw at the lower address, as litex lays them out
+        self.assertEqual(self.comm.read(reg.addr, length=2), [0x01234567, 0x89abcdef])
+
+    def test_backing_file(self):
+        self.comm.regs.ctrl_scratch.write(0x12345678)
+        self.file.seek(self.comm.regs.ctrl_scratch.addr)
+        self.assertEqual(int.from_bytes(self.file.read(4), "little"), 0x12345678)
+
+    def test_read_only(self):
+        with self.assertRaises(KeyError):
+            self.comm.regs.xadc_temperature.write(1)
+
+    def test_anonymous(self):
+        comm = CommMMAP(None, csr_csv="csr.csv", size=0x20000)
+        comm.open()
+        comm.regs.bsREPL_collatz_submit_trigger_csr.write(1)
+        self.assertEqual(comm.read(comm.regs.bsREPL_collatz_submit_trigger_csr.addr), 1)
+        comm.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,364 @@
+import os
+import queue
+import threading
+from types import SimpleNamespace
+import numpy as np
+
+from migen import *
+import migen.sim.core
+import migen.fhdl.bitcontainer
+from litex.soc.interconnect import csr_bus
+from litex.soc.interconnect.csr import CSRStatus
+
+from csr_table import CSRTable, CSRRegister, Register, address_accessors
+
+# A CommPCIe stand-in backed by Migen's simulator running the real adapter
+# gateware (bsREPL._init_HDL, CustomAdder) behind a LiteX CSR bank, with the
+# BSV user modules replaced by the models in models.py.
+#
+# The simulator runs in a thread and its only generator blocks on a queue of
+# bus operations from the host, so clocks only advance while a register
+# access is in progress: host-side think time costs no simulated cycles and
+# a poll loop advances the design by a few cycles per read. Writes are
+# posted, reads block for the result, like on PCIe.
+#
+# Banks are placed at the same addresses as in csr.csv where the module is
+# listed there, so addresses (and traces) match the hardware.
+#
+# It is slow: a simulated cycle of the default design costs about 1.5ms,
+# and every access takes two, so about 3ms an access; a collatz(27) call
+# (~130 cycles of polling) takes ~0.2s and a map over a few hundred values
+# a minute. Keep tests on it to a few dozen calls. A multi-word access
+# goes to the simulator as one request, and the widths Migen's simulator
+# recomputes for every expression on every cycle are memoized while it
+# runs, which takes about a quarter off.
+#
+# With stream (or job), the adapter's DMA sink and source are driven from
+# the host too, through SimDMA, a pcie_dma0 stand-in for bsREPL.stream and
+# a job's readback.
+#
+#   BSREPL_COMM=sim python bsREPL.py
+#   BSREPL_COMM=sim python adder.py
+
+PAGING = 0x800
+ADDRESS_WIDTH = 14
+
+def default_modules(lanes=1, queue_depth=0, perf=False, pop=False, job=False, stream=False):
+    from bsREPL import bsREPL
+    from adder import CustomAdder
+    from models import CollatzServerModel, BsAdderModel, DRAMModel
+    models = [CollatzServerModel() for _ in range(lanes)]
+    # job mode gets a small SDRAM stand-in
+    dram = DRAMModel() if job else None
+    repl = bsREPL(model=models, lanes=lanes, queue_depth=queue_depth, perf=perf, pop=pop,
+                  stream=stream, job_ports=dram and dram.ports)
+    if dram is not None:
+        repl.submodules.dram = dram
+    return {"bsREPL": repl,
+            "cadd": CustomAdder(model=BsAdderModel())}
+
+def _bus_write(bus, adr, dat):
+    # a CSRStorage's re pulse, and whatever it pushes or pops, lands the
+    # cycle after the bus write; give it that cycle before the next access
+    # so a read behind a write sees its effect, as it always would on PCIe.
+    yield bus.adr.eq(adr)
+    yield bus.dat_w.eq(dat)
+    yield bus.we.eq(1)
+    yield
+    yield bus.we.eq(0)
+    yield
+
+def _bus_read(bus, adr):
+    # banks register dat_r, so it is valid two cycles after adr. Newer
+    # litex buses also have a read strobe; keep it high for exactly one.
+    strobe = getattr(bus, "re", None)
+    yield bus.adr.eq(adr)
+    if strobe is not None:
+        yield strobe.eq(1)
+    yield
+    if strobe is not None:
+        yield strobe.eq(0)
+    yield
+    return (yield bus.dat_r)
+
+def _stream(sink, source, words, n, patience=4096):
+    # words into sink while n words are taken from source, like the DMA
+    # reader and writer do, until patience cycles go by with neither
+    # moving: (words taken, cycles). A generator's reads after a yield see
+    # the signals as the clock edge did, so valid & ready then means a
+    # word went through.
+    out = []
+    i = idle = cycles = 0
+    yield source.ready.eq(n > 0)
+    if words:
+        yield sink.valid.eq(1)
+        yield sink.data.eq(words[0])
+    while (i < len(words) or len(out) < n) and idle < patience:
+        yield
+        idle += 1
+        cycles += 1
+        if i < len(words) and (yield sink.ready):
+            i += 1
+            idle = 0
+            if i < len(words):
+                yield sink.data.eq(words[i])
+            else:
+                yield sink.valid.eq(0)
+        if len(out) < n and (yield source.valid):
+            out.append((yield source.data))
+            idle = 0
+            if len(out) == n:
+                yield source.ready.eq(0)
+    if sink is not None:
+        yield sink.valid.eq(0)
+    yield source.ready.eq(0)
+    yield
+    return out, cycles + 1
+
+# value_bits_sign for every expression the simulator evaluates, by
+# identity: the expressions don't change once the simulation has started.
+# The simulator looks it up in both modules at call time, so it is swapped
+# in there while any sim runs and put back after the last one. Each sim's
+# thread keeps its own cache; other threads get the plain function.
+_ORIGINALS = {module: module.value_bits_sign for module in [migen.sim.core, migen.fhdl.bitcontainer]}
+_running = 0
+_running_lock = threading.Lock()
+_local = threading.local()
+
+def _value_bits_sign(value, compute=migen.fhdl.bitcontainer.value_bits_sign):
+    widths = getattr(_local, "widths", None)
+    if widths is None:
+        return compute(value)
+    entry = widths.get(id(value))
+    if entry is None or entry[0] is not value:
+        entry = widths[id(value)] = (value, compute(value))
+    return entry[1]
+
+def _memoize_widths(on):
+    global _running
+    with _running_lock:
+        _running += 1 if on else -1
+        for module, original in _ORIGINALS.items():
+            module.value_bits_sign = _value_bits_sign if _running else original
+
+class SimSoC(Module):
+    def __init__(self, modules, address_map):
+        # the adapters use ResetSignal(), so sys needs a (never asserted) reset
+        self.clock_domains.cd_sys = ClockDomain()
+        for name, module in modules.items():
+            setattr(self.submodules, name, module)
+        self.submodules.csrbankarray = csr_bus.CSRBankArray(self, address_map,
+                                                            data_width=32,
+                                                            address_width=ADDRESS_WIDTH,
+                                                            paging=PAGING)
+        self.bus = csr_bus.Interface(data_width=32, address_width=ADDRESS_WIDTH)
+        self.submodules.csrcon = csr_bus.Interconnect(self.bus, self.csrbankarray.get_buses())
+
+class CommSim():
+
+    def __init__(self, modules=None, csr_csv="csr.csv", vcd_name=None, debug=False, lanes=1, queue_depth=0, perf=False, pop=False,
+                 job=False, stream=False):
+        self.debug = debug
+        self.vcd_name = vcd_name
+        modules = default_modules(lanes, queue_depth, perf, pop, job, stream) if modules is None else modules
+        # the DMA endpoints of the module that has them, for SimDMA
+        self.endpoints = next(((getattr(m, "sink", None), getattr(m, "source", None)) for m in modules.values()
+                               if hasattr(m, "sink") or hasattr(m, "source")), None)
+
+        # keep the hardware's bank numbers, put anything else in free banks
+        hw = CSRTable(csr_csv if csr_csv is not None and os.path.exists(csr_csv) else None)
+        banks = {name: base//PAGING for name, base in hw.bases.items()}
+        free = (n for n in range(2**ADDRESS_WIDTH*4//PAGING) if n not in banks.values())
+        for name in modules:
+            if name not in banks:
+                banks[name] = next(free)
+        address_map = lambda name, memory: banks.get(name) if memory is None else None
+
+        self.soc = SimSoC(modules, address_map)
+
+        # same layout rules as litex's csr.csv export
+        self.table = table = CSRTable(None)
+        table.constants.update(hw.constants)
+        for name, csrs, mapaddr, rmap in self.soc.csrbankarray.banks:
+            origin = mapaddr*PAGING
+            table.bases[name] = origin
+            offset = 0
+            for csr in csrs:
+                nwords = (csr.size + 31)//32
+                reg_name = f"{name}_{csr.name}"
+                # a status register that takes writes (like an EventManager's
+                # pending) has an r, and litex exports it rw
+                mode = "ro" if isinstance(csr, CSRStatus) and not hasattr(csr, "r") else "rw"
+                table.regs[reg_name] = CSRRegister(reg_name, origin + 4*offset, nwords, mode)
+                offset += nwords
+
+        self.bases = SimpleNamespace(**table.bases)
+        self.constants = SimpleNamespace(**table.constants)
+        self.regs = SimpleNamespace(**{name: Register(reg, *address_accessors(reg, self.read, self.write))
+                                       for name, reg in table.regs.items()})
+
+        self._requests = queue.Queue()
+        self._responses = queue.Queue()
+        self._thread = None
+        self.cycles = 0
+
+    def _driver(self):
+        bus = self.soc.bus
+        while True:
+            op = self._requests.get()
+            if op is None:
+                return
+            # a whole multi-word access at a time
+            kind, adr, dat = op
+            if kind == "stream":
+                data, cycles = yield from _stream(*self.endpoints, adr, dat)
+                self.cycles += cycles
+                self._responses.put(data)
+                continue
+            if kind == "write":
+                for i, value in enumerate(dat):
+                    yield from _bus_write(bus, adr + i, value)
+                    self.cycles += 2
+            else:
+                data = []
+                for i in range(dat):
+                    data.append((yield from _bus_read(bus, adr + i)))
+                    self.cycles += 2
+                self._responses.put(data)
+
+    def _run(self):
+        _local.widths = {}
+        _memoize_widths(True)
+        try:
+            run_simulation(self.soc, [self._driver()], vcd_name=self.vcd_name)
+        except BaseException as e:
+            self._responses.put(e)
+            raise
+        finally:
+            _memoize_widths(False)
+            del _local.widths
+
+    def enable(self):
+        pass
+
+    def open(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._requests.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def stream(self, words, n):
+        # push words into the DMA sink and take up to n from the source;
+        # fewer if they stopped coming
+        assert self.endpoints is not None, "no module with DMA endpoints"
+        self._requests.put(("stream", list(words), n))
+        data = self._responses.get()
+        if isinstance(data, BaseException):
+            raise RuntimeError("simulation stopped") from data
+        return data
+
+    # same address-based interface as CommPCIe
+    def read(self, addr, length=None, burst="incr"):
+        self._requests.put(("read", addr//4, 1 if length is None else length))
+        data = self._responses.get()
+        if isinstance(data, BaseException):
+            raise RuntimeError("simulation stopped") from data
+        if self.debug:
+            for i, value in enumerate(data):
+                print("read 0x{:08x} @ 0x{:08x}".format(value, addr + 4*i))
+        return data[0] if length is None else data
+
+    def write(self, addr, data):
+        data = data if isinstance(data, list) else [data]
+        if self.debug:
+            for i, value in enumerate(data):
+                print("write 0x{:08x} @ 0x{:08x}".format(value, addr + 4*i))
+        self._requests.put(("write", addr//4, data))
+
+class SimDMA():
+    # pcie_dma0 for a CommSim: what bsREPL.stream and job readback use of
+    # dma.DMA, with every exchange pushed through the adapter's endpoints
+    # in one request. Arrays go as whole buffers of stream words, first
+    # byte in the low bits, like the DMA moves them; there are no rings,
+    # so nothing under- or overflows.
+
+    def __init__(self, comm, buffer_size=64, timeout=1.0):
+        self.comm = comm
+        sink, source = comm.endpoints
+        self.word = len((sink if sink is not None else source).data)//8
+        assert buffer_size % self.word == 0, "buffers of whole stream words"
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.underflows = self.overflows = 0
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    def loopback(self, on=True):
+        assert not on, "no loopback in the simulation"
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def exchange(self, send=None, recv=None):
+        size, word = self.buffer_size, self.word
+        words = []
+        if send is not None:
+            data = np.ascontiguousarray(send).reshape(-1).view(np.uint8).tobytes()
+            data += bytes(-len(data) % size)
+            words = [int.from_bytes(data[i:i + word], "little") for i in range(0, len(data), word)]
+        n = 0 if recv is None else -(-recv.nbytes//size)*size//word
+        got = self.comm.stream(words, n)
+        if len(got) < n:
+            raise TimeoutError(f"DMA stalled: received {len(got)*word//size}/{n*word//size} buffers")
+        if recv is not None:
+            data = b"".join(w.to_bytes(word, "little") for w in got)
+            recv[...] = np.frombuffer(data, dtype=np.uint8)[:recv.nbytes].view(recv.dtype).reshape(recv.shape)
+        return recv
+
+    def send(self, array):
+        self.exchange(send=array)
+
+    def recv_into(self, array):
+        return self.exchange(recv=array)
+
+
+import unittest
+
+class TestCommSim(unittest.TestCase):
+
+    def test_modes(self):
+        # as litex exports them: ev_pending is a status register that takes
+        # writes
+        regs = CommSim().regs
+        self.assertEqual([regs.bsREPL_ev_status.mode, regs.bsREPL_ev_pending.mode, regs.bsREPL_ev_enable.mode],
+                         ["ro", "rw", "rw"])
+
+    def test_widths(self):
+        # memoized while sims run, each its own, and put back after the
+        # last. Another test's sim (device.dev) may be running already.
+        before = [module.value_bits_sign for module in _ORIGINALS]
+        from bsREPL import bsREPL, _sim
+        a, b = _sim(), _sim()
+        repls = [bsREPL(a), bsREPL(b)]
+        for repl in repls:
+            self.assertEqual(repl.call("collatz_submit", "collatz_get", 27), 111)
+        self.assertIs(migen.sim.core.value_bits_sign, _value_bits_sign)
+        a.close()
+        self.assertIs(migen.fhdl.bitcontainer.value_bits_sign, _value_bits_sign)
+        self.assertEqual(repls[1].call("collatz_submit", "collatz_get", 6), 8)
+        b.close()
+        self.assertEqual([module.value_bits_sign for module in _ORIGINALS], before)
@@ -0,0 +1,76 @@
+import csv
+from collections import namedtuple
+
+# flat view of a LiteX csr.csv, loaded once. Comm backends compile their
+# register accessors from this instead of going through litex's CSRBuilder.
+
+CSRRegister = namedtuple("CSRRegister", ["name", "addr", "length", "mode"])
+MemoryRegion = namedtuple("MemoryRegion", ["name", "origin", "size", "type"])
+
+def _constant(value):
+    # same conversion litex's CSRBuilder applies to constants
+    if value == "None":
+        return None
+    try:
+        return int(value, 0)
+    except ValueError:
+        return value
+
+class Register():
+    # what comm.regs.<name> holds: the csr.csv row plus compiled accessors
+    __slots__ = ["name", "addr", "length", "mode", "read", "write"]
+
+    def __init__(self, reg, read, write):
+        self.name, self.addr, self.length, self.mode = reg
+        self.read = read
+        self.write = write
+
+def address_accessors(reg, read, write, busword=32):
+    # read/write closures for one register on top of an address-based
+    # read(addr, length) / write(addr, data) comm, splitting it into words
+    # msw first like litex does.
+    addr, length = reg.addr, reg.length
+    mask = 2**busword - 1
+    shifts = [busword*(length - 1 - n) for n in range(length)]
+    if length == 1:
+        def reg_read():
+            return read(addr)
+        def reg_write(value):
+            write(addr, value & mask)
+    else:
+        def reg_read():
+            value = 0
+            for word in read(addr, length=length):
+                value = (value << busword) | word
+            return value
+        def reg_write(value):
+            write(addr, [(value >> s) & mask for s in shifts])
+
+    if reg.mode not in ["rw", "wo"]:
+        def reg_write(value, name=reg.name):
+            raise KeyError(name + " register not writable")
+    return reg_read, reg_write
+
+class CSRTable():
+
+    def __init__(self, csr_csv="csr.csv"):
+        self.bases = bases = {}
+        self.regs = regs = {}
+        self.constants = constants = {}
+        self.mems = mems = {}
+
+        if csr_csv is None:
+            return
+        with open(csr_csv) as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith("#"):
+                    continue
+                kind, name = row[0], row[1]
+                if kind == "csr_base":
+                    bases[name] = int(row[2], 0)
+                elif kind == "csr_register":
+                    regs[name] = CSRRegister(name, int(row[2], 0), int(row[3]), row[4])
+                elif kind == "constant":
+                    constants[name] = _constant(row[2])
+                elif kind == "memory_region":
+                    mems[name] = MemoryRegion(name, int(row[2], 0), int(row[3]), row[4])
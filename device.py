@@ -1,51 +1,155 @@
-from litex.tools.remote.comm_pcie import CommPCIe
+import os
+from functools import lru_cache
 from pprint import pprint as p
-import pint
-ureg = pint.UnitRegistry()
+from csr_table import CSRTable
+import profiler
 
 def vp(i):
     p(vars(i))
 
 
-bar = "03:00.0"
-comm = CommPCIe(bar, debug=False, csr_csv="csr.csv")
-comm.enable(); comm.open()
+# the card's PCI address; BSREPL_BAR picks one of several, see pool.py
+bar = os.environ.get("BSREPL_BAR", "03:00.0")
+csr_csv = "csr.csv"
+
+# Nothing is opened at import time: `comm`, `dev` and `ureg` are created on
+# first access (from device import dev, or device.dev), so importing this
+# for the bsREPL stubs or a single xadc read doesn't pay for litex, pint or
+# the PCIe open up front.
+
+def open_comm(kind=None, bar=bar):
+    # BSREPL_COMM=mmap selects the direct mmap backend, BSREPL_COMM=sim the
+    # simulated gateware (no card needed), with BSREPL_LANES bsREPL lanes
+    # and BSREPL_QUEUE_DEPTH deep queues, perf counters if BSREPL_PERF=1 and
+    # read-to-pop registers if BSREPL_POP=1 (narrow ones of n bits with n > 1)
+    # and batch jobs on a simulated SDRAM if BSREPL_JOB=1
+    kind = os.environ.get("BSREPL_COMM", "pcie") if kind is None else kind
+    if kind == "mmap":
+        from comm_mmap import CommMMAP
+        comm = CommMMAP(bar, debug=False, csr_csv=csr_csv)
+    elif kind == "sim":
+        from comm_sim import CommSim
+        pop = os.environ.get("BSREPL_POP", "0")
+        comm = CommSim(csr_csv=csr_csv,
+                       lanes=int(os.environ.get("BSREPL_LANES", 1)),
+                       queue_depth=int(os.environ.get("BSREPL_QUEUE_DEPTH", 0)),
+                       perf=os.environ.get("BSREPL_PERF", "0") == "1",
+                       pop={"0": False, "1": True}[pop] if pop in ["0", "1"] else int(pop),
+                       job=os.environ.get("BSREPL_JOB", "0") == "1")
+    else:
+        from litex.tools.remote.comm_pcie import CommPCIe
+        comm = CommPCIe(bar, debug=False, csr_csv=csr_csv)
+    comm.enable(); comm.open()
+    # BSREPL_PROFILE=1 times every register access, see profiler.py
+    prof = profiler.from_env()
+    if prof is not None:
+        prof.instrument_comm(comm)
+    # BSREPL_TRACE=path records every register access there, see regtrace.py
+    if os.environ.get("BSREPL_TRACE"):
+        import regtrace
+        regtrace.from_env(comm)
+    return comm
+
+def read_ident(comm):
+    # identifier_mem holds one character per 32-bit word, nul terminated
+    base = comm.bases.identifier_mem
+    chars = []
+    for i in range(256):
+        c = comm.read(base + 4*i) & 0xff
+        if c == 0:
+            break
+        chars.append(chr(c))
+    return "".join(chars)
+
+@lru_cache(maxsize=None)
+def get_ureg():
+    import pint
+    return pint.UnitRegistry()
+
+def __getattr__(name):
+    if name == "comm":
+        value = open_comm()
+    elif name == "dev":
+        value = Device(globals()["comm"] if "comm" in globals() else __getattr__("comm"))
+    elif name == "ureg":
+        value = get_ureg()
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
 
 
 # import code; from pprint import pprint as p; code.InteractiveConsole(locals=dict(globals(), **locals())).interact()
 
 class FilteredDevice():
-    
+
     def __init__(self, comm):
         self.comm = comm
 
     def __getattr__(self, attr):
         return self.comm.regs.__getattr__(attr).read()
-    
+
     @property
     def ident(self):
-        return self.comm.read_str(self.comm.bases.identifier_mem)
-    
+        return read_ident(self.comm)
+
     @property
     def temp(self):
+        ureg = get_ureg()
         val = self.comm.regs.xadc_temperature.read()
         t = ureg.Quantity((val*503.975/4096 - 273.15), ureg.degC)
         return t
-    
+
     def __getattr__(self, key):
         return getattr(self.comm.regs, key).read()
-        
+
     def __setattr__(self, key, value):
         if key == "comm":
             object.__setattr__(self, key, value)
             return
         return getattr(self.comm.regs, key).write(value)
 
-dev = FilteredDevice(comm)
+@lru_cache(maxsize=None)
+def device_class(names):
+    # Same surface as FilteredDevice, but with one property per register
+    # generated up front. The instance holds the comm's read/write
+    # callables in register order, so dev.<reg> is a slot lookup, an index
+    # and the call - no name resolution per access.
+    names = list(names)
+
+    def register(i):
+        def get(self):
+            return self._read[i]()
+        def set(self, value):
+            self._write[i](value)
+        return property(get, set)
+
+    def __init__(self, comm):
+        self.comm = comm
+        regs = [getattr(comm.regs, name) for name in names]
+        self._read = [reg.read for reg in regs]
+        self._write = [reg.write for reg in regs]
+
+    namespace = {"__slots__": ("comm", "_read", "_write"),
+                 "__init__": __init__,
+                 "names": names,
+                 "ident": FilteredDevice.ident,
+                 "temp": FilteredDevice.temp}
+    for i, name in enumerate(names):
+        namespace[name] = register(i)
+    return type("Device", (), namespace)
+
+def Device(comm, csr_csv=csr_csv):
+    # registers from the comm's own table when it has one (mmap, sim),
+    # otherwise from csr.csv
+    table = comm.table if hasattr(comm, "table") else CSRTable(csr_csv)
+    return device_class(tuple(table.regs))(comm)
 
 if __name__ == "__main__":
+    comm = open_comm()
+    dev = Device(comm)
     vp(comm)
     print(dev.ident)
     print(dev.temp)
     import IPython
-    IPython.embed()
\ No newline at end of file
+    IPython.embed()
@@ -0,0 +1,487 @@
+import os
+import mmap
+import time
+import fcntl
+import ctypes
+import select
+import argparse
+import tempfile
+import numpy as np
+
+# Host side of pcie_dma0, through the litepcie kernel driver.
+#
+# The driver owns the DMA buffers and programs pcie_dma0's descriptor
+# tables with their bus addresses; we lock the channel, mmap its buffer
+# rings and view them as NumPy arrays (count x buffer_size bytes), so data
+# is moved by the card straight into / out of the arrays we hand around.
+# The reader (host -> card) and writer (card -> host) each run around their
+# ring continuously; hw_count is how many buffers the card has done,
+# sw_count how many we have filled (reader) or consumed (writer), and the
+# *_UPDATE ioctls tell the driver our sw_count.
+#
+#   with DMA() as dma:
+#       dma.loopback(True)
+#       dma.exchange(data, out)           # send data, receive into out
+#       for buf in dma.buffers(16): ...   # zero-copy views of received buffers
+#
+# FileDMA is the same class over a file mapping with the card emulated in
+# loopback, for tests and machines without the card:
+#
+#   python dma.py loopback [--file] [-n 4096]
+
+DEVICE = os.environ.get("BSREPL_DMA", "/dev/litepcie0")
+
+# litepcie.h
+_LITEPCIE_IOCTL = ord("S")
+
+def _ioc(direction, nr, struct):
+    # asm-generic encoding: dir 2 bits, size 14, type 8, nr 8
+    return (direction << 30) | (ctypes.sizeof(struct) << 16) | (_LITEPCIE_IOCTL << 8) | nr
+
+_IOW, _IOR, _IOWR = 1, 2, 3
+
+class _Loopback(ctypes.Structure):
+    _fields_ = [("loopback_enable", ctypes.c_uint8)]
+
+class _Channel(ctypes.Structure):
+    _fields_ = [("enable", ctypes.c_uint8), ("hw_count", ctypes.c_int64), ("sw_count", ctypes.c_int64)]
+
+class _MmapInfo(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint64) for name in ["tx_offset", "tx_size", "tx_count",
+                                                     "rx_offset", "rx_size", "rx_count"]]
+
+class _Update(ctypes.Structure):
+    _fields_ = [("sw_count", ctypes.c_int64)]
+
+class _Lock(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint8) for name in ["reader_request", "writer_request",
+                                                    "reader_release", "writer_release",
+                                                    "reader_status", "writer_status"]]
+
+IOCTL_DMA = _ioc(_IOW, 20, _Loopback)
+IOCTL_DMA_WRITER = _ioc(_IOWR, 21, _Channel)
+IOCTL_DMA_READER = _ioc(_IOWR, 22, _Channel)
+IOCTL_MMAP_DMA_INFO = _ioc(_IOR, 24, _MmapInfo)
+IOCTL_LOCK = _ioc(_IOWR, 25, _Lock)
+IOCTL_MMAP_DMA_WRITER_UPDATE = _ioc(_IOW, 26, _Update)
+IOCTL_MMAP_DMA_READER_UPDATE = _ioc(_IOW, 27, _Update)
+
+# descriptor flags, in the upper word of a table value next to the length
+DMA_IRQ_DISABLE = 1 << 24
+DMA_LAST_DISABLE = 1 << 25
+
+class DMATable():
+    # CSR-level view of one descriptor table of pcie_dma0. The driver
+    # programs the tables for DMA; this is for watching them, and for
+    # programming them directly when the bus addresses are known some other
+    # way.
+
+    def __init__(self, comm, direction, name="pcie_dma0"):
+        regs = comm.regs
+        prefix = f"{name}_{direction}"
+        self._enable = getattr(regs, f"{prefix}_enable")
+        self._value = getattr(regs, f"{prefix}_table_value")
+        self._we = getattr(regs, f"{prefix}_table_we")
+        self._loop_prog_n = getattr(regs, f"{prefix}_table_loop_prog_n")
+        self._loop_status = getattr(regs, f"{prefix}_table_loop_status")
+        self._level = getattr(regs, f"{prefix}_table_level")
+        self._flush = getattr(regs, f"{prefix}_table_flush")
+
+    def enable(self, on=True):
+        self._enable.write(int(on))
+
+    def level(self):
+        # descriptors in the table
+        return self._level.read()
+
+    def loop_status(self):
+        # (loops done, descriptor index); with a table of n descriptors the
+        # card has done loops*n + index buffers
+        status = self._loop_status.read()
+        return status >> 16, status & 0xffff
+
+    def program(self, descriptors, loop=True, irq_every=1):
+        # descriptors: (bus address, length) pairs. With loop the card goes
+        # around them until disabled, otherwise each is done once.
+        self.enable(False)
+        self._flush.write(1)
+        self._loop_prog_n.write(0)
+        for i, (address, length) in enumerate(descriptors):
+            flags = DMA_LAST_DISABLE | (DMA_IRQ_DISABLE if i % irq_every else 0)
+            self._value.write(((flags | length) << 32) | (address & 0xffffffff))
+            self._we.write(address >> 32)
+        self._loop_prog_n.write(int(loop))
+
+class DMA():
+
+    def __init__(self, device=DEVICE, comm=None, timeout=1.0):
+        self.device = device
+        # optional, for status(): the tables' CSRs
+        self.comm = comm
+        # seconds without progress before a transfer gives up
+        self.timeout = timeout
+        self.reader_hw = self.reader_sw = 0
+        self.writer_hw = self.writer_sw = 0
+        self.reader_enabled = self.writer_enabled = False
+        # buffers the card read before we filled them / wrote before we
+        # consumed them; either means data was lost
+        self.underflows = self.overflows = 0
+        self.fd = None
+
+    def open(self):
+        if self.fd is not None:
+            return self
+        self.fd = os.open(self.device, os.O_RDWR | os.O_CLOEXEC)
+        lock = _Lock(reader_request=1, writer_request=1)
+        fcntl.ioctl(self.fd, IOCTL_LOCK, lock)
+        if not (lock.reader_status and lock.writer_status):
+            self._unlock(lock.reader_status, lock.writer_status)
+            os.close(self.fd)
+            self.fd = None
+            raise OSError(f"{self.device}: DMA channel in use")
+        info = _MmapInfo()
+        fcntl.ioctl(self.fd, IOCTL_MMAP_DMA_INFO, info)
+        self._map(info)
+        return self
+
+    def _unlock(self, reader=True, writer=True):
+        fcntl.ioctl(self.fd, IOCTL_LOCK, _Lock(reader_release=int(reader), writer_release=int(writer)))
+
+    def _map(self, info):
+        # tx is what the card's reader takes, rx what its writer fills
+        self.buffer_size = info.tx_size
+        self.count = info.tx_count
+        self._tx_map = mmap.mmap(self.fd, info.tx_size*info.tx_count, mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE, offset=info.tx_offset)
+        self._rx_map = mmap.mmap(self.fd, info.rx_size*info.rx_count, mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE, offset=info.rx_offset)
+        self.tx = np.frombuffer(self._tx_map, dtype=np.uint8).reshape(info.tx_count, info.tx_size)
+        self.rx = np.frombuffer(self._rx_map, dtype=np.uint8).reshape(info.rx_count, info.rx_size)
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.stop()
+        del self.tx, self.rx # views must go before the maps can close
+        self._tx_map.close()
+        self._rx_map.close()
+        self._unlock()
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # driver interface, replaced by FileDMA
+
+    def _channel(self, request, enable):
+        channel = _Channel(enable=int(enable))
+        fcntl.ioctl(self.fd, request, channel)
+        return channel.hw_count, channel.sw_count
+
+    def _update(self, request, sw_count):
+        fcntl.ioctl(self.fd, request, _Update(sw_count=sw_count))
+
+    def _wait(self, events, timeout):
+        poll = select.poll()
+        poll.register(self.fd, events)
+        poll.poll(timeout*1e3)
+
+    def loopback(self, on=True):
+        fcntl.ioctl(self.fd, IOCTL_DMA, _Loopback(loopback_enable=int(on)))
+
+    def _sync(self):
+        # enabling a stopped channel restarts both counts at 0
+        self.writer_hw, sw = self._channel(IOCTL_DMA_WRITER, self.writer_enabled)
+        if not self.writer_enabled:
+            self.writer_sw = sw
+        self.reader_hw, sw = self._channel(IOCTL_DMA_READER, self.reader_enabled)
+        if not self.reader_enabled:
+            self.reader_sw = sw
+
+    def start(self):
+        # the writer runs from here on; the reader only once there is data
+        # for it, see exchange
+        self.writer_enabled = True
+        self._sync()
+
+    def stop(self):
+        self.reader_enabled = self.writer_enabled = False
+        self._sync()
+
+    def status(self):
+        status = {"reader_hw": self.reader_hw, "reader_sw": self.reader_sw,
+                  "writer_hw": self.writer_hw, "writer_sw": self.writer_sw,
+                  "underflows": self.underflows, "overflows": self.overflows}
+        if self.comm is not None:
+            for direction in ["reader", "writer"]:
+                table = DMATable(self.comm, direction)
+                status[f"{direction}_table_level"] = table.level()
+                status[f"{direction}_loop"] = table.loop_status()
+        return status
+
+    def _fill(self, src, first, n):
+        # copy buffers first.. of src into the tx ring, at reader_sw on
+        size = self.buffer_size
+        while n:
+            slot = self.reader_sw % self.count
+            k = min(n, self.count - slot)
+            chunk = src[first*size:(first + k)*size]
+            flat = self.tx[slot:slot + k].reshape(-1)
+            flat[:len(chunk)] = chunk
+            flat[len(chunk):] = 0 # pad a short last buffer
+            self.reader_sw += k
+            first += k
+            n -= k
+
+    def _drain(self, dst, first, n):
+        # copy n buffers from the rx ring at writer_sw into dst
+        size = self.buffer_size
+        while n:
+            slot = self.writer_sw % self.count
+            k = min(n, self.count - slot)
+            chunk = dst[first*size:(first + k)*size]
+            chunk[:] = self.rx[slot:slot + k].reshape(-1)[:len(chunk)]
+            self.writer_sw += k
+            first += k
+            n -= k
+
+    def exchange(self, send=None, recv=None):
+        # stream send to the card and fill recv from it, interleaved so a
+        # loopback of more than a ring's worth doesn't stall. Both are
+        # any arrays, taken as bytes in C order; a short last buffer is
+        # zero-padded on the way out. A recv that isn't contiguous is filled
+        # through a contiguous copy, as a flat view of it would be a copy
+        # the data never left.
+        src = None if send is None else np.ascontiguousarray(send).reshape(-1).view(np.uint8)
+        target = None
+        if recv is not None and not recv.flags.c_contiguous:
+            target, recv = recv, np.empty(recv.shape, dtype=recv.dtype)
+        dst = None if recv is None else recv.reshape(-1).view(np.uint8)
+        size = self.buffer_size
+        n_out = 0 if src is None else -(-len(src)//size)
+        n_in = 0 if dst is None else -(-len(dst)//size)
+        if n_in and not self.writer_enabled:
+            self.start()
+        out = got = 0
+        last = time.monotonic()
+        while out < n_out or got < n_in:
+            self._sync()
+            progress = False
+
+            if out < n_out:
+                if self.reader_enabled and self.reader_hw > self.reader_sw:
+                    self.underflows += self.reader_hw - self.reader_sw
+                # keep half the ring between us and the card, like the driver
+                k = min(self.count//2 - (self.reader_sw - self.reader_hw), n_out - out)
+                if k > 0:
+                    self._fill(src, out, k)
+                    out += k
+                    self._update(IOCTL_MMAP_DMA_READER_UPDATE, self.reader_sw)
+                    if not self.reader_enabled:
+                        self.reader_enabled = True
+                        self._channel(IOCTL_DMA_READER, True)
+                    progress = True
+
+            if got < n_in:
+                k = self.writer_hw - self.writer_sw
+                if k > self.count:
+                    # the card lapped us, those are gone
+                    self.overflows += k - self.count
+                    self.writer_sw = self.writer_hw - self.count
+                    k = self.count
+                k = min(k, n_in - got)
+                if k > 0:
+                    self._drain(dst, got, k)
+                    got += k
+                    self._update(IOCTL_MMAP_DMA_WRITER_UPDATE, self.writer_sw)
+                    progress = True
+
+            if progress:
+                last = time.monotonic()
+            elif time.monotonic() - last > self.timeout:
+                raise TimeoutError(f"DMA stalled: sent {out}/{n_out}, received {got}/{n_in} buffers")
+            else:
+                self._wait((select.POLLOUT if out < n_out else 0) | (select.POLLIN if got < n_in else 0), 0.1)
+        if target is not None:
+            target[...] = recv
+            return target
+        return recv
+
+    def send(self, array):
+        self.exchange(send=array)
+
+    def recv_into(self, array):
+        return self.exchange(recv=array)
+
+    def buffers(self, n=None):
+        # received buffers as they arrive, without copying: each is a view
+        # into the ring and only valid until the next one is asked for
+        if not self.writer_enabled:
+            self.start()
+        got = 0
+        last = time.monotonic()
+        while n is None or got < n:
+            self._sync()
+            if self.writer_hw - self.writer_sw > self.count:
+                self.overflows += self.writer_hw - self.writer_sw - self.count
+                self.writer_sw = self.writer_hw - self.count
+            if self.writer_hw == self.writer_sw:
+                if time.monotonic() - last > self.timeout:
+                    raise TimeoutError(f"DMA stalled after {got} buffers")
+                self._wait(select.POLLIN, 0.1)
+                continue
+            yield self.rx[self.writer_sw % self.count]
+            self.writer_sw += 1
+            self._update(IOCTL_MMAP_DMA_WRITER_UPDATE, self.writer_sw)
+            got += 1
+            last = time.monotonic()
+
+    def loopback_test(self, n=1024, seed=0):
+        # n buffers of random bytes around the loopback; returns the
+        # buffers that came back different and the throughput
+        data = np.random.default_rng(seed).integers(0, 256, n*self.buffer_size, dtype=np.uint8)
+        out = np.empty_like(data)
+        self.loopback(True)
+        self.start()
+        t = time.perf_counter()
+        self.exchange(data, out)
+        t = time.perf_counter() - t
+        self.stop()
+        self.loopback(False)
+        errors = int((data.reshape(n, -1) != out.reshape(n, -1)).any(axis=1).sum())
+        return {"buffers": n, "errors": errors, "seconds": t,
+                "gbps": 8*data.nbytes/t/1e9, "underflows": self.underflows, "overflows": self.overflows}
+
+class FileDMA(DMA):
+    # the rings in a file (a temporary one by default) and the card
+    # emulated on every sync: the reader takes whatever was submitted and,
+    # in loopback, the writer puts it in the rx ring. Unlike the card the
+    # emulation waits for room rather than overflowing.
+
+    def __init__(self, path=None, buffer_size=8192, count=256, timeout=1.0):
+        DMA.__init__(self, device=path, timeout=timeout)
+        self.buffer_size = buffer_size
+        self.count = count
+        self._loopback = False
+        self._submitted = 0 # reader sw_count as last told
+
+    def open(self):
+        if self.fd is not None:
+            return self
+        if self.device is None:
+            self._file = tempfile.TemporaryFile()
+            self.fd = os.dup(self._file.fileno())
+            self._file.close()
+        else:
+            self.fd = os.open(self.device, os.O_RDWR | os.O_CREAT, 0o644)
+        # the rx ring starts on a page, as mmap offsets must
+        ring = self.buffer_size*self.count
+        ring += -ring % mmap.ALLOCATIONGRANULARITY
+        os.ftruncate(self.fd, 2*ring)
+        self._map(_MmapInfo(tx_offset=0, tx_size=self.buffer_size, tx_count=self.count,
+                            rx_offset=ring, rx_size=self.buffer_size, rx_count=self.count))
+        return self
+
+    def _unlock(self, reader=True, writer=True):
+        pass
+
+    def loopback(self, on=True):
+        self._loopback = on
+
+    def _channel(self, request, enable):
+        if request == IOCTL_DMA_READER:
+            if not enable:
+                self._reader_hw = self._submitted = 0
+                return 0, 0
+            while self._reader_hw < self._submitted:
+                if self._loopback and self.writer_enabled:
+                    if self._writer_hw - self.writer_sw >= self.count:
+                        break # rx ring full
+                    self.rx[self._writer_hw % self.count] = self.tx[self._reader_hw % self.count]
+                    self._writer_hw += 1
+                self._reader_hw += 1
+            return self._reader_hw, self._submitted
+        if not enable:
+            self._writer_hw = 0
+            return 0, 0
+        # the writer only moves with the reader
+        self._channel(IOCTL_DMA_READER, self.reader_enabled)
+        return self._writer_hw, self.writer_sw
+
+    def _update(self, request, sw_count):
+        if request == IOCTL_MMAP_DMA_READER_UPDATE:
+            self._submitted = sw_count
+
+    def _wait(self, events, timeout):
+        pass
+
+    _reader_hw = _writer_hw = 0
+
+
+import unittest
+
+class TestFileDMA(unittest.TestCase):
+
+    def setUp(self):
+        self.dma = FileDMA(buffer_size=256, count=10).open()
+
+    def tearDown(self):
+        self.dma.close()
+
+    def test_loopback(self):
+        # several rings' worth and a short last buffer
+        result = self.dma.loopback_test(n=100)
+        self.assertEqual(result["errors"], 0)
+        data = np.arange(1000, dtype=np.uint32)
+        out = np.zeros_like(data)
+        self.dma.loopback(True)
+        self.dma.start()
+        self.dma.exchange(data, out)
+        self.assertTrue((data == out).all())
+
+    def test_strided(self):
+        # a strided recv gets the data too, and a strided send goes as C order
+        data = np.arange(512, dtype=np.uint16).reshape(16, 32)
+        out = np.zeros((16, 64), dtype=np.uint16)
+        self.dma.loopback(True)
+        self.dma.start()
+        self.assertIs(self.dma.exchange(data[:, ::-1], out[:, ::2]).base, out)
+        self.assertTrue((out[:, ::2] == data[:, ::-1]).all())
+        self.assertFalse(out[:, 1::2].any())
+
+    def test_buffers(self):
+        self.dma.loopback(True)
+        self.dma.start()
+        data = np.arange(4*256, dtype=np.uint8)
+        self.dma.send(data)
+        got = [buf.copy() for buf in self.dma.buffers(4)]
+        self.assertTrue((np.concatenate(got) == data).all())
+
+    def test_timeout(self):
+        # nothing is sent, so nothing comes back
+        self.dma.timeout = 0.01
+        with self.assertRaises(TimeoutError):
+            self.dma.recv_into(np.zeros(256, dtype=np.uint8))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pcie_dma0 from Python")
+    parser.add_argument("command", choices=["loopback", "status"])
+    parser.add_argument("-n", type=int, default=4096, help="loopback: buffers to send")
+    parser.add_argument("--file", action="store_true", help="use the file-backed stand-in")
+    parser.add_argument("--device", default=DEVICE)
+    args = parser.parse_args()
+
+    if args.command == "status":
+        from device import comm
+        with DMA(args.device, comm=comm) as dma:
+            print(dma.status())
+    else:
+        with (FileDMA() if args.file else DMA(args.device)) as dma:
+            result = dma.loopback_test(args.n)
+        print(f"{result['buffers']} buffers, {result['errors']} errors, {result['gbps']:.2f} Gbps"
+              f" ({result['underflows']} underflows, {result['overflows']} overflows)")
@@ -0,0 +1,201 @@
+import time
+import argparse
+import numpy as np
+from waiters import CallTimeout, Deadline
+from bsREPL import stream_dtype
+
+# Batch jobs: the card computes a whole range of arguments on its own.
+#
+# A job runs the adapter's stream method pair (see bsREPL._add_job) over
+# start, start + stride, ... for count arguments, with the values generated
+# on the card, and writes the results to the card's SDRAM in bulk. The host
+# only starts it and waits - polling the status register, or blocking on
+# the job event when the repl's waiter has an interrupt - and then reads the
+# results back as a NumPy array, over the DMA writer if the repl has a
+# dma.DMA, otherwise through a CSR a port word at a time.
+#
+#   job = launch(repl, start=5, count=1000000)
+#   job.wait()
+#   steps = job.results()
+#
+#   python job.py -n 100000              (BSREPL_COMM=sim BSREPL_JOB=1 without a card)
+
+def _regs(repl):
+    comm, modname = repl._comm, repl.modname
+    return lambda name: getattr(comm.regs, f"{modname}_job_{name}_csr")
+
+def launch(repl, start, count, stride=1, address=0):
+    # start a job; address is the byte offset in the SDRAM for its results
+    assert repl.jobs, "adapter built without batch jobs"
+    reg = _regs(repl)
+    word = 4*reg("readback_data").length
+    assert address % word == 0, f"results have to start on a {word} byte boundary"
+    if reg("status").read() & 1:
+        raise RuntimeError("a job is already running")
+    submit, get = repl.stream_methods
+    width, = [m[1] for m in repl.interface.actionmethods if m[3] == submit]
+    mask = (1 << width) - 1
+    reg("start").write(start & mask)
+    reg("stride").write(stride & mask)
+    reg("count").write(count)
+    reg("base").write(address)
+    reg("control").write(1)
+    return Job(repl, start, count, stride, address)
+
+class Job():
+
+    def __init__(self, repl, start, count, stride, address):
+        self.repl = repl
+        self.start = start
+        self.count = count
+        self.stride = stride
+        self.address = address
+        self._reg = _regs(repl)
+        # the results are packed in the port's words, as in the DMA stream
+        self.word = 4*self._reg("readback_data").length
+        (type, width), = [m[:2] for m in repl.interface.actionvaluemethods if m[2] == repl.stream_methods[1]]
+        self.dtype = stream_dtype(type, width)
+
+    def poll(self):
+        # done yet?
+        return bool(self._reg("status").read() & 1 << 1)
+
+    def progress(self):
+        # results collected from the lanes so far
+        return self._reg("progress").read()
+
+    def wait(self):
+        # until done. With a timeout on the repl, a job that collects no
+        # results for that long is diagnosed and recovered like a call.
+        repl = self.repl
+        irq = getattr(repl._waiter, "irq", None)
+        deadline = Deadline(repl.timeout)
+        progress = self.progress() if repl.timeout is not None else 0
+        while not self.poll():
+            if irq is not None:
+                try:
+                    irq.wait(self.poll, repl._job_event, deadline)
+                except CallTimeout:
+                    pass
+            if deadline.expired():
+                collected = self.progress()
+                if collected == progress:
+                    try:
+                        repl._expired(*repl._pair_names(*repl.stream_methods))
+                    except CallTimeout as e:
+                        e.method = "job"
+                        e.args = (f"job at {collected}/{self.count}: {e.args[0]}",)
+                        raise
+                progress = collected
+                deadline.restart()
+        return self
+
+    def nbytes(self):
+        return -(-self.count*self.dtype.itemsize//self.word)*self.word
+
+    def results(self, dma=None):
+        # the results as an array, read back from the SDRAM
+        assert self.poll(), "job not done"
+        dma = self.repl.dma if dma is None else dma
+        data = self._read_dma(dma) if dma is not None else self._read_csr()
+        return data[:self.count*self.dtype.itemsize].view(self.dtype)
+
+    def _readback(self, words, how):
+        self._reg("readback_base").write(self.address)
+        self._reg("readback_count").write(words)
+        self._reg("control").write(how)
+
+    def _read_csr(self):
+        # a word at a time; reading the data register pops it
+        words = self.nbytes()//self.word
+        status, data = self._reg("status"), self._reg("readback_data")
+        out = bytearray()
+        self._readback(words, 2)
+        deadline = Deadline(self.repl.timeout)
+        for _ in range(words):
+            while not status.read() & 1 << 3:
+                if deadline.expired():
+                    raise CallTimeout(f"job readback: no data in {self.repl.timeout}s", method="job")
+            out += data.read().to_bytes(self.word, "little")
+            deadline.restart()
+        return np.frombuffer(bytes(out), dtype=np.uint8)
+
+    def _read_dma(self, dma):
+        # the DMA writer moves whole buffers, so read back that much more;
+        # it is only SDRAM past the results
+        total = -(-self.nbytes()//dma.buffer_size)*dma.buffer_size
+        out = np.empty(total, dtype=np.uint8)
+        dma.loopback(False)
+        dma.start()
+        try:
+            self._readback(total//self.word, 4)
+            dma.recv_into(out)
+        finally:
+            dma.stop()
+        return out
+
+def run(repl, start, count, stride=1, address=0):
+    # launch, wait and read back in one go
+    return launch(repl, start, count, stride, address).wait().results()
+
+
+import unittest
+
+class TestJob(unittest.TestCase):
+
+    def test_job(self):
+        from bsREPL import bsREPL, _collatz, _sim
+        comm = _sim(job=True)
+        repl = bsREPL(comm, timeout=2)
+        self.assertTrue(repl.jobs)
+        # an odd count, so the last word is padded
+        job = launch(repl, 5, 7, stride=3, address=64).wait()
+        self.assertEqual(job.progress(), 7)
+        self.assertEqual(job.results().tolist(), [_collatz(n) for n in range(5, 5 + 3*7, 3)])
+        # and the adapter still takes single calls
+        self.assertEqual(repl.call("collatz_submit", "collatz_get", 27), 111)
+        self.assertEqual(run(repl, 1, 0).size, 0)
+        comm.close()
+
+    def test_read_dma(self):
+        from bsREPL import bsREPL, _collatz, _sim
+        from comm_sim import SimDMA
+        comm = _sim(job=True)
+        # 16 byte words, 32 byte buffers: 7 results take two buffers, and
+        # the DMA reads back past them
+        dma = SimDMA(comm, buffer_size=32)
+        repl = bsREPL(comm, timeout=2, dma=dma)
+        job = launch(repl, 5, 7, stride=3, address=64).wait()
+        self.assertEqual(job._read_dma(dma).size, 64)
+        self.assertEqual(job.results().tolist(), [_collatz(n) for n in range(5, 5 + 3*7, 3)])
+        # the CSR readback finds the same SDRAM
+        self.assertEqual(job._read_csr().tobytes(), job._read_dma(dma)[:job.nbytes()].tobytes())
+        comm.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run a batch job of collatz_submit/collatz_get on the card")
+    parser.add_argument("-n", type=int, default=100000, help="arguments")
+    parser.add_argument("--start", type=int, default=5)
+    parser.add_argument("--stride", type=int, default=1)
+    parser.add_argument("--dma", action="store_true", help="read the results back over DMA")
+    args = parser.parse_args()
+
+    from device import open_comm
+    from bsREPL import bsREPL
+    comm = open_comm()
+    dma = None
+    if args.dma:
+        from dma import DMA
+        dma = DMA(comm=comm)
+        dma.open()
+    repl = bsREPL(comm, dma=dma)
+    comm.regs.bsREPL_reset.write(1)
+    t = time.perf_counter()
+    job = launch(repl, args.start, args.n, args.stride).wait()
+    t_run = time.perf_counter() - t
+    results = job.results()
+    t_read = time.perf_counter() - t - t_run
+    print(f"{args.n} calls in {t_run:.3f}s ({args.n/t_run:.0f} calls/s), read back in {t_read:.3f}s")
+    print(f"max {results.max()} at {args.start + args.stride*int(results.argmax())}")
+    comm.close()
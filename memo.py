@@ -0,0 +1,134 @@
+import os
+import json
+from collections import OrderedDict
+
+# Result caches for pure bsREPL method pairs.
+#
+# A Memo is a bounded LRU of argument -> result for one submit/get pair.
+# map() answers what it can from the cache and hands the rest, each
+# distinct argument once, to the hardware in one batch. Caches can be kept
+# in a JSON file between sessions; the file records the bitstream's
+# identifier (identifier_mem), and is ignored once that changes, since the
+# results may have come from a different design.
+#
+#   repl = bsREPL(comm, pure=True, memo_path="build/memo.json")
+#   repl.map("collatz_submit", "collatz_get", values)   # misses only go out
+#   repl.memo_stats()
+
+_MISS = object()
+
+class Memo():
+
+    def __init__(self, maxsize=1 << 20, items=()):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.computed = 0 # arguments sent to the hardware
+        for key, value in items:
+            self.store(key, value)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def store(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def lookup(self, key, default=None):
+        value = self._cache.get(key, _MISS)
+        if value is _MISS:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return value
+
+    def map(self, keys, compute):
+        # results for keys, in order; compute gets the distinct missing keys
+        # as a list and returns their results in the same order
+        results = []
+        missing = {} # key -> positions in results
+        for key in keys:
+            value = self._cache.get(key, _MISS)
+            if value is _MISS:
+                missing.setdefault(key, []).append(len(results))
+                self.misses += 1
+            else:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            results.append(value)
+        if missing:
+            computed = compute(list(missing))
+            self.computed += len(missing)
+            for (key, positions), value in zip(missing.items(), computed):
+                self.store(key, value)
+                for i in positions:
+                    results[i] = value
+        return results
+
+    def clear(self):
+        self._cache.clear()
+
+    def items(self):
+        return list(self._cache.items())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self._cache), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses, "computed": self.computed,
+                "hit_rate": self.hits/lookups if lookups else 0}
+
+def load(path, ident):
+    # {name: [(key, value), ...]} from a memo file, empty if there is none
+    # or it was written against another bitstream
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if data.get("ident") != ident:
+        return {}
+    return {name: [(key, value) for key, value in items] for name, items in data["memos"].items()}
+
+def save(path, ident, memos):
+    # memos: {name: Memo}. Oldest entries first, so loading keeps the order.
+    data = {"ident": ident, "memos": {name: memo.items() for name, memo in memos.items()}}
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # a temporary file of our own, so processes saving at once don't mix
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+import unittest
+
+class TestMemo(unittest.TestCase):
+
+    def test_map(self):
+        sent = []
+        def compute(keys):
+            sent.append(keys)
+            return [k*k for k in keys]
+        memo = Memo(maxsize=3)
+        self.assertEqual(memo.map([1, 2, 2, 3], compute), [1, 4, 4, 9])
+        self.assertEqual(sent, [[1, 2, 3]])
+        self.assertEqual(memo.map([3, 4], compute), [9, 16])
+        self.assertEqual(memo.map([1], compute), [1])
+        self.assertEqual(sent[1:], [[4], [1]]) # 1 was the least recently used
+        self.assertEqual(len(memo), 3)
+        self.assertEqual(memo.stats()["computed"], 5)
+
+    def test_persist(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "memo.json")
+            memo = Memo(items=[(5, 5), (27, 111)])
+            save(path, "ident a", {"collatz_submit/collatz_get": memo})
+            self.assertEqual(load(path, "ident a"), {"collatz_submit/collatz_get": [(5, 5), (27, 111)]})
+            self.assertEqual(load(path, "ident b"), {})
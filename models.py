@@ -0,0 +1,152 @@
+from migen import *
+from migen.genlib.fifo import SyncFIFO
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import AutoCSR, CSRStatus, CSRStorage
+
+# Migen models of the BSV user modules, with the same ports as the verilog
+# bsc generates for them. bsREPL / CustomAdder take one as `model=` in place
+# of the verilog Instance, so the adapters can run in Migen's simulator.
+# XADCModel and MSIModel stand in for the registers of the XADC and
+# litepcie's MSI cores the same way.
+
+class CollatzServerModel(Module):
+    # mkCollatzServer from CollatzServer.bsv: 2-deep mkFIFO request and
+    # response queues around a one-step-per-cycle collatz iteration.
+    def __init__(self, depth=2):
+        self.RST_N = Signal()
+        self.collatz_submit_n = Signal((64, True))
+        self.EN_collatz_submit = Signal()
+        self.RDY_collatz_submit = Signal()
+        self.collatz_get = Signal((64, True))
+        self.EN_collatz_get = Signal()
+        self.RDY_collatz_get = Signal()
+
+        self.submodules.req = req = ResetInserter()(SyncFIFO(64, depth))
+        self.submodules.resp = resp = ResetInserter()(SyncFIFO(64, depth))
+
+        iteration_count = Signal((64, True))
+        value = Signal((64, True))
+        running = Signal()
+
+        start = Signal()
+        enditer = Signal()
+
+        self.comb += [
+            req.reset.eq(~self.RST_N),
+            resp.reset.eq(~self.RST_N),
+
+            # methods
+            # not ready while held in reset, or the request would be dropped
+            self.RDY_collatz_submit.eq(req.writable & self.RST_N),
+            req.din.eq(self.collatz_submit_n),
+            req.we.eq(self.EN_collatz_submit),
+            self.RDY_collatz_get.eq(resp.readable & self.RST_N),
+            self.collatz_get.eq(resp.dout),
+            resp.re.eq(self.EN_collatz_get),
+
+            # rule guards
+            start.eq(~running & req.readable),
+            enditer.eq(running & (value == 1) & resp.writable),
+            req.re.eq(start),
+            resp.we.eq(enditer),
+            resp.din.eq(iteration_count),
+        ]
+
+        self.sync += [
+            If(~self.RST_N,
+               running.eq(0),
+               value.eq(0),
+               iteration_count.eq(0),
+            ).Elif(start,
+               running.eq(1),
+               value.eq(req.dout),
+               iteration_count.eq(0),
+            ).Elif(enditer,
+               running.eq(0),
+            ).Elif(running & (value > 1),
+               iteration_count.eq(iteration_count + 1),
+               If(value[0],
+                  value.eq((3*value) + 1)
+               ).Else(
+                  value.eq(value >> 1)
+               )
+            )
+        ]
+
+class BsAdderModel(Module):
+    # mkBsAdder from BsAdder.bsv
+    def __init__(self):
+        self.RST_N = Signal()
+        self.reply_x = Signal(32)
+        self.reply_y = Signal(32)
+        self.reply = Signal(32)
+
+        self.comb += self.reply.eq(self.reply_x + self.reply_y)
+
+class DRAMPortModel(Module):
+    # one side of a LiteDRAM native port (cmd, wdata, rdata endpoints in
+    # port-width words), served from `mem`; a command at a time, reads
+    # answered the cycle after.
+    def __init__(self, mem, we):
+        self.data_width = dw = mem.width
+        self.address_width = aw = log2_int(mem.depth)
+        self.cmd = stream.Endpoint([("we", 1), ("addr", aw)])
+        self.wdata = stream.Endpoint([("data", dw), ("we", dw//8)])
+        self.rdata = stream.Endpoint([("data", dw)])
+
+        addr = Signal(aw)
+        busy = Signal()
+        if we:
+            port = mem.get_port(write_capable=True)
+            self.specials += port
+            self.comb += [self.cmd.ready.eq(~busy),
+                          self.wdata.ready.eq(busy),
+                          port.adr.eq(addr),
+                          port.dat_w.eq(self.wdata.data),
+                          port.we.eq(self.wdata.valid & busy)]
+            self.sync += If(self.cmd.valid & self.cmd.ready,
+                            addr.eq(self.cmd.addr),
+                            busy.eq(1)
+                         ).Elif(self.wdata.valid & self.wdata.ready,
+                            busy.eq(0))
+        else:
+            port = mem.get_port(async_read=True)
+            self.specials += port
+            self.comb += [self.cmd.ready.eq(~busy),
+                          port.adr.eq(addr),
+                          self.rdata.valid.eq(busy),
+                          self.rdata.data.eq(port.dat_r)]
+            self.sync += If(self.cmd.valid & self.cmd.ready,
+                            addr.eq(self.cmd.addr),
+                            busy.eq(1)
+                         ).Elif(self.rdata.valid & self.rdata.ready,
+                            busy.eq(0))
+
+class DRAMModel(Module):
+    # the SDRAM behind a write and a read crossbar port, as bsREPL's job
+    # mode gets them: `ports` is (write, read)
+    def __init__(self, data_width=128, depth=1024):
+        self.specials.mem = Memory(data_width, depth)
+        self.submodules.write_port = DRAMPortModel(self.mem, we=True)
+        self.submodules.read_port = DRAMPortModel(self.mem, we=False)
+        self.ports = (self.write_port, self.read_port)
+
+class XADCModel(Module, AutoCSR):
+    # the registers telemetry.py reads off litex's XADC core. Every channel
+    # counts up a code per cycle from its own offset, so samples are in
+    # order, and a sequence ends every 8 cycles, for 4 of them.
+    def __init__(self, channels=("temperature", "vccint", "vccaux", "vccbram")):
+        count = Signal(12)
+        self.sync += count.eq(count + 1)
+        for i, channel in enumerate(channels):
+            csr = CSRStatus(12, name=channel)
+            setattr(self, channel, csr)
+            self.comb += csr.status.eq(count + (i << 8))
+        self.eos = CSRStatus()
+        self.comb += self.eos.status.eq(count[2])
+
+class MSIModel(Module, AutoCSR):
+    # the enable register of litepcie's MSI core, which BsREPLIRQ sets its
+    # vector in; put it on CommSim as "pcie_msi"
+    def __init__(self, width=32):
+        self.enable = CSRStorage(width)
@@ -0,0 +1,261 @@
+import os
+import glob
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+
+# Several cards in one host, used as one.
+#
+# discover() finds the cards' PCIe functions. A Pool opens a comm and a
+# bsREPL on each, checks that they all run the same bitstream
+# (identifier_mem), and map() spreads a batch over them: the values are cut
+# into chunks, and each card's worker takes the next chunk as soon as its
+# card is done with the last, so a faster card takes more of the batch.
+# Results come back in input order; stats() has each card's share and
+# throughput for the last map.
+#
+# The workers are threads by default. With processes=True each card gets a
+# process of its own that opens the comm, for when one interpreter's GIL
+# caps the rate of all the cards together.
+#
+#   pool = Pool.open()                   (every card found, BSREPL_COMM backend)
+#   steps = pool.map("collatz_submit", "collatz_get", range(5, 1000000))
+#   pool.stats()
+#
+#   python pool.py                       (benchmark every card)
+#   python pool.py --sim 3               (three simulated ones)
+
+XILINX = 0x10ee
+
+def discover(vendor=XILINX, device=None):
+    # PCI addresses of the functions with a BAR0 matching vendor and, if
+    # given, device id, in bus order. BSREPL_BARS (comma separated)
+    # overrides the scan.
+    if "BSREPL_BARS" in os.environ:
+        return os.environ["BSREPL_BARS"].split(",")
+    found = []
+    for path in sorted(glob.glob("/sys/bus/pci/devices/*")):
+        try:
+            ids = [int(open(f"{path}/{name}").read(), 16) for name in ["vendor", "device"]]
+        except (OSError, ValueError):
+            continue
+        if ids[0] == vendor and device in [None, ids[1]] and os.path.exists(f"{path}/resource0"):
+            found.append(os.path.basename(path))
+    return found
+
+def _ident(comm):
+    from device import read_ident
+    return read_ident(comm) if hasattr(comm.bases, "identifier_mem") else ""
+
+def _open(kind, bar):
+    from device import open_comm
+    return open_comm(kind) if bar is None else open_comm(kind, bar)
+
+def _repl(comm, repl_args):
+    from bsREPL import bsREPL
+    repl = bsREPL(comm, **repl_args)
+    comm.regs.bsREPL_reset.write(1)
+    return repl
+
+class _ThreadCard():
+    # a card driven from this process
+
+    def __init__(self, name, comm, repl_args):
+        self.name = name
+        self.comm = comm
+        self.ident = _ident(comm)
+        self.repl = _repl(comm, repl_args)
+
+    def map(self, submit, get, values):
+        return self.repl.map(submit, get, values)
+
+    def close(self):
+        self.comm.close()
+
+def _serve(conn, kind, bar, repl_args):
+    # a card's process: open it, report the ident, then run maps
+    try:
+        comm = _open(kind, bar)
+        repl = _repl(comm, repl_args)
+        conn.send((_ident(comm), None))
+    except Exception as e:
+        conn.send((None, repr(e)))
+        return
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        try:
+            conn.send((repl.map(*request), None))
+        except Exception as e:
+            conn.send((None, repr(e)))
+    comm.close()
+
+class _ProcessCard():
+    # a card driven from a process of its own, over a pipe
+
+    def __init__(self, name, kind, bar, repl_args):
+        self.name = name
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child, kind, bar, repl_args), daemon=True)
+        self._process.start()
+        self.ident = self._reply()
+
+    def _reply(self):
+        result, error = self._conn.recv()
+        if error is not None:
+            raise RuntimeError(f"{self.name}: {error}")
+        return result
+
+    def map(self, submit, get, values):
+        self._conn.send((submit, get, list(values)))
+        return self._reply()
+
+    def close(self):
+        self._conn.send(None)
+        self._process.join()
+
+def check_idents(cards):
+    # all cards have to run the same bitstream, or map's results would
+    # depend on which card a value went to
+    idents = {card.name: card.ident for card in cards}
+    if len(set(idents.values())) > 1:
+        raise RuntimeError("cards run different bitstreams:\n  " +
+                           "\n  ".join(f"{name}: {ident!r}" for name, ident in idents.items()))
+
+class Pool():
+
+    def __init__(self, cards, kind=None, processes=False, chunk=4096, **repl_args):
+        # cards: open comms, or PCI addresses (None for one more simulated
+        # card with kind="sim") to open with device.open_comm. repl_args
+        # go to each card's bsREPL.
+        self.chunk = chunk
+        self.cards = []
+        self._stats = {}
+        try:
+            for i, card in enumerate(cards):
+                name = card if isinstance(card, str) else f"card{i}"
+                if processes:
+                    assert card is None or isinstance(card, str), "processes open their own comms"
+                    self.cards.append(_ProcessCard(name, kind, card, repl_args))
+                else:
+                    if card is None or isinstance(card, str):
+                        card = _open(kind, card)
+                    self.cards.append(_ThreadCard(name, card, repl_args))
+            check_idents(self.cards)
+        except Exception:
+            self.close()
+            raise
+
+    @classmethod
+    def open(cls, kind=None, **kwargs):
+        # every card discover() finds
+        bars = discover()
+        if not bars:
+            raise RuntimeError("no cards found")
+        return cls(bars, kind=kind, **kwargs)
+
+    @property
+    def ident(self):
+        return self.cards[0].ident
+
+    def close(self):
+        for card in self.cards:
+            card.close()
+        self.cards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def map(self, submit, get, values, chunk=None):
+        # submit/get for every value, spread over the cards, results in order
+        values = list(values)
+        chunk = self.chunk if chunk is None else chunk
+        chunks = queue.Queue()
+        for start in range(0, len(values), chunk):
+            chunks.put(start)
+        results = [None]*len(values)
+        errors = []
+        stats = {card.name: {"calls": 0, "chunks": 0, "seconds": 0.0} for card in self.cards}
+
+        def work(card):
+            s = stats[card.name]
+            while not errors:
+                try:
+                    start = chunks.get_nowait()
+                except queue.Empty:
+                    return
+                part = values[start:start + chunk]
+                t = time.perf_counter()
+                try:
+                    results[start:start + len(part)] = card.map(submit, get, part)
+                except Exception as e:
+                    errors.append(RuntimeError(f"{card.name}: {e!r}"))
+                    return
+                s["seconds"] += time.perf_counter() - t
+                s["calls"] += len(part)
+                s["chunks"] += 1
+
+        t = time.perf_counter()
+        workers = [threading.Thread(target=work, args=(card,)) for card in self.cards]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        t = time.perf_counter() - t
+        if errors:
+            raise errors[0]
+        for s in stats.values():
+            s["calls_per_s"] = s["calls"]/s["seconds"] if s["seconds"] else 0
+        stats["total"] = {"calls": len(values), "seconds": t, "calls_per_s": len(values)/t if t else 0}
+        self._stats = stats
+        return results
+
+    def stats(self):
+        # per card and in total, for the last map
+        return self._stats
+
+
+import unittest
+
+class TestPool(unittest.TestCase):
+
+    def test_map(self):
+        from bsREPL import _collatz, _sim
+        comms = [_sim(), _sim(queue_depth=2)]
+        with Pool(comms, chunk=7) as pool:
+            values = range(5, 50)
+            self.assertEqual(pool.map("collatz_submit", "collatz_get", values), [_collatz(n) for n in values])
+            stats = pool.stats()
+            self.assertEqual(sum(stats[f"card{i}"]["calls"] for i in range(2)), 45)
+            self.assertEqual(stats["total"]["calls"], 45)
+
+    def test_idents(self):
+        from types import SimpleNamespace as card
+        check_idents([card(name="a", ident="x"), card(name="b", ident="x")])
+        with self.assertRaises(RuntimeError):
+            check_idents([card(name="a", ident="x"), card(name="b", ident="y")])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="spread bsREPL calls over every card")
+    parser.add_argument("--sim", type=int, default=0, help="use this many simulated cards instead")
+    parser.add_argument("--processes", action="store_true", help="one process per card instead of a thread")
+    parser.add_argument("-n", type=int, default=100000, help="calls")
+    parser.add_argument("--chunk", type=int, default=4096, help="values a card takes at a time")
+    args = parser.parse_args()
+
+    if args.sim:
+        pool = Pool([None]*args.sim, kind="sim", processes=args.processes, chunk=args.chunk)
+    else:
+        pool = Pool.open(processes=args.processes, chunk=args.chunk)
+    with pool:
+        print(f"{len(pool.cards)} cards running {pool.ident!r}")
+        pool.map("collatz_submit", "collatz_get", range(5, 5 + args.n))
+        for name, s in pool.stats().items():
+            print(f"{name:14} {s['calls']:8} calls {s['calls_per_s']:12.0f} calls/s")
@@ -0,0 +1,275 @@
+import os
+import sys
+import time
+import atexit
+
+# Host-side profiling of register traffic, opt-in.
+#
+# A Profiler swaps the read/write callables of every comm.regs.<name> for
+# timed ones, and the methods of a bsREPL instance for ones that record a
+# span per call: its time, the register reads and writes it made, and how
+# many polls of the handshake came back not-ready (spins; only seen when
+# the repl has a waiter - stub calls show their polls as reads). Nothing is
+# patched until it's installed, so with profiling off the access path is
+# exactly what it was - no flag checks per access.
+#
+#   prof = Profiler()
+#   prof.instrument_comm(comm)      # before Device(comm), which binds the
+#   prof.instrument_repl(repl)      # accessors when it's created
+#   ...
+#   print(prof.report())
+#   prof.remove()
+#
+# or BSREPL_PROFILE=1 to have device.open_comm and bsREPL install one and
+# print the report at exit.
+
+HIST_BUCKETS = 64 # log2(ns) buckets
+
+active = None
+
+def from_env():
+    # the process-wide profiler if BSREPL_PROFILE is set
+    global active
+    if active is None and os.environ.get("BSREPL_PROFILE", "0") not in ["", "0"]:
+        active = Profiler()
+        atexit.register(lambda: print(active.report(), file=sys.stderr))
+    return active
+
+def _bucket_ns(bucket):
+    # upper bound of a log2 bucket
+    return (1 << bucket) - 1
+
+def _percentile(hist, count, q):
+    seen = 0
+    for bucket, n in enumerate(hist):
+        seen += n
+        if seen > q*count:
+            return _bucket_ns(bucket)
+    return _bucket_ns(len(hist) - 1)
+
+class _Timing():
+    __slots__ = ["count", "ns", "hist"]
+
+    def __init__(self):
+        self.count = 0
+        self.ns = 0
+        self.hist = [0]*HIST_BUCKETS
+
+    def add(self, ns):
+        self.count += 1
+        self.ns += ns
+        self.hist[min(ns.bit_length(), HIST_BUCKETS - 1)] += 1
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count,
+                "total_us": self.ns/1e3,
+                "mean_us": self.ns/self.count/1e3,
+                "p50_us": _percentile(self.hist, self.count, 0.50)/1e3,
+                "p99_us": _percentile(self.hist, self.count, 0.99)/1e3}
+
+class _Span(_Timing):
+    __slots__ = ["reads", "writes", "spins"]
+
+    def __init__(self):
+        _Timing.__init__(self)
+        self.reads = self.writes = self.spins = 0
+
+class Profiler():
+
+    def __init__(self):
+        self.reads = {}   # register name -> _Timing
+        self.writes = {}
+        self.spans = {}   # method name -> _Span
+        # running totals, spans record the difference over a call
+        self.n_reads = 0
+        self.n_writes = 0
+        self.n_spins = 0
+        self._patched = [] # (object, attribute, original or None)
+
+    def _patch(self, obj, attr, fn):
+        # None: attribute came from the class, delete ours to restore
+        own = attr in getattr(obj, "__dict__", {}) or attr in getattr(type(obj), "__slots__", ())
+        self._patched.append((obj, attr, getattr(obj, attr) if own else None))
+        setattr(obj, attr, fn)
+
+    def remove(self):
+        for obj, attr, original in reversed(self._patched):
+            if original is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, original)
+        self._patched = []
+
+    def instrument_comm(self, comm):
+        clock = time.perf_counter_ns
+        for name, reg in vars(comm.regs).items():
+            reads = self.reads.setdefault(name, _Timing())
+            writes = self.writes.setdefault(name, _Timing())
+
+            def read(read=reg.read, reads=reads):
+                self.n_reads += 1
+                t = clock()
+                v = read()
+                reads.add(clock() - t)
+                return v
+
+            def write(value, write=reg.write, writes=writes):
+                self.n_writes += 1
+                t = clock()
+                write(value)
+                writes.add(clock() - t)
+
+            self._patch(reg, "read", read)
+            self._patch(reg, "write", write)
+
+        # address-level access, for anything bound to comm.read/write after
+        # this (stubgen's stubs). The register accessors above already hold
+        # the originals, so nothing is counted twice.
+        names = {reg.addr: name for name, reg in vars(comm.regs).items()}
+
+        def comm_read(addr, length=None, *args, read=comm.read, **kwargs):
+            self.n_reads += 1
+            t = clock()
+            v = read(addr, length, *args, **kwargs)
+            self.reads.setdefault(names.get(addr, f"{addr:#x}"), _Timing()).add(clock() - t)
+            return v
+
+        def comm_write(addr, data, *args, write=comm.write, **kwargs):
+            self.n_writes += 1
+            t = clock()
+            write(addr, data, *args, **kwargs)
+            self.writes.setdefault(names.get(addr, f"{addr:#x}"), _Timing()).add(clock() - t)
+
+        self._patch(comm, "read", comm_read)
+        self._patch(comm, "write", comm_write)
+        return comm
+
+    def instrument_repl(self, repl):
+        clock = time.perf_counter_ns
+
+        # count the polls that came back not ready
+        waiter = repl._waiter
+        def wait(ready, event=None, wait=waiter.wait):
+            def counted():
+                ok = ready()
+                if not ok:
+                    self.n_spins += 1
+                return ok
+            return wait(counted, event)
+        self._patch(waiter, "wait", wait)
+
+        names = list(repl._events)
+        if repl.lanes > 1:
+            names += repl._method_names()
+        names += [f"{name}_many" for name in names] + ["map"]
+        for name in names:
+            span = self.spans.setdefault(name, _Span())
+
+            def call(*args, fn=getattr(repl, name), span=span, **kwargs):
+                reads, writes, spins = self.n_reads, self.n_writes, self.n_spins
+                t = clock()
+                result = fn(*args, **kwargs)
+                span.add(clock() - t)
+                span.reads += self.n_reads - reads
+                span.writes += self.n_writes - writes
+                span.spins += self.n_spins - spins
+                return result
+
+            self._patch(repl, name, call)
+        return repl
+
+    def registers(self):
+        # per register counts and timings, most total time first
+        rows = []
+        for name in dict.fromkeys(list(self.reads) + list(self.writes)):
+            r, w = self.reads.get(name, _Timing()), self.writes.get(name, _Timing())
+            if r.count or w.count:
+                rows.append((r.ns + w.ns, name, r.summary(), w.summary()))
+        rows.sort(reverse=True)
+        return [(name, read, write) for _, name, read, write in rows]
+
+    def calls(self):
+        rows = {}
+        for name, span in self.spans.items():
+            if span.count:
+                rows[name] = dict(span.summary(),
+                                  reads_per_call=span.reads/span.count,
+                                  writes_per_call=span.writes/span.count,
+                                  spins_per_call=span.spins/span.count)
+        return rows
+
+    def report(self, top=20):
+        total = sum(t.ns for t in self.reads.values()) + sum(t.ns for t in self.writes.values())
+        lines = [f"register access: {self.n_reads} reads, {self.n_writes} writes, {total/1e3:.0f}us"]
+        lines.append(f"  {'register':48} {'reads':>8} {'mean':>8} {'p99':>8} {'writes':>8} {'mean':>8} {'share':>6}")
+        for name, r, w in self.registers()[:top]:
+            ns = r.get("total_us", 0) + w.get("total_us", 0)
+            lines.append(f"  {name:48} {r['count']:8} {r.get('mean_us', 0):7.2f}u {r.get('p99_us', 0):7.2f}u "
+                         f"{w['count']:8} {w.get('mean_us', 0):7.2f}u {ns*1e3/total if total else 0:6.1%}")
+        calls = self.calls()
+        if calls:
+            lines.append(f"  {'call':48} {'calls':>8} {'mean':>8} {'p99':>8} {'reads':>8} {'writes':>8} {'spins':>8}")
+            for name, c in sorted(calls.items(), key=lambda kv: -kv[1]["total_us"]):
+                lines.append(f"  {name:48} {c['count']:8} {c['mean_us']:7.2f}u {c['p99_us']:7.2f}u "
+                             f"{c['reads_per_call']:8.1f} {c['writes_per_call']:8.1f} {c['spins_per_call']:8.1f}")
+        return "\n".join(lines)
+
+
+import unittest
+
+class TestProfiler(unittest.TestCase):
+
+    def test_off_and_on(self):
+        from unittest import mock
+        from comm_sim import CommSim
+        from bsREPL import bsREPL, _collatz, _sim
+        comm = _sim()
+        names = ["collatz_submit", "collatz_get", "map"]
+        with mock.patch.dict(os.environ, {"BSREPL_PROFILE": "0"}):
+            self.assertIsNone(from_env())
+            repl = bsREPL(comm)
+        # off, the accessors and methods are the plain ones
+        def plain():
+            return ([comm.read, comm.write] + [getattr(reg, attr) for reg in vars(comm.regs).values()
+                                               for attr in ["read", "write"]] +
+                    [getattr(repl, name) for name in names])
+        before = plain()
+        self.assertEqual(comm.read.__func__, CommSim.read)
+        self.assertNotIn("read", vars(comm))
+
+        prof = Profiler()
+        prof.instrument_comm(comm)
+        prof.instrument_repl(repl)
+        self.assertEqual(repl.map("collatz_submit", "collatz_get", [5, 27]), [5, 111])
+        repl.collatz_submit(n=6)
+        self.assertEqual(repl.collatz_get(), _collatz(6))
+        calls = prof.calls()
+        self.assertEqual((calls["map"]["count"], calls["collatz_get"]["count"]), (1, 1))
+        self.assertGreater(calls["map"]["reads_per_call"], 0)
+        self.assertGreater(prof.n_reads, 0)
+        self.assertIn("bsREPL_collatz_get_ack_csr", [name for name, r, w in prof.registers()])
+
+        # and removed, they are back to exactly those
+        prof.remove()
+        for a, b in zip(plain(), before):
+            self.assertTrue(a is b or a == b, f"{a} is not {b}")
+        self.assertNotIn("read", vars(comm))
+        comm.close()
+
+
+if __name__ == "__main__":
+    # profile a short run of collatz calls
+    from device import open_comm
+    from bsREPL import bsREPL
+    comm = open_comm()
+    prof = Profiler()
+    prof.instrument_comm(comm)
+    repl = prof.instrument_repl(bsREPL(comm))
+    comm.regs.bsREPL_reset.write(1)
+    for n in range(5, 500):
+        repl.collatz_submit(n=n)
+        repl.collatz_get()
+    repl.map("collatz_submit", "collatz_get", range(5, 500))
+    print(prof.report())
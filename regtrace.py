@@ -0,0 +1,387 @@
+import os
+import json
+import time
+import atexit
+import argparse
+import numpy as np
+
+# Register transaction traces: record every CSR access a run makes, and
+# replay it later against another comm (the simulated gateware, another
+# backend or card) as fast as that comm goes.
+#
+# A Recorder patches the comm the way profiler.py does - every
+# comm.regs.<name> accessor, and comm.read/write for the stubs - so
+# everything built on the comm after it's installed (FilteredDevice,
+# bsREPL, ...) is traced. An access costs the host a clock read and a list
+# append; the entries are packed into 17 byte records, one per bus word:
+#
+#   t      u64  ns since the recorder started, as the access completed
+#   addr   u32  bus address of the word, as in csr.csv
+#   value  u32  the word read or written
+#   kind   u8   READ, WRITE, or PHASE (addr indexes the phase names)
+#
+# The file is a JSON header (ident, phase names, register table) and the
+# records as one array. Replay folds each run of reads of one address into
+# a poll: it reads until it sees the value the run ended with, so a faster
+# or slower target doesn't diverge on how often it was polled. Any other
+# read that differs is a divergence; a poll that never completes is a hang
+# and ends the replay.
+#
+#   rec = Recorder(comm)             (or BSREPL_TRACE=run.trace, via device.open_comm)
+#   rec.phase("warmup"); ...; rec.phase("map"); ...
+#   rec.save("run.trace")
+#
+#   python regtrace.py show run.trace
+#   python regtrace.py replay run.trace --comm sim
+
+READ, WRITE, PHASE = 0, 1, 2
+KINDS = {READ: "read", WRITE: "write", PHASE: "phase"}
+
+RECORD = np.dtype([("t", "<u8"), ("addr", "<u4"), ("value", "<u4"), ("kind", "u1")])
+
+MAGIC = b"BSRTRACE"
+
+BUSWORD = 32
+
+def _records(entries):
+    # (t, kind, addr, data, words) entries -> one record per bus word. data
+    # is a register's value (msw at addr, as litex lays them out), or the
+    # list of words of a comm.read
+    mask = 2**BUSWORD - 1
+    t, addr, value, kind = [], [], [], []
+    for ns, k, a, data, words in entries:
+        if isinstance(data, list):
+            values = data
+        elif words == 1:
+            values = [data]
+        else:
+            values = [(data >> BUSWORD*(words - 1 - i)) & mask for i in range(words)]
+        for i, v in enumerate(values):
+            t.append(ns)
+            addr.append(a + 4*i)
+            value.append(v & mask)
+            kind.append(k)
+    records = np.empty(len(t), dtype=RECORD)
+    records["t"], records["addr"], records["value"], records["kind"] = t, addr, value, kind
+    return records
+
+class Recorder():
+
+    def __init__(self, comm, chunk=1 << 20):
+        self.comm = comm
+        # entries are packed into records every chunk accesses
+        self.chunk = chunk
+        from device import read_ident
+        self.ident = read_ident(comm) if hasattr(comm.bases, "identifier_mem") else ""
+        self.registers = {name: (reg.addr, reg.length) for name, reg in vars(comm.regs).items()}
+        self.phases = []
+        self._entries = []
+        self._packed = []
+        self._patched = []
+        self.start = time.perf_counter_ns()
+        self._install()
+
+    def _patch(self, obj, attr, fn):
+        own = attr in getattr(obj, "__dict__", {}) or attr in getattr(type(obj), "__slots__", ())
+        self._patched.append((obj, attr, getattr(obj, attr) if own else None))
+        setattr(obj, attr, fn)
+
+    def remove(self):
+        for obj, attr, original in reversed(self._patched):
+            if original is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, original)
+        self._patched = []
+
+    def _append(self, entry):
+        entries = self._entries
+        entries.append(entry)
+        if len(entries) >= self.chunk:
+            self._pack()
+
+    def _pack(self):
+        self._packed.append(_records(self._entries))
+        self._entries = []
+
+    def _install(self):
+        clock, start, append = time.perf_counter_ns, self.start, self._append
+        comm = self.comm
+        for name, reg in vars(comm.regs).items():
+
+            def read(read=reg.read, addr=reg.addr, words=reg.length):
+                v = read()
+                append((clock() - start, READ, addr, v, words))
+                return v
+
+            def write(value, write=reg.write, addr=reg.addr, words=reg.length):
+                write(value)
+                append((clock() - start, WRITE, addr, value, words))
+
+            self._patch(reg, "read", read)
+            self._patch(reg, "write", write)
+
+        # address-level access, for the stubs and anything else bound to
+        # comm.read/write after this; the accessors above hold the originals
+        def comm_read(addr, length=None, *args, read=comm.read, **kwargs):
+            v = read(addr, length, *args, **kwargs)
+            append((clock() - start, READ, addr, v, 1))
+            return v
+
+        def comm_write(addr, data, *args, write=comm.write, **kwargs):
+            write(addr, data, *args, **kwargs)
+            append((clock() - start, WRITE, addr, data, 1))
+
+        self._patch(comm, "read", comm_read)
+        self._patch(comm, "write", comm_write)
+
+    def phase(self, name):
+        # everything from here to the next phase is timed as name on replay
+        self._append((time.perf_counter_ns() - self.start, PHASE, len(self.phases), 0, 1))
+        self.phases.append(name)
+
+    def records(self):
+        self._pack()
+        return np.concatenate(self._packed) if self._packed else np.empty(0, dtype=RECORD)
+
+    def save(self, path):
+        save(path, self.records(), self.ident, self.phases, self.registers)
+
+
+def save(path, records, ident="", phases=(), registers=None):
+    header = json.dumps({"ident": ident, "phases": list(phases),
+                         "registers": registers or {}, "records": len(records)}).encode()
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        f.write(records.astype(RECORD).tobytes())
+    os.replace(f"{path}.tmp", path)
+
+class Trace():
+
+    def __init__(self, records, ident="", phases=(), registers=None):
+        self.records = records
+        self.ident = ident
+        self.phases = list(phases)
+        self.registers = registers or {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"{path} isn't a trace")
+        n = int.from_bytes(data[len(MAGIC):len(MAGIC) + 4], "little")
+        header = json.loads(data[len(MAGIC) + 4:len(MAGIC) + 4 + n])
+        records = np.frombuffer(data, dtype=RECORD, offset=len(MAGIC) + 4 + n)
+        return cls(records, header["ident"], header["phases"], header["registers"])
+
+    def names(self):
+        # bus address -> register name, with [i] for the later words
+        names = {}
+        for name, (addr, length) in self.registers.items():
+            for i in range(length):
+                names[addr + 4*i] = name if i == 0 else f"{name}[{i}]"
+        return names
+
+    def ops(self):
+        # (kind, addr, value, polls, t): runs of reads of one address folded
+        # into one read of the value the run ended with, polls the rest
+        ops = []
+        records = self.records
+        t, addr, value, kind = (records[f].tolist() for f in ["t", "addr", "value", "kind"])
+        i, n = 0, len(records)
+        while i < n:
+            j = i
+            if kind[i] == READ:
+                while j + 1 < n and kind[j + 1] == READ and addr[j + 1] == addr[i]:
+                    j += 1
+            ops.append((kind[j], addr[j], value[j], j - i, t[j]))
+            i = j + 1
+        return ops
+
+    def summary(self):
+        records = self.records
+        kinds = records["kind"]
+        return {"ident": self.ident,
+                "records": len(records),
+                "reads": int((kinds == READ).sum()),
+                "writes": int((kinds == WRITE).sum()),
+                "phases": self.phases,
+                "seconds": (int(records["t"][-1]) - int(records["t"][0]))/1e9 if len(records) else 0}
+
+
+class Replay():
+
+    def __init__(self, trace, comm, timeout=1.0, ignore=(), max_divergences=100):
+        self.trace = trace
+        self.comm = comm
+        # seconds a folded poll may take on the target before it's a hang
+        self.timeout = timeout
+        # registers whose value isn't expected to repeat (temperatures,
+        # perf counters): prefixes of their names
+        self.ignore = tuple(ignore)
+        self.max_divergences = max_divergences
+
+    def mismatched(self):
+        # registers of the trace the comm has elsewhere, or not at all
+        regs = vars(self.comm.regs)
+        return sorted(name for name, (addr, length) in self.trace.registers.items()
+                      if name not in regs or (regs[name].addr, regs[name].length) != (addr, length))
+
+    def run(self):
+        # replay as fast as the comm goes; returns the report
+        names = self.trace.names()
+        skip = {addr for addr, name in names.items() if name.startswith(self.ignore)} if self.ignore else set()
+        read, write, clock, monotonic = self.comm.read, self.comm.write, time.perf_counter_ns, time.monotonic
+        phase_names = ["-"] + self.trace.phases
+        phases = {name: {"recorded_s": 0.0, "replay_s": 0.0, "reads": 0, "writes": 0,
+                         "polls_recorded": 0, "polls_replayed": 0} for name in phase_names}
+        divergences = []
+        counts = {}
+        hang = None
+
+        ops = self.trace.ops()
+        current = phases["-"]
+        t0 = t_rec = ops[0][4] if ops else 0
+        start = clock()
+        for i, (kind, addr, value, polls, t) in enumerate(ops):
+            if kind == WRITE:
+                write(addr, value)
+                current["writes"] += 1
+                continue
+            if kind == PHASE:
+                now = clock()
+                current["replay_s"] += (now - start)/1e9
+                current["recorded_s"] += (t - t_rec)/1e9
+                start, t_rec = now, t
+                current = phases[phase_names[addr + 1]]
+                continue
+            v = read(addr)
+            current["reads"] += 1
+            if polls:
+                current["polls_recorded"] += polls
+                give_up = monotonic() + self.timeout
+                while v != value:
+                    if monotonic() > give_up:
+                        break
+                    v = read(addr)
+                    current["polls_replayed"] += 1
+                if v != value:
+                    hang = {"op": i, "register": names.get(addr, f"{addr:#x}"), "waiting_for": value, "saw": v}
+                    break
+            if v != value and addr not in skip:
+                name = names.get(addr, f"{addr:#x}")
+                counts[name] = counts.get(name, 0) + 1
+                if len(divergences) < self.max_divergences:
+                    divergences.append({"op": i, "register": name, "recorded": value, "replayed": v})
+        end = clock()
+        current["replay_s"] += (end - start)/1e9
+        current["recorded_s"] += ((ops[i][4] if ops else 0) - t_rec)/1e9
+        return {"ops": len(ops),
+                "mismatched": self.mismatched(),
+                "completed": hang is None,
+                "hang": hang,
+                "divergences": divergences,
+                "divergences_by_register": counts,
+                "phases": {name: p for name, p in phases.items() if p["reads"] or p["writes"] or name != "-"},
+                "recorded_s": ((ops[-1][4] - t0)/1e9) if ops else 0}
+
+
+def from_env(comm):
+    # BSREPL_TRACE=path records everything on comm, saved there at exit
+    path = os.environ.get("BSREPL_TRACE")
+    if not path:
+        return None
+    recorder = Recorder(comm)
+    atexit.register(recorder.save, path)
+    return recorder
+
+
+import unittest
+
+class TestTrace(unittest.TestCase):
+
+    def run_collatz(self, comm, recorder=None):
+        from bsREPL import bsREPL
+        repl = bsREPL(comm)
+        comm.regs.bsREPL_reset.write(1)
+        if recorder:
+            recorder.phase("single")
+        for n in [27, 5, 97]:
+            repl.collatz_submit(n=n)
+            repl.collatz_get()
+        if recorder:
+            recorder.phase("map")
+        return repl.map("collatz_submit", "collatz_get", range(5, 20))
+
+    def test_roundtrip(self):
+        import tempfile
+        from comm_sim import CommSim
+        comm = CommSim()
+        comm.open()
+        rec = Recorder(comm)
+        self.run_collatz(comm, rec)
+        rec.remove()
+        comm.close()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "run.trace")
+            rec.save(path)
+            trace = Trace.load(path)
+        self.assertEqual(trace.phases, ["single", "map"])
+        self.assertTrue(trace.summary()["writes"] > 0)
+
+        comm = CommSim()
+        comm.open()
+        report = Replay(trace, comm).run()
+        self.assertTrue(report["completed"])
+        self.assertEqual(report["divergences"], [])
+        self.assertEqual(set(report["phases"]), {"-", "single", "map"})
+
+        # a result that comes out different
+        records = trace.records.copy()
+        value = trace.registers["bsREPL_collatz_get_value_csr"][0] + 4 # lsw
+        i = np.flatnonzero((records["addr"] == value) & (records["kind"] == READ))[0]
+        records["value"][i] += 1
+        report = Replay(Trace(records, phases=trace.phases, registers=trace.registers), comm).run()
+        self.assertEqual(report["divergences_by_register"], {"bsREPL_collatz_get_value_csr[1]": 1})
+        comm.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="show or replay a register trace")
+    parser.add_argument("command", choices=["show", "replay"])
+    parser.add_argument("trace")
+    parser.add_argument("--comm", default=None, help="replay: comm backend (BSREPL_COMM)")
+    parser.add_argument("--timeout", type=float, default=1.0, help="replay: seconds before a poll is a hang")
+    parser.add_argument("--ignore", nargs="*", default=["xadc_"], help="replay: register name prefixes not compared")
+    args = parser.parse_args()
+
+    trace = Trace.load(args.trace)
+    if args.command == "show":
+        s = trace.summary()
+        print(f"{s['ident']!r}: {s['reads']} reads, {s['writes']} writes over {s['seconds']:.3f}s, "
+              f"phases {', '.join(s['phases']) or '-'}")
+        names = trace.names()
+        addrs, counts = np.unique(trace.records["addr"][trace.records["kind"] != PHASE], return_counts=True)
+        for addr, count in sorted(zip(addrs.tolist(), counts.tolist()), key=lambda ac: -ac[1])[:20]:
+            print(f"  {names.get(addr, f'{addr:#x}'):48} {count:10}")
+    else:
+        from device import open_comm, read_ident
+        comm = open_comm(args.comm)
+        if trace.ident and hasattr(comm.bases, "identifier_mem") and read_ident(comm) != trace.ident:
+            print(f"warning: trace was recorded on {trace.ident!r}")
+        report = Replay(trace, comm, timeout=args.timeout, ignore=args.ignore).run()
+        if report["mismatched"]:
+            print(f"warning: {len(report['mismatched'])} registers are laid out differently here, "
+                  f"e.g. {report['mismatched'][0]}")
+        for name, p in report["phases"].items():
+            print(f"{name:16} recorded {p['recorded_s']*1e3:10.2f}ms  replayed {p['replay_s']*1e3:10.2f}ms  "
+                  f"{p['reads']:8} reads {p['writes']:8} writes  polls {p['polls_recorded']} -> {p['polls_replayed']}")
+        for name, count in report["divergences_by_register"].items():
+            print(f"diverged {count:8}x  {name}")
+        if report["hang"]:
+            print(f"hang at op {report['hang']['op']}: {report['hang']['register']} "
+                  f"never read {report['hang']['waiting_for']:#x} (last {report['hang']['saw']:#x})")
+        comm.close()
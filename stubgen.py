@@ -0,0 +1,314 @@
+import sys
+import hashlib
+import argparse
+from types import SimpleNamespace
+
+# Host stubs for a bsREPL adapter, generated from its BSVInterface.
+#
+# bsREPL's generic call path looks up registers by name and splits values
+# into words on every call. The stubs do all of that once: each method
+# becomes a function of straight-line read/write calls on the comm, with
+# the addresses, word counts and shifts written into the source as
+# constants. The register names come from the same interface and the same
+# naming as the adapter bsREPL._init_HDL builds, and the addresses from the
+# comm's table (csr.csv), so the stubs match the gateware they were built
+# against; `python stubgen.py` checks that against the adapter itself.
+#
+# With deadlines, every poll loop gives up after bind's `timeout` seconds
+# and calls `expired(method name)`, which is expected to raise; bsREPL
+# passes one that diagnoses and recovers the adapter first.
+#
+#   stubs = stubgen.bind(comm, BSVInterface.from_package("CollatzServer.bsv")["Ifc_type"])
+#   stubs.collatz_submit(27); stubs.collatz_get()
+#
+#   python stubgen.py CollatzServer.bsv Ifc_type -o build/collatz_stubs.py
+#
+# The check covers addresses, lengths and modes. When only the adapter
+# changed, --update-csr rewrites its rows of csr.csv from it first; after
+# any change to the SoC, make csr.csv instead.
+
+BUSWORD = 32
+
+def _write(reg, expr):
+    mask = 2**BUSWORD - 1
+    if reg.length == 1:
+        return f"write({reg.addr:#x}, {expr} & {mask:#x})"
+    words = []
+    for i in range(reg.length):
+        shift = BUSWORD*(reg.length - 1 - i)
+        words.append(f"({expr} >> {shift}) & {mask:#x}" if shift else f"{expr} & {mask:#x}")
+    return f"write({reg.addr:#x}, [{', '.join(words)}])"
+
+def _read(reg):
+    # an expression, given `w` holds the words of a multi-word read
+    if reg.length == 1:
+        return None, f"read({reg.addr:#x})"
+    words = " | ".join(f"(w[{i}] << {BUSWORD*(reg.length - 1 - i)})" if i < reg.length - 1 else f"w[{i}]"
+                       for i in range(reg.length))
+    return f"w = read({reg.addr:#x}, {reg.length})", words
+
+def _loop(name, header, body=(), deadline=False):
+    # a poll loop, indented one level; with a deadline it calls expired()
+    # once timeout seconds have passed
+    if not deadline:
+        return [f"    {header}"] + [f"        {line}" for line in body or ["pass"]]
+    return ([f"    give_up = monotonic() + timeout",
+             f"    {header}"] +
+            [f"        {line}" for line in body] +
+            [f"        if monotonic() > give_up:",
+             f"            expired({name!r})"])
+
+def _action(regs, modname, name, arg_name, queue_depth, deadline=False):
+    value = regs[f"{modname}_{name}_{arg_name}_value_csr"]
+    if queue_depth:
+        credits = regs[f"{modname}_{name}_credits_csr"]
+        return ([f"def {name}({arg_name}):"] +
+                _loop(name, f"while not read({credits.addr:#x}): # no room in the queue", deadline=deadline) +
+                [f"    {_write(value, arg_name)}"])
+    trigger = regs[f"{modname}_{name}_trigger_csr"]
+    return ([f"def {name}({arg_name}):"] +
+            _loop(name, f"while read({trigger.addr:#x}): # previous submission not accepted yet", deadline=deadline) +
+            [f"    {_write(value, arg_name)}",
+             f"    write({trigger.addr:#x}, 1)"] +
+            _loop(name, f"while read({trigger.addr:#x}):", deadline=deadline))
+
+def _pop(regs, modname, name, width, deadline=False):
+    # poll the read-to-pop register: the first word carries the valid bit,
+    # the rest are read (the last one taking the value) once it's set
+    pop = regs[f"{modname}_{name}_pop_csr"]
+    valid, mask = 1 << (BUSWORD - 1), 2**width - 1
+    lines = [f"def {name}():",
+             f"    v = read({pop.addr:#x})"]
+    lines += _loop(name, f"while not v & {valid:#x}:", [f"v = read({pop.addr:#x})"], deadline)
+    if width + 1 > BUSWORD*pop.length:
+        # narrow, values that don't fit come through value/ack
+        wide = 1 << (BUSWORD - 2)
+        value, ack = regs[f"{modname}_{name}_value_csr"], regs[f"{modname}_{name}_ack_csr"]
+        words, expr = _read(value)
+        lines += [f"    if v & {wide:#x}: # too wide for it"]
+        if words is not None:
+            lines.append(f"        {words}")
+        lines += [f"        v = {expr}",
+                  f"        write({ack.addr:#x}, 1)",
+                  f"        return v",
+                  f"    return v & {wide - 1:#x}"]
+        return lines
+    if pop.length > 1:
+        lines.append(f"    w = read({pop.addr + 4:#x}, {pop.length - 1})")
+        for i in range(pop.length - 1):
+            lines.append(f"    v = (v << {BUSWORD}) | w[{i}]")
+    lines.append(f"    return v & {mask:#x}")
+    return lines
+
+def _actionvalue(regs, modname, name, width, queue_depth, deadline=False):
+    if f"{modname}_{name}_pop_csr" in regs:
+        return _pop(regs, modname, name, width, deadline)
+    value = regs[f"{modname}_{name}_value_csr"]
+    ack = regs[f"{modname}_{name}_ack_csr"]
+    lines = [f"def {name}():"]
+    if queue_depth:
+        level = regs[f"{modname}_{name}_level_csr"]
+        lines += _loop(name, f"while not read({level.addr:#x}): # queue empty", deadline=deadline)
+    else:
+        lines += _loop(name, f"while read({ack.addr:#x}): # no new value yet", deadline=deadline)
+    words, expr = _read(value)
+    if words is not None:
+        lines.append(f"    {words}")
+    lines += [f"    v = {expr}",
+              f"    write({ack.addr:#x}, 1)",
+              f"    return v"]
+    return lines
+
+def source(interface, regs, modname="bsREPL", lanes=1, queue_depth=0, deadlines=False):
+    # python source of a module with bind(comm, timeout, expired) ->
+    # namespace of the method functions. regs maps register names to
+    # anything with addr and length.
+    lines = [f"# generated by stubgen.py for {interface.name} behind {modname},",
+             f"# {lanes} lane(s), queue depth {queue_depth}{', with deadlines' if deadlines else ''}.",
+             f"# Do not edit; regenerate when csr.csv changes.",
+             "",
+             "from time import monotonic",
+             "from types import SimpleNamespace",
+             "",
+             "def bind(comm, timeout=None, expired=None):",
+             "    read, write = comm.read, comm.write",
+             ""]
+    names = []
+    for lane in range(lanes):
+        prefix = "" if lanes == 1 else f"lane{lane}_"
+        methods = []
+        for type, width, arg_name, method_name in interface.actionmethods:
+            methods.append(_action(regs, modname, f"{prefix}{method_name}", arg_name, queue_depth, deadlines))
+            names.append(f"{prefix}{method_name}")
+        for type, width, method_name in interface.actionvaluemethods:
+            methods.append(_actionvalue(regs, modname, f"{prefix}{method_name}", width, queue_depth, deadlines))
+            names.append(f"{prefix}{method_name}")
+        for method in methods:
+            lines += ["    " + line for line in method] + [""]
+
+    # like bsREPL, the plain names call lane 0
+    aliases = []
+    if lanes > 1:
+        aliases = [(m[3], f"lane0_{m[3]}") for m in interface.actionmethods]
+        aliases += [(m[2], f"lane0_{m[2]}") for m in interface.actionvaluemethods]
+    members = [f"{name}={name}" for name in names] + [f"{alias}={name}" for alias, name in aliases]
+    lines.append(f"    return SimpleNamespace({', '.join(members)})")
+    return "\n".join(lines) + "\n"
+
+_compiled = {}
+
+def compile_source(text):
+    key = hashlib.sha256(text.encode()).hexdigest()
+    if key not in _compiled:
+        namespace = {}
+        exec(compile(text, f"<stubgen {key[:12]}>", "exec"), namespace)
+        _compiled[key] = namespace["bind"]
+    return _compiled[key]
+
+def bind(comm, interface, modname="bsREPL", lanes=1, queue_depth=0, timeout=None, expired=None):
+    # without a timeout the stubs are generated without deadline checks
+    text = source(interface, vars(comm.regs), modname, lanes, queue_depth, timeout is not None)
+    return compile_source(text)(comm, timeout, expired)
+
+def adapter_layout(repl, modname, base):
+    # the registers bsREPL's adapter defines, laid out and given modes the
+    # way litex exports a CSR bank: {name: (addr, length, mode)}
+    from litex.soc.interconnect.csr import CSRStatus
+    layout = {}
+    offset = 0
+    for csr in repl.get_csrs():
+        length = (csr.size + BUSWORD - 1)//BUSWORD
+        mode = "ro" if isinstance(csr, CSRStatus) and not hasattr(csr, "r") else "rw"
+        layout[f"{modname}_{csr.name}"] = (base + 4*offset, length, mode)
+        offset += length
+    return layout
+
+def check(table, interface, module, modname, lanes, queue_depth, perf, pop=False):
+    # compare csr.csv with the adapter the same options build
+    from bsREPL import bsREPL
+    repl = bsREPL(interface=interface, module=module, modname=modname,
+                  lanes=lanes, queue_depth=queue_depth, perf=perf, pop=pop)
+    errors = []
+    for name, (addr, length, mode) in adapter_layout(repl, modname, table.bases[modname]).items():
+        reg = table.regs.get(name)
+        if reg is None:
+            errors.append(f"{name} missing")
+        elif (reg.addr, reg.length) != (addr, length):
+            errors.append(f"{name} at {reg.addr:#x}/{reg.length}, adapter has {addr:#x}/{length}")
+        elif reg.mode != mode:
+            errors.append(f"{name} is {reg.mode}, adapter has {mode}")
+    return errors
+
+def update_csv(path, layout):
+    # rewrite a csr.csv's rows for the adapter's registers from its layout,
+    # in place of theirs, leaving the rest of the SoC as it is: for when
+    # only the adapter changed and the full SoC build isn't at hand
+    with open(path) as f:
+        lines = f.read().split("\n")
+    names = set(layout)
+    rows = [f"csr_register,{name},{addr:#010x},{length},{mode}" for name, (addr, length, mode) in layout.items()]
+    kept = []
+    for line in lines:
+        if line.startswith("csr_register,") and line.split(",")[1] in names:
+            kept += rows
+            rows = []
+        else:
+            kept.append(line)
+    assert not rows, f"{path} has none of the adapter's registers to replace"
+    with open(path, "w") as f:
+        f.write("\n".join(kept))
+
+
+import unittest
+
+class TestStubgen(unittest.TestCase):
+
+    def test_check(self):
+        # the checked-in csr.csv is what the default adapter builds
+        from bsv_parser import BSVInterface
+        from csr_table import CSRTable
+        interface = BSVInterface.from_package("CollatzServer.bsv")["Ifc_type"]
+        self.assertEqual(check(CSRTable("csr.csv"), interface, "mkCollatzServer", "bsREPL", 1, 0, False), [])
+        # and a stale one is brought up to date from the adapter
+        import shutil, tempfile
+        from bsREPL import bsREPL
+        with tempfile.TemporaryDirectory() as d:
+            path = shutil.copy("csr.csv", d)
+            with open(path) as f:
+                text = f.read()
+            with open(path, "w") as f:
+                f.write(text.replace("bsREPL_ev_pending,0x00006028,1,rw", "bsREPL_ev_pending,0x00006028,1,ro"))
+            self.assertEqual(check(CSRTable(path), interface, "mkCollatzServer", "bsREPL", 1, 0, False),
+                             ["bsREPL_ev_pending is ro, adapter has rw"])
+            repl = bsREPL(interface=interface)
+            update_csv(path, adapter_layout(repl, "bsREPL", CSRTable(path).bases["bsREPL"]))
+            self.assertEqual(check(CSRTable(path), interface, "mkCollatzServer", "bsREPL", 1, 0, False), [])
+            with open(path) as f:
+                self.assertEqual(f.read(), text)
+
+    def test_calls(self):
+        for queue_depth in [0, 2]:
+            with self.subTest(queue_depth=queue_depth):
+                self.check_calls(queue_depth)
+
+    def check_calls(self, queue_depth):
+        # the stubs against the generic call path, on the same adapter
+        from bsREPL import bsREPL, _collatz, _sim
+        from waiters import SpinWaiter, CallTimeout
+        comm = _sim(queue_depth=queue_depth)
+        generic = bsREPL(comm, waiter=SpinWaiter())
+        self.assertEqual(generic.queue_depth, queue_depth)
+        stubs = bind(comm, generic.interface, queue_depth=queue_depth)
+        for n in [5, 27, 6]:
+            stubs.collatz_submit(n)
+            self.assertEqual(stubs.collatz_get(), _collatz(n))
+            self.assertEqual(generic.call("collatz_submit", "collatz_get", n), _collatz(n))
+        # with a deadline, a get with nothing submitted gives up
+        def expired(name):
+            raise CallTimeout(name, method=name)
+        stubs = bind(comm, generic.interface, queue_depth=queue_depth, timeout=0.2, expired=expired)
+        with self.assertRaises(CallTimeout) as cm:
+            stubs.collatz_get()
+        self.assertEqual(cm.exception.method, "collatz_get")
+        comm.close()
+
+
+if __name__ == "__main__":
+    from bsv_parser import BSVInterface
+    from csr_table import CSRTable
+
+    parser = argparse.ArgumentParser(description="generate bsREPL host stubs from a BSV interface")
+    parser.add_argument("package", help=".bsv file holding the interface")
+    parser.add_argument("interface", help="interface name, e.g. Ifc_type")
+    parser.add_argument("--module", default="mkCollatzServer", help="verilog module behind the adapter")
+    parser.add_argument("--modname", default="bsREPL", help="CSR bank name of the adapter")
+    parser.add_argument("--csr-csv", default="csr.csv")
+    parser.add_argument("--lanes", type=int, default=1)
+    parser.add_argument("--queue-depth", type=int, default=0)
+    parser.add_argument("--perf", action="store_true", help="adapter was built with perf counters")
+    parser.add_argument("--pop", nargs="?", type=int, const=True, default=False,
+                        help="adapter was built with read-to-pop registers, of this many payload bits if given")
+    parser.add_argument("--deadlines", action="store_true", help="poll loops give up after bind's timeout")
+    parser.add_argument("--no-check", action="store_true", help="don't check csr.csv against the adapter")
+    parser.add_argument("--update-csr", action="store_true", help="rewrite the adapter's rows of csr.csv from the adapter first")
+    parser.add_argument("-o", "--output", default=None, help="write here instead of stdout")
+    args = parser.parse_args()
+
+    interface = BSVInterface.from_package(args.package)[args.interface]
+    if args.update_csr:
+        from bsREPL import bsREPL
+        repl = bsREPL(interface=interface, module=args.module, modname=args.modname, lanes=args.lanes,
+                      queue_depth=args.queue_depth, perf=args.perf, pop=args.pop)
+        update_csv(args.csr_csv, adapter_layout(repl, args.modname, CSRTable(args.csr_csv).bases[args.modname]))
+    table = CSRTable(args.csr_csv)
+    if not args.no_check:
+        errors = check(table, interface, args.module, args.modname, args.lanes, args.queue_depth, args.perf, args.pop)
+        if errors:
+            sys.exit(f"{args.csr_csv} doesn't match the adapter:\n  " + "\n  ".join(errors))
+
+    text = source(interface, table.regs, args.modname, args.lanes, args.queue_depth, args.deadlines)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text)
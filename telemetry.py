@@ -0,0 +1,207 @@
+import time
+import argparse
+import threading
+import numpy as np
+
+# Background XADC sampling.
+#
+# A thread reads the raw XADC registers on a fixed schedule into a NumPy
+# ring buffer - a few CSR reads and an array store per sample, no unit
+# conversion and no pint. Conversion to degC / V is done in bulk on
+# whatever window is asked for, so the sampler can run next to a bsREPL
+# workload and show throttling at little cost to it.
+#
+#   tel = Telemetry(comm, interval=0.01).start()
+#   ...
+#   tel.stats(seconds=5)["temperature"]   # {"min": .., "max": .., "mean": ..}
+#   tel.window(seconds=5)["time"], ...["temperature"]
+#   tel.stop()
+
+CHANNELS = ["temperature", "vccint", "vccaux", "vccbram"]
+
+# XADC transfer functions, 12-bit codes
+def to_celsius(raw):
+    return raw*503.975/4096 - 273.15
+
+def to_volts(raw):
+    return raw*3/4096
+
+CONVERSIONS = {"temperature": to_celsius,
+               "vccint": to_volts,
+               "vccaux": to_volts,
+               "vccbram": to_volts}
+
+class Telemetry():
+
+    def __init__(self, comm, interval=0.01, size=1 << 16, gate_eos=False, lock=None, modname="xadc"):
+        self.interval = interval
+        # only sample once the XADC reports the end of a conversion sequence,
+        # so all channels come from the same sequence
+        self.gate_eos = gate_eos
+        # held around each sample's reads, for comms that can't take reads
+        # from two threads (the simulated one)
+        self.lock = lock
+        regs = comm.regs
+        self._reads = [getattr(regs, f"{modname}_{channel}").read for channel in CHANNELS]
+        self._eos = getattr(regs, f"{modname}_eos").read
+
+        self.size = size
+        self._time = np.zeros(size, dtype=np.float64)
+        self._raw = np.zeros((size, len(CHANNELS)), dtype=np.uint16)
+        self.samples = 0 # total taken; the newest is at (samples - 1) % size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        # take one sample now; False if gated on eos and it isn't set
+        if self.lock is not None:
+            with self.lock:
+                return self._sample()
+        return self._sample()
+
+    def _sample(self):
+        if self.gate_eos and not self._eos():
+            return False
+        i = self.samples % self.size
+        self._raw[i] = [read() for read in self._reads]
+        self._time[i] = time.monotonic()
+        self.samples += 1
+        return True
+
+    def _run(self):
+        next_t = time.monotonic()
+        while not self._stop.is_set():
+            self.sample()
+            # on a fixed schedule, skipping ticks we're late for
+            next_t += self.interval
+            now = time.monotonic()
+            if next_t < now:
+                next_t = now + self.interval - (now - next_t) % self.interval
+            self._stop.wait(next_t - now)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _indices(self, seconds=None, n=None):
+        # ring positions of the requested window, oldest first. One slot is
+        # left out, as the sampler may be overwriting it.
+        total = self.samples
+        k = min(total, self.size - 1)
+        if n is not None:
+            k = min(k, n)
+        idx = np.arange(total - k, total) % self.size
+        if seconds is not None and k:
+            t = self._time[idx]
+            idx = idx[t >= t[-1] - seconds]
+        return idx
+
+    def window(self, seconds=None, n=None, raw=False):
+        # the last `seconds` (or `n` samples, or everything buffered):
+        # {"time": monotonic seconds, channel: values in degC / V}
+        idx = self._indices(seconds, n)
+        codes = self._raw[idx]
+        result = {"time": self._time[idx]}
+        for i, channel in enumerate(CHANNELS):
+            column = codes[:, i]
+            result[channel] = column if raw else CONVERSIONS[channel](column.astype(np.float64))
+        return result
+
+    def stats(self, seconds=None, n=None):
+        w = self.window(seconds, n)
+        result = {"samples": len(w["time"])}
+        if result["samples"]:
+            result["seconds"] = w["time"][-1] - w["time"][0]
+        for channel in CHANNELS:
+            v = w[channel]
+            result[channel] = ({"min": v.min(), "max": v.max(), "mean": v.mean()} if v.size else {})
+        return result
+
+    def latest(self):
+        w = self.window(n=1)
+        return {channel: w[channel][0] for channel in CHANNELS} if len(w["time"]) else None
+
+
+import unittest
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_ring(self):
+        from comm_sim import CommSim
+        from models import XADCModel
+        comm = CommSim(modules={"xadc": XADCModel()})
+        comm.open()
+        tel = Telemetry(comm, size=4)
+        self.assertIsNone(tel.latest())
+        for _ in range(6):
+            self.assertTrue(tel.sample())
+        # past the end of the ring, the newest size - 1 are kept, oldest first
+        self.assertEqual(tel.samples, 6)
+        w = tel.window(raw=True)
+        self.assertEqual(len(w["time"]), 3)
+        self.assertTrue((np.diff(w["temperature"].astype(int)) > 0).all())
+        self.assertTrue((np.diff(w["time"]) >= 0).all())
+        # the channels of a sample are read one access (2 cycles) apart
+        self.assertEqual((w["vccint"] - w["temperature"]).tolist(), [256 + 2]*3)
+        last = tel.window(n=1, raw=True)["temperature"][0]
+        self.assertEqual(last, w["temperature"][-1])
+        self.assertEqual(tel.latest()["temperature"], to_celsius(float(last)))
+        self.assertEqual(tel.stats(n=2)["samples"], 2)
+        # gated on eos, only samples at the end of a sequence count
+        tel = Telemetry(comm, size=4, gate_eos=True)
+        taken = [tel.sample() for _ in range(8)]
+        self.assertIn(True, taken)
+        self.assertIn(False, taken)
+        self.assertEqual(tel.samples, sum(taken))
+        comm.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sample the XADC, optionally under bsREPL load")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between samples")
+    parser.add_argument("--seconds", type=float, default=10, help="how long to run")
+    parser.add_argument("--gate-eos", action="store_true", help="only sample at the end of a sequence")
+    parser.add_argument("--load", action="store_true", help="run collatz calls meanwhile")
+    args = parser.parse_args()
+
+    from device import comm
+    lock = threading.Lock() if type(comm).__name__ == "CommSim" else None
+    tel = Telemetry(comm, interval=args.interval, gate_eos=args.gate_eos, lock=lock).start()
+    deadline = time.monotonic() + args.seconds
+    if args.load:
+        from bsREPL import bsREPL
+        repl = bsREPL(comm)
+        comm.regs.bsREPL_reset.write(1)
+        calls = 0
+        while time.monotonic() < deadline:
+            if lock is not None:
+                with lock:
+                    calls += len(repl.map("collatz_submit", "collatz_get", range(5, 5 + 1000)))
+            else:
+                calls += len(repl.map("collatz_submit", "collatz_get", range(5, 5 + 1000)))
+        print(f"{calls/args.seconds:.0f} calls/s")
+    else:
+        time.sleep(args.seconds)
+    tel.stop()
+    s = tel.stats()
+    print(f"{s['samples']} samples over {s.get('seconds', 0):.1f}s")
+    for channel in CHANNELS:
+        unit = "degC" if channel == "temperature" else "V"
+        c = s[channel]
+        if c:
+            print(f"{channel:12} min {c['min']:7.3f} max {c['max']:7.3f} mean {c['mean']:7.3f} {unit}")
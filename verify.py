@@ -0,0 +1,167 @@
+import os
+import time
+import argparse
+import numpy as np
+
+# Bulk verification of bsREPL methods against a NumPy golden model.
+#
+# A model maps an int64 array of inputs to an int64 array of expected
+# results, with -1 for inputs the hardware can't complete. Those are not sent:
+# for collatz, n < 1 or a trajectory that overflows Int#(64) leaves
+# mkCollatzServer spinning forever. Everything else is streamed through the
+# fastest call path the repl has, in chunks, and compared in bulk.
+#
+#   python verify.py --sweep 5:10000
+#   python verify.py --random 1000000 --seed 1
+
+INT64_MAX = np.iinfo(np.int64).max
+# 3n+1 no longer fits in an Int#(64) above this
+ODD_LIMIT = (INT64_MAX - 1)//3
+
+class CollatzModel():
+    # steps to reach 1, as counted by mkCollatzServer. Every n below
+    # 2**memo_bits is tabulated up front; other inputs are stepped in
+    # lockstep until they drop into the table.
+
+    def __init__(self, memo_bits=20):
+        memo = np.array([-1, 0], dtype=np.int64)
+        while memo.size < 2**memo_bits:
+            # the new half only needs to step until it falls below memo.size
+            memo = np.concatenate([memo, self._count(np.arange(memo.size, 2*memo.size, dtype=np.int64), memo)])
+        self.memo = memo
+
+    def __call__(self, n):
+        return self._count(np.asarray(n, dtype=np.int64), self.memo)
+
+    @staticmethod
+    def _count(n, memo):
+        result = np.full(n.shape, -1, dtype=np.int64)
+        steps = np.zeros(n.shape, dtype=np.int64)
+        active = np.flatnonzero(n >= 1)
+        x = n[active]
+        while active.size:
+            hit = x < memo.size
+            hit[hit] = memo[x[hit]] >= 0
+            result[active[hit]] = steps[active[hit]] + memo[x[hit]]
+            keep = ~hit
+            odd = (x & 1) == 1
+            keep &= ~(odd & (x > ODD_LIMIT)) # would overflow, left at -1
+            active, x, odd = active[keep], x[keep], odd[keep]
+            x = np.where(odd, 3*x + 1, x >> 1)
+            steps[active] += 1
+        return result
+
+class Report():
+
+    def __init__(self, method):
+        self.method = method
+        self.checked = 0
+        self.skipped = 0
+        self.mismatches = [] # (input, expected, got)
+        self.seconds = 0.0
+
+    @property
+    def passed(self):
+        return not self.mismatches
+
+    def __str__(self):
+        rate = self.checked/self.seconds if self.seconds else 0
+        lines = [f"{self.method}: {self.checked} checked, {self.skipped} skipped, "
+                 f"{len(self.mismatches)} mismatches, {rate:.0f} calls/s"]
+        for n, expected, got in self.mismatches[:20]:
+            lines.append(f"  {n}: expected {expected}, got {got}")
+        if len(self.mismatches) > 20:
+            lines.append(f"  ... {len(self.mismatches) - 20} more")
+        return "\n".join(lines)
+
+def call_path(repl, submit, get):
+    # the fastest way this repl has of pushing an array through submit/get:
+    # DMA if the adapter streams this pair and there's a dma, else map
+    if getattr(repl, "streaming", False) and repl.dma is not None and (submit, get) == repl.stream_methods:
+        def streamed(values):
+            return repl.stream(values, submit, get).astype(np.uint64)
+        return streamed
+    def mapped(values):
+        return np.array(repl.map(submit, get, values.tolist()), dtype=np.uint64)
+    return mapped
+
+def verify(repl, submit, get, model, vectors, chunk=1 << 16):
+    names = [m[3] for m in repl.interface.actionmethods]
+    assert submit in names, f"{submit} is not an action method"
+    names = [m[2] for m in repl.interface.actionvaluemethods]
+    assert get in names, f"{get} is not an actionvalue method"
+
+    report = Report(f"{submit}/{get}")
+    call = call_path(repl, submit, get)
+    vectors = np.asarray(vectors, dtype=np.int64)
+    t = time.perf_counter()
+    for start in range(0, vectors.size, chunk):
+        v = vectors[start:start + chunk]
+        expected = model(v)
+        ok = expected >= 0
+        v, expected = v[ok], expected[ok]
+        report.skipped += int((~ok).sum())
+
+        got = call(v).view(np.int64)
+        bad = np.flatnonzero(got != expected)
+        report.mismatches += list(zip(v[bad].tolist(), expected[bad].tolist(), got[bad].tolist()))
+        report.checked += v.size
+    report.seconds = time.perf_counter() - t
+    return report
+
+def random_vectors(width, n, seed=None):
+    # uniform over the positive range of an Int#(width)
+    rng = np.random.default_rng(seed)
+    return rng.integers(1, 2**(width - 1) - 1, size=n, dtype=np.int64, endpoint=True)
+
+
+import unittest
+
+class TestVerify(unittest.TestCase):
+
+    def test_model(self):
+        from bsREPL import _collatz
+        model = CollatzModel(memo_bits=8)
+        ns = [1, 5, 27, 255, 256, 1000, 77031]
+        self.assertEqual(model(ns).tolist(), [_collatz(n) for n in ns])
+        # no answer for n < 1 or a trajectory that leaves Int#(64)
+        self.assertEqual(model([0, -5, (ODD_LIMIT + 1) | 1]).tolist(), [-1, -1, -1])
+
+    def test_sim(self):
+        from bsREPL import bsREPL, _sim
+        comm = _sim()
+        repl = bsREPL(comm)
+        model = CollatzModel(memo_bits=8)
+        report = verify(repl, "collatz_submit", "collatz_get", model, [0, 5, 27, -3, 6, 9], chunk=4)
+        self.assertTrue(report.passed, str(report))
+        self.assertEqual((report.checked, report.skipped), (4, 2))
+        # a model that disagrees shows up as mismatches
+        wrong = lambda n: np.where(np.asarray(n) == 27, 112, model(n))
+        report = verify(repl, "collatz_submit", "collatz_get", wrong, [5, 27])
+        self.assertEqual(report.mismatches, [(27, 112, 111)])
+        comm.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="verify bsREPL collatz against the golden model")
+    parser.add_argument("--sweep", default=None, help="start:stop range of inputs")
+    parser.add_argument("--random", type=int, default=0, help="number of random 64 bit inputs")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    from device import dev, comm
+    from bsREPL import bsREPL
+    from dma import DMA, DEVICE
+    repl = bsREPL(comm)
+    if repl.streaming and os.path.exists(DEVICE):
+        repl.dma = DMA(comm=comm).open()
+    model = CollatzModel()
+    dev.bsREPL_reset = 1
+
+    if args.sweep:
+        start, stop = (int(x, 0) for x in args.sweep.split(":"))
+        print(verify(repl, "collatz_submit", "collatz_get", model, np.arange(start, stop)))
+    if args.random:
+        (type, width, arg_name, method_name), = repl.interface.actionmethods
+        vectors = random_vectors(width, args.random, args.seed)
+        print(verify(repl, "collatz_submit", "collatz_get", model, vectors))
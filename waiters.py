@@ -0,0 +1,247 @@
+import os
+import abc
+import stat
+import time
+import select
+import struct
+from functools import partial
+
+# How the host waits for a bsREPL handshake to complete.
+#
+#   SpinWaiter      re-read the CSR until it's ready; lowest latency, one core
+#                   at 100% and a stream of non-posted reads on the link.
+#   AdaptiveWaiter  spin for `spin` seconds, then back off: block on the
+#                   interrupt if there is one, otherwise sleep between polls.
+#   IRQWaiter       block on the interrupt straight away.
+#
+# wait(ready, event) takes a predicate that does the CSR read, and the index
+# of the bsREPL event that fires when it may have become true.
+# With record=True every wait is timed (wall and cpu) so the modes can be
+# compared with stats(); with record=False nothing extra runs per wait.
+# With a timeout (seconds) a wait that doesn't complete in time raises
+# CallTimeout; the clock is only read while the wait is spinning anyway.
+
+class CallTimeout(TimeoutError):
+    # a wait on the card passed its deadline. bsREPL fills in the method,
+    # what its status bits say, and how (if at all) the adapter was
+    # recovered.
+    def __init__(self, message, method=None, diagnosis=None, recovery=None):
+        TimeoutError.__init__(self, message)
+        self.method = method
+        self.diagnosis = diagnosis
+        self.recovery = recovery
+
+class Deadline():
+    # for poll loops: expired() once timeout seconds have passed since the
+    # last restart(), check() raises then. Without a timeout, never.
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.restart()
+
+    def restart(self):
+        if self.timeout is not None:
+            self.at = time.monotonic() + self.timeout
+
+    def expired(self):
+        return self.timeout is not None and time.monotonic() > self.at
+
+    def check(self):
+        if self.expired():
+            raise CallTimeout(f"no progress in {self.timeout}s")
+
+class Waiter(abc.ABC):
+
+    def __init__(self, record=False, timeout=None):
+        self.timeout = timeout
+        self.latencies = []
+        self.wall = 0.0
+        self.cpu = 0.0
+        if record:
+            self.wait = self._timed_wait
+        else:
+            self.wait = self._wait
+
+    @abc.abstractmethod
+    def _wait(self, ready, event=None):
+        pass
+
+    def _timed_wait(self, ready, event=None):
+        t, c = time.perf_counter(), time.process_time()
+        self._wait(ready, event)
+        dt = time.perf_counter() - t
+        self.cpu += time.process_time() - c
+        self.wall += dt
+        self.latencies.append(dt)
+
+    def stats(self):
+        lat = sorted(self.latencies)
+        if not lat:
+            return {}
+        pick = lambda q: lat[min(len(lat) - 1, int(q*len(lat)))]
+        return {"waits": len(lat),
+                "mean": self.wall/len(lat),
+                "p50": pick(0.50),
+                "p99": pick(0.99),
+                "max": lat[-1],
+                "cpu": self.cpu/self.wall if self.wall else 0.0}
+
+    def reset_stats(self):
+        self.latencies = []
+        self.wall = self.cpu = 0.0
+
+class SpinWaiter(Waiter):
+
+    def _wait(self, ready, event=None):
+        if self.timeout is None:
+            while not ready():
+                pass
+            return
+        deadline = Deadline(self.timeout)
+        while not ready():
+            deadline.check()
+
+class AdaptiveWaiter(Waiter):
+
+    def __init__(self, spin=50e-6, sleep=20e-6, irq=None, record=False, timeout=None):
+        Waiter.__init__(self, record, timeout)
+        self.spin = spin
+        self.sleep = sleep
+        self.irq = irq
+
+    def _wait(self, ready, event=None):
+        deadline = time.perf_counter() + self.spin
+        give_up = Deadline(self.timeout)
+        while not ready():
+            if time.perf_counter() < deadline:
+                continue
+            if self.irq is not None and event is not None:
+                self.irq.wait(ready, event, give_up)
+                return
+            give_up.check()
+            time.sleep(self.sleep)
+
+class IRQWaiter(Waiter):
+
+    def __init__(self, irq, record=False, timeout=None):
+        if irq is None:
+            raise ValueError("IRQWaiter needs a BsREPLIRQ")
+        Waiter.__init__(self, record, timeout)
+        self.irq = irq
+
+    def _wait(self, ready, event=None):
+        deadline = Deadline(self.timeout)
+        if event is None:
+            while not ready():
+                deadline.check()
+            return
+        self.irq.wait(ready, event, deadline)
+
+class BsREPLIRQ():
+    # the bsREPL EventManager raises an MSI on vector `bsrepl_interrupt`.
+    # We need a kernel-side endpoint that blocks until it fires; `path` is a
+    # UIO-style char device: a 4 byte read returns the interrupt count once
+    # it has fired, and writing 1 re-arms it. The stock litepcie driver only
+    # services its DMA vectors and has no such node, so without a driver
+    # that forwards this one the constructor refuses rather than leave
+    # every wait to time out on a vector nobody reports.
+
+    def __init__(self, comm, path, modname="bsREPL"):
+        if not hasattr(comm.constants, "bsrepl_interrupt"):
+            raise RuntimeError("the SoC routes no MSI vector to bsREPL (built without --with-pcie?)")
+        if os.path.basename(path).startswith("litepcie"):
+            raise ValueError(f"{path} is the litepcie driver's DMA node; it never reports the bsREPL vector")
+        if not os.path.exists(path) or not stat.S_ISCHR(os.stat(path).st_mode):
+            raise FileNotFoundError(f"{path}: no bsREPL interrupt device. The stock litepcie driver doesn't "
+                                    "create one; it needs a driver that forwards vector bsrepl_interrupt "
+                                    "as a UIO-style node")
+        self.fd = os.open(path, os.O_RDWR)
+        self.poll = select.poll()
+        self.poll.register(self.fd, select.POLLIN)
+        regs = comm.regs
+        # pending is a status register that clears the bits written to it.
+        # Older litex exports it as ro, so the register's accessor may
+        # refuse the write: clear it by address.
+        self.pending = getattr(regs, f"{modname}_ev_pending")
+        self._clear = partial(comm.write, self.pending.addr)
+        self.enable = getattr(regs, f"{modname}_ev_enable")
+        # let the msi core forward our vector to the host
+        vector = comm.constants.bsrepl_interrupt
+        regs.pcie_msi_enable.write(regs.pcie_msi_enable.read() | (1 << vector))
+
+    def wait(self, ready, event, deadline=None):
+        mask = 1 << event
+        self.enable.write(self.enable.read() | mask)
+        while True:
+            # clear before checking, so an event between the check and the
+            # block is still counted by the kernel and we return right away
+            self._clear(mask)
+            if ready():
+                return
+            if deadline is not None:
+                deadline.check()
+            os.write(self.fd, struct.pack("I", 1))
+            # with a deadline, block no longer than its timeout
+            timeout = 1000 if deadline is None or deadline.timeout is None else min(1000, deadline.timeout*1e3)
+            if self.poll.poll(timeout):
+                os.read(self.fd, 4)
+
+    def close(self):
+        os.close(self.fd)
+
+
+import unittest
+
+class TestWaiters(unittest.TestCase):
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Waiter()
+
+    def test_timeout(self):
+        with self.assertRaises(CallTimeout):
+            SpinWaiter(timeout=0.01).wait(lambda: False)
+        AdaptiveWaiter(timeout=0.01).wait(iter([False, True]).__next__)
+
+    def test_no_irq(self):
+        from types import SimpleNamespace
+        with self.assertRaises(ValueError):
+            IRQWaiter(None)
+        comm = SimpleNamespace(constants=SimpleNamespace(bsrepl_interrupt=1))
+        with self.assertRaises(ValueError):
+            BsREPLIRQ(comm, "/dev/litepcie0")
+        with self.assertRaises(FileNotFoundError):
+            BsREPLIRQ(comm, "/dev/null/bsrepl_irq")
+        with self.assertRaises(RuntimeError):
+            BsREPLIRQ(SimpleNamespace(constants=SimpleNamespace()), "/dev/bsrepl_irq")
+
+    def test_irq(self):
+        # the register side of a wait on CommSim, with bsREPL's events.
+        # /dev/null stands in for the interrupt node: it always polls
+        # readable, so every pass is a clear, a check and a re-arm.
+        from comm_sim import CommSim, default_modules
+        from models import MSIModel
+        from bsREPL import bsREPL, _collatz
+        comm = CommSim(modules=dict(default_modules(), pcie_msi=MSIModel()))
+        comm.open()
+        comm.regs.bsREPL_reset.write(1)
+        irq = BsREPLIRQ(comm, "/dev/null")
+        vector = comm.constants.bsrepl_interrupt
+        self.assertTrue(comm.regs.pcie_msi_enable.read() & 1 << vector)
+        repl = bsREPL(comm, waiter=IRQWaiter(irq, timeout=5))
+        for n in [27, 5]:
+            self.assertEqual(repl.call("collatz_submit", "collatz_get", n), _collatz(n))
+        # the result's event is pending once a value is waiting, and a
+        # wait clears it before it checks
+        event = repl._events["collatz_get"]
+        get = 1 << event
+        self.assertTrue(comm.regs.bsREPL_ev_enable.read() & get)
+        repl.collatz_submit(n=6)
+        status = comm.regs.bsREPL_collatz_get_status_csr
+        SpinWaiter(timeout=5).wait(lambda: status.read() & 1 << 4)
+        self.assertTrue(comm.regs.bsREPL_ev_pending.read() & get)
+        irq.wait(lambda: True, event)
+        self.assertFalse(comm.regs.bsREPL_ev_pending.read() & get)
+        self.assertEqual(repl.collatz_get(), _collatz(6))
+        irq.close()
+        comm.close()